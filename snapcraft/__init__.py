@@ -153,13 +153,32 @@ class BasePlugin:
                 'source-subdir': {
                     'type': 'string',
                     'default': None,
-                }
+                },
+                'source-checksum': {
+                    'type': 'string',
+                    'default': '',
+                },
+                'source-depth': {
+                    'type': 'integer',
+                    'minimum': 0,
+                    'default': 0,
+                },
             },
             'required': [
                 'source',
             ]
         }
 
+    @classmethod
+    def pull_properties(cls):
+        """Return the names of the properties used to pull the part.
+
+        Changing one of these pulls the part again, changing any other
+        property only builds it again. The source properties and
+        stage-packages are always used to pull.
+        """
+        return []
+
     @property
     def PLUGIN_STAGE_SOURCES(self):
         """Define additional sources.list."""
@@ -192,6 +211,8 @@ class BasePlugin:
         - source-branch
         - source-tag
         - source-type
+        - source-depth
+        - source-checksum
 
         If source is empty or does not exist, the phase will be skipped.
 
@@ -218,7 +239,7 @@ class BasePlugin:
 
         shutil.copytree(
             sourcedir, self.builddir, symlinks=True,
-            ignore=lambda d, s: common.SNAPCRAFT_FILES
+            ignore=lambda d, s: [n for n in s if common.is_snapcraft_file(n)]
             if d is self.sourcedir else [])
 
     def snap_fileset(self):
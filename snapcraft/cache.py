@@ -0,0 +1,204 @@
+# -*- Mode:Python; indent-tabs-mode:nil; tab-width:4 -*-
+#
+# Copyright (C) 2016 Canonical Ltd
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 3 as
+# published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""File caches shared between parts and projects.
+
+Entries live under $XDG_CACHE_HOME/snapcraft/<namespace> and are added
+atomically or under a lock, so several snapcraft processes can share a
+cache. The least recently used entries are removed once a cache grows over
+its size limit.
+"""
+
+import contextlib
+import errno
+import fcntl
+import logging
+import os
+import shutil
+import tempfile
+
+from snapcraft import common
+
+
+logger = logging.getLogger(__name__)
+
+
+class FileCache:
+
+    def __init__(self, namespace, max_size):
+        self.cachedir = os.path.join(common.get_cachedir(), namespace)
+        self.max_size = max_size
+
+    def get(self, key):
+        """Return the path to the entry for key or None if not cached."""
+        path = os.path.join(self.cachedir, key)
+        try:
+            # The modification time tracks when an entry was last used.
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+        return path
+
+    def link(self, key, dst):
+        """Put the entry for key at dst, returning False if not cached."""
+        path = self.get(key)
+        if not path:
+            return False
+        try:
+            link_or_copy(path, dst)
+        except FileNotFoundError:
+            # Removed by another process since it was looked up.
+            return False
+        return True
+
+    def add(self, key, src):
+        """Add the file at src as the entry for key.
+
+        The cache is not pruned, call prune once done adding entries.
+        """
+        os.makedirs(self.cachedir, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=self.cachedir, prefix='.tmp-')
+        os.close(fd)
+        try:
+            os.remove(tmp)
+            link_or_copy(src, tmp)
+            os.rename(tmp, os.path.join(self.cachedir, key))
+        except OSError:
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(tmp)
+            raise
+
+    def prune(self):
+        """Remove the least recently used entries over the size limit."""
+        if not os.path.isdir(self.cachedir):
+            return
+        with lock(self.cachedir):
+            entries = []
+            for name in os.listdir(self.cachedir):
+                if name.startswith('.'):
+                    continue
+                with contextlib.suppress(FileNotFoundError):
+                    st = os.stat(os.path.join(self.cachedir, name))
+                    entries.append((st.st_mtime, st.st_size, name))
+
+            size = sum(e[1] for e in entries)
+            for mtime, entry_size, name in sorted(entries):
+                if size <= self.max_size:
+                    break
+                logger.debug('Removing %s from the cache', name)
+                with contextlib.suppress(FileNotFoundError):
+                    os.remove(os.path.join(self.cachedir, name))
+                size -= entry_size
+
+
+class DirectoryCache:
+    """A cache of directories updated in place, such as VCS mirrors.
+
+    Every entry has a lock of its own, so that entries are only pruned when
+    nobody uses them and unrelated entries can be used concurrently.
+    """
+
+    def __init__(self, namespace, max_size):
+        self.cachedir = os.path.join(common.get_cachedir(), namespace)
+        self.max_size = max_size
+
+    @contextlib.contextmanager
+    def use(self, key):
+        """Hold the entry for key for as long as the context lasts.
+
+        The path to the entry, which might not exist yet, is given.
+        """
+        os.makedirs(self.cachedir, exist_ok=True)
+        path = os.path.join(self.cachedir, key)
+        with lock_file(path + '.lock'):
+            yield path
+            # The modification time tracks when an entry was last used.
+            with contextlib.suppress(FileNotFoundError):
+                os.utime(path)
+
+    def prune(self):
+        """Remove the least recently used entries over the size limit.
+
+        Entries in use are left alone.
+        """
+        if not os.path.isdir(self.cachedir):
+            return
+        with lock(self.cachedir):
+            entries = []
+            for name in os.listdir(self.cachedir):
+                path = os.path.join(self.cachedir, name)
+                if name.startswith('.') or name.endswith('.lock') or \
+                        not os.path.isdir(path):
+                    continue
+                with contextlib.suppress(FileNotFoundError):
+                    entries.append(
+                        (os.stat(path).st_mtime, _tree_size(path), name))
+
+            size = sum(e[1] for e in entries)
+            for mtime, entry_size, name in sorted(entries):
+                if size <= self.max_size:
+                    break
+                path = os.path.join(self.cachedir, name)
+                with open(path + '.lock', 'w') as f:
+                    try:
+                        fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    except BlockingIOError:
+                        continue
+                    logger.debug('Removing %s from the cache', name)
+                    shutil.rmtree(path, ignore_errors=True)
+                    fcntl.flock(f, fcntl.LOCK_UN)
+                size -= entry_size
+
+
+def _tree_size(path):
+    size = 0
+    for root, dirs, files in os.walk(path):
+        for name in files:
+            with contextlib.suppress(FileNotFoundError):
+                size += os.lstat(os.path.join(root, name)).st_size
+    return size
+
+
+@contextlib.contextmanager
+def lock(directory, shared=False):
+    """Hold a lock on directory shared with other processes.
+
+    The lock is exclusive unless shared is set, shared locks are only
+    exclusive of the exclusive ones.
+    """
+    with lock_file(os.path.join(directory, '.lock'), shared):
+        yield
+
+
+@contextlib.contextmanager
+def lock_file(path, shared=False):
+    """Hold a lock on the file at path, created if needed."""
+    with open(path, 'w') as f:
+        fcntl.flock(f, fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def link_or_copy(src, dst):
+    """Hard link src to dst, copying instead across filesystems."""
+    try:
+        os.link(src, dst)
+    except OSError as e:
+        if e.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK):
+            raise
+        shutil.copy2(src, dst)
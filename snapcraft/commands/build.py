@@ -24,16 +24,29 @@ Usage:
 
 Options:
   -h --help             show this help message and exit.
+  -j N --jobs=N         number of parts to work on concurrently
+                        [default: 1].
+  --pipeline            advance each part to its next step as soon as it
+                        can instead of running the parts step by step.
+  --refresh-apt-index   update the package index stage-packages are
+                        fetched from even if it was updated recently.
 
 """
 
 from docopt import docopt
 
-from snapcraft import lifecycle
+from snapcraft import (
+    lifecycle,
+    repo,
+)
 
 
 def main(argv=None):
     argv = argv if argv else []
     args = docopt(__doc__, argv=argv)
 
-    lifecycle.execute('build', args['PART'])
+    if args['--refresh-apt-index']:
+        repo.expire_apt_indexes()
+
+    lifecycle.execute('build', args['PART'], jobs=int(args['--jobs']),
+                      pipeline=args['--pipeline'])
@@ -67,3 +67,7 @@ def main(argv=None):
     if os.path.exists(common.get_snapdir()):
         logger.info('Cleaning up snapping area')
         shutil.rmtree(common.get_snapdir())
+
+    if os.path.exists(common.get_debugdir()):
+        logger.info('Cleaning up debug symbols')
+        shutil.rmtree(common.get_debugdir())
@@ -25,19 +25,47 @@ Usage:
 Options:
   DIRECTORY             optional target directory to snap.
   -h --help             show this help message and exit.
+  -j N --jobs=N         number of parts to work on concurrently
+                        [default: 1].
+  --pipeline            advance each part to its next step as soon as it
+                        can instead of running the parts step by step.
+  --refresh-apt-index   update the package index stage-packages are
+                        fetched from even if it was updated recently.
+  --compression=NAME    the squashfs compressor to use, one of gzip, lzo,
+                        lz4, xz or zstd.
+  --compression-level=N
+                        the compression level, for gzip, lzo and zstd.
+  --block-size=SIZE     the squashfs block size, such as 128K or 1M.
+  --processors=N        the number of processors to compress with.
+  --benchmark-compression
+                        squash the snap with every available compressor and
+                        report how long it took and how big the snap is,
+                        instead of creating the snap.
+
+Compression options not given are taken from the compression section of
+snapcraft.yaml, by default the snap is compressed with xz.
 
 """
 
+import hashlib
+import json
 import logging
 import os.path
+import re
+import resource
 import subprocess
+import tempfile
+import time
 
 import yaml
 from docopt import docopt
 
+import snapcraft.yaml
 from snapcraft import (
     common,
     lifecycle,
+    pluginhandler,
+    repo,
 )
 
 
@@ -59,6 +87,125 @@ def _format_snap_name(snap):
     return '{name}_{version}_{arch}.snap'.format(**snap)
 
 
+_ALGORITHMS = ('gzip', 'lzo', 'lz4', 'xz', 'zstd')
+# The mksquashfs option to set the compression level of each compressor.
+_LEVEL_OPTIONS = {
+    'gzip': '-Xcompression-level',
+    'lzo': '-Xcompression-level',
+    'zstd': '-Xcompression-level',
+}
+
+
+def _compression_from_args(args, compression):
+    compression = dict(compression or {})
+    for option, key in (('--compression', 'algorithm'),
+                        ('--compression-level', 'level'),
+                        ('--block-size', 'block-size'),
+                        ('--processors', 'processors')):
+        if args[option] is not None:
+            compression[key] = args[option]
+    return compression
+
+
+def _check_compression(compression, benchmark=False):
+    """Raise a ValueError for compression options mksquashfs would reject.
+
+    The level is only checked against the algorithm when not benchmarking,
+    benchmarks use it for the algorithms it applies to.
+    """
+    algorithm = compression.get('algorithm', 'xz')
+    if algorithm not in _ALGORITHMS:
+        raise ValueError('The compression must be one of {}, not {!r}'.format(
+            ', '.join(_ALGORITHMS), algorithm))
+    for key in ('level', 'processors'):
+        value = compression.get(key)
+        if value is not None and not re.match(r'^[1-9]\d*$', str(value)):
+            raise ValueError(
+                'The compression {} must be a positive integer, '
+                'not {!r}'.format(key, value))
+    block_size = compression.get('block-size')
+    if block_size is not None and \
+            not re.match(r'^\d+[KM]?$', str(block_size)):
+        raise ValueError(
+            'The block size must be a number of bytes, optionally followed '
+            'by K or M, not {!r}'.format(block_size))
+    if compression.get('level') is not None and not benchmark and \
+            algorithm not in _LEVEL_OPTIONS:
+        raise ValueError(
+            'A compression level cannot be set for {!r}'.format(algorithm))
+
+
+def _mksquashfs_options(compression):
+    algorithm = compression.get('algorithm', 'xz')
+    options = ['-comp', algorithm]
+    if compression.get('level') is not None:
+        options += [_LEVEL_OPTIONS[algorithm], str(compression['level'])]
+    if compression.get('block-size') is not None:
+        options += ['-b', str(compression['block-size'])]
+    if compression.get('processors') is not None:
+        options += ['-processors', str(compression['processors'])]
+    return options
+
+
+def _available_compressors():
+    # mksquashfs lists its compressors in its usage, which it prints to
+    # stderr and exits with an error for.
+    proc = subprocess.Popen(['mksquashfs', '-help'], stdout=subprocess.PIPE,
+                            stderr=subprocess.STDOUT)
+    usage = proc.communicate()[0].decode()
+    _, _, compressors = usage.partition('Compressors available')
+    return re.findall(r'^\t(\w+)(?: \(default\))?$', compressors, re.M)
+
+
+def _benchmark_compression(snap_dir, compression):
+    logger.info('{:<8}{:>10}{:>10}{:>14}'.format(
+        'Comp', 'Wall (s)', 'CPU (s)', 'Size (bytes)'))
+    with tempfile.TemporaryDirectory() as tmpdir:
+        snap_file = os.path.join(tmpdir, 'benchmark.snap')
+        for algorithm in _available_compressors():
+            options = dict(compression, algorithm=algorithm)
+            if algorithm not in _LEVEL_OPTIONS:
+                options.pop('level', None)
+            before = resource.getrusage(resource.RUSAGE_CHILDREN)
+            start = time.monotonic()
+            subprocess.check_call(
+                ['mksquashfs', snap_dir, snap_file, '-noappend'] +
+                _mksquashfs_options(options), stdout=subprocess.DEVNULL)
+            wall = time.monotonic() - start
+            after = resource.getrusage(resource.RUSAGE_CHILDREN)
+            cpu = (after.ru_utime - before.ru_utime +
+                   after.ru_stime - before.ru_stime)
+            logger.info('{:<8}{:>10.2f}{:>10.2f}{:>14}'.format(
+                algorithm, wall, cpu, os.path.getsize(snap_file)))
+
+
+def _snap_manifest_file(snap_dir):
+    # Kept out of the project, where snapcraft clean would have to know
+    # about it, and keyed by the snap directory it is for.
+    return os.path.join(common.get_cachedir(), 'snaps', hashlib.sha256(
+        os.path.abspath(snap_dir).encode()).hexdigest())
+
+
+def _load_snap_manifest(snap_dir):
+    try:
+        with open(_snap_manifest_file(snap_dir)) as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return {}
+
+
+def _is_snapped(manifest, snap_name, options, fingerprint):
+    """Return True if snap_name was made from the same snap dir before."""
+    try:
+        st = os.stat(snap_name)
+    except FileNotFoundError:
+        return False
+    return (manifest.get('snap') == snap_name and
+            manifest.get('options') == options and
+            manifest.get('fingerprint') == fingerprint and
+            manifest.get('stat') == [st.st_size, st.st_mtime_ns])
+
+
 def main(argv=None):
     argv = argv if argv else []
     args = docopt(__doc__, argv=argv)
@@ -68,14 +215,52 @@ def main(argv=None):
         # TODO: write integration test
         snap_dir = os.path.abspath(args['DIRECTORY'])
         snap = _snap_data_from_dir(snap_dir)
+        compression = _compression_from_args(args, None)
+        _check_compression(compression, args['--benchmark-compression'])
     else:
+        compression = _compression_from_args(
+            args, snapcraft.yaml.load_compression())
+        # Before anything is built, not to find out once it is.
+        _check_compression(compression, args['--benchmark-compression'])
+        if args['--refresh-apt-index']:
+            repo.expire_apt_indexes()
         # make sure the full lifecycle is executed
         snap_dir = common.get_snapdir()
-        snap = lifecycle.execute('strip')
+        snap = lifecycle.execute('strip', jobs=int(args['--jobs']),
+                                 pipeline=args['--pipeline'])
+
+    if args['--benchmark-compression']:
+        _benchmark_compression(snap_dir, compression)
+        return
 
     snap_name = _format_snap_name(snap)
 
+    options = _mksquashfs_options(compression)
+    if args['DIRECTORY']:
+        _mksquashfs(snap_dir, snap_name, options)
+        return
+
+    # The snap directory made by the lifecycle is only squashed again
+    # when its contents changed since the snap was made.
+    manifest = _load_snap_manifest(snap_dir)
+    fingerprint, files = pluginhandler.fingerprint_directory(
+        snap_dir, manifest.get('files'))
+    if _is_snapped(manifest, snap_name, options, fingerprint):
+        logger.info('Skipping snap {} (already snapped)'.format(snap_name))
+        return
+
+    _mksquashfs(snap_dir, snap_name, options)
+    st = os.stat(snap_name)
+    manifest_file = _snap_manifest_file(snap_dir)
+    os.makedirs(os.path.dirname(manifest_file), exist_ok=True)
+    with open(manifest_file, 'w') as f:
+        json.dump({'snap': snap_name, 'options': options,
+                   'fingerprint': fingerprint, 'files': files,
+                   'stat': [st.st_size, st.st_mtime_ns]}, f)
+
+
+def _mksquashfs(snap_dir, snap_name, options):
     logger.info('Snapping {}'.format(snap_name))
     subprocess.check_call(
-        ['mksquashfs', snap_dir, snap_name, '-noappend', '-comp', 'xz'])
+        ['mksquashfs', snap_dir, snap_name, '-noappend'] + options)
     logger.info('Snapped {}'.format(snap_name))
@@ -17,13 +17,13 @@
 # Data/methods shared between plugins and snapcraft
 
 import os
+import re
 import subprocess
 import sys
-import tempfile
 import urllib
 
 
-SNAPCRAFT_FILES = ['snapcraft.yaml', 'parts', 'stage', 'snap']
+SNAPCRAFT_FILES = ['snapcraft.yaml', 'parts', 'stage', 'snap', 'snap-debug']
 COMMAND_ORDER = ['pull', 'build', 'stage', 'strip']
 _DEFAULT_PLUGINDIR = '/usr/share/snapcraft/plugins'
 _plugindir = _DEFAULT_PLUGINDIR
@@ -35,31 +35,87 @@ _arch_triplet = None
 env = []
 
 
+def is_snapcraft_file(name):
+    """Return True for what snapcraft creates in the project directory."""
+    return name in SNAPCRAFT_FILES or name.endswith('.snap')
+
+
 def assemble_env():
     return '\n'.join(['export ' + e for e in env])
 
 
 def run(cmd, **kwargs):
     assert isinstance(cmd, list), 'run command must be a list'
-    # FIXME: This is gross to keep writing this, even when env is the same
-    with tempfile.NamedTemporaryFile(mode='w+') as f:
-        f.write(assemble_env())
-        f.write('\n')
-        f.write('exec $*')
-        f.flush()
-        subprocess.check_call(['/bin/sh', f.name] + cmd, **kwargs)
+    kwargs['env'] = _get_run_env(kwargs.get('env'))
+    subprocess.check_call(cmd, **kwargs)
 
 
 def run_output(cmd, **kwargs):
     assert isinstance(cmd, list), 'run command must be a list'
-    # FIXME: This is gross to keep writing this, even when env is the same
-    with tempfile.NamedTemporaryFile(mode='w+') as f:
-        f.write(assemble_env())
-        f.write('\n')
-        f.write('exec $*')
-        f.flush()
-        return subprocess.check_output(['/bin/sh', f.name] + cmd,
-                                       **kwargs).decode('utf8').strip()
+    kwargs['env'] = _get_run_env(kwargs.get('env'))
+    return subprocess.check_output(cmd, **kwargs).decode('utf8').strip()
+
+
+_NAME = r'[A-Za-z_][A-Za-z0-9_]*'
+_ASSIGNMENT = re.compile(r'^({})=(.*)$'.format(_NAME), re.DOTALL)
+_VARIABLE = re.compile(r'\$(?:\{{({0})\}}|({0}))'.format(_NAME))
+_UNSAFE_QUOTED = set('"\\`$')
+_UNSAFE_UNQUOTED = _UNSAFE_QUOTED | set(' \t\n;&|<>()~\'')
+
+# The last evaluated env, commands usually run with the same one.
+_run_env = (None, None)
+
+
+def _get_run_env(base=None):
+    """Return env evaluated on top of base (the process env by default)."""
+    global _run_env
+    if base is None:
+        base = os.environ
+    key = (tuple(env), tuple(sorted(base.items())))
+    if _run_env[0] != key:
+        _run_env = (key, _evaluate_env(env, base))
+    return _run_env[1]
+
+
+def _evaluate_env(lines, base):
+    result = dict(base)
+    for line in lines:
+        match = _ASSIGNMENT.match(line)
+        value = _expand(match.group(2), result) if match else None
+        if value is None:
+            # Not a plain assignment, let the shell make sense of it.
+            return _evaluate_env_in_shell(lines, base)
+        result[match.group(1)] = value
+    return result
+
+
+def _expand(value, variables):
+    """Expand the variables in value as the shell would.
+
+    None is returned if value needs anything else from the shell.
+    """
+    unsafe = _UNSAFE_UNQUOTED
+    if len(value) > 1 and value[0] == value[-1] == '"':
+        value = value[1:-1]
+        unsafe = _UNSAFE_QUOTED
+    if unsafe.intersection(_VARIABLE.sub('', value)):
+        return None
+    return _VARIABLE.sub(
+        lambda m: variables.get(m.group(1) or m.group(2), ''), value)
+
+
+def _evaluate_env_in_shell(lines, base):
+    # Anything written by the exports goes to stderr so that only the
+    # resulting env is captured.
+    script = '{{\n{}\n}} >&2\nexec env -0'.format(
+        '\n'.join(['export ' + l for l in lines]))
+    output = subprocess.check_output(['/bin/sh', '-c', script], env=base)
+    result = {}
+    for variable in output.decode('utf8').split('\0'):
+        name, sep, value = variable.partition('=')
+        if sep:
+            result[name] = value
+    return result
 
 
 def fatal():
@@ -95,6 +151,16 @@ def get_snapdir():
     return os.path.join(os.getcwd(), 'snap')
 
 
+def get_debugdir():
+    return os.path.join(os.getcwd(), 'snap-debug')
+
+
+def get_cachedir():
+    cache_home = os.environ.get(
+        'XDG_CACHE_HOME', os.path.join(os.path.expanduser('~'), '.cache'))
+    return os.path.join(cache_home, 'snapcraft')
+
+
 def set_plugindir(plugindir):
     global _plugindir
     _plugindir = plugindir
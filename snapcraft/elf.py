@@ -0,0 +1,260 @@
+# -*- Mode:Python; indent-tabs-mode:nil; tab-width:4 -*-
+#
+# Copyright (C) 2016 Canonical Ltd
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 3 as
+# published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Find, strip and follow the ELF executables and libraries in a tree."""
+
+import concurrent.futures
+import contextlib
+import filecmp
+import logging
+import mmap
+import os
+import shutil
+import struct
+import subprocess
+
+
+logger = logging.getLogger(__name__)
+
+_ELF_MAGIC = b'\x7fELF'
+# The e_type of executables and shared objects, the only ones stripped.
+_ET_EXEC = 2
+_ET_DYN = 3
+_SHT_DYNAMIC = 6
+_DT_NULL = 0
+_DT_NEEDED = 1
+_DT_RPATH = 15
+_DT_RUNPATH = 29
+
+
+def is_elf(path):
+    """Return True if path is an ELF executable or shared object."""
+    try:
+        with open(path, 'rb') as f:
+            header = f.read(18)
+    except OSError:
+        return False
+    if len(header) < 18 or header[:4] != _ELF_MAGIC:
+        return False
+    byteorder = 'little' if header[5] == 1 else 'big'
+    return int.from_bytes(header[16:18], byteorder) in (_ET_EXEC, _ET_DYN)
+
+
+def find_elf_files(root, files):
+    """Return which of files, relative to root, are ELF files.
+
+    Symlinks are left out, what they point to is listed on its own.
+    """
+    files = [f for f in files if not os.path.islink(os.path.join(root, f))]
+    with concurrent.futures.ThreadPoolExecutor() as executor:
+        found = list(executor.map(
+            is_elf, [os.path.join(root, f) for f in files]))
+    return [f for f, elf in zip(files, found) if elf]
+
+
+def strip_files(root, files, debugdir=None):
+    """Strip the ELF files, relative to root, returning those that changed.
+
+    Each stripped file replaces the original, so hardlinks to it are only
+    broken when it changed. With debugdir, the debug information of every
+    file that changed is kept in debugdir as the file name plus '.debug'.
+    """
+    paths = [os.path.join(root, f) for f in files]
+    debugpaths = [os.path.join(debugdir, f + '.debug') if debugdir else None
+                  for f in files]
+    # The work is done by the strip processes, threads are enough to keep
+    # a few of them running at once.
+    with concurrent.futures.ThreadPoolExecutor(
+            max_workers=os.cpu_count()) as executor:
+        changed = list(executor.map(_strip_file, paths, debugpaths))
+    return [f for f, c in zip(files, changed) if c]
+
+
+def _strip_file(path, debugpath):
+    stripped = path + '.snapcraft-stripped'
+    try:
+        _run(['strip', '--strip-unneeded', '-o', stripped, path])
+        if filecmp.cmp(path, stripped, shallow=False):
+            os.remove(stripped)
+            return False
+        if debugpath:
+            os.makedirs(os.path.dirname(debugpath), exist_ok=True)
+            _run(['objcopy', '--only-keep-debug', path, debugpath])
+            _run(['objcopy', '--add-gnu-debuglink=' + debugpath, stripped])
+        shutil.copymode(path, stripped)
+        os.rename(stripped, path)
+    except (OSError, subprocess.CalledProcessError) as e:
+        logger.warning('Could not strip %s: %s', path,
+                       getattr(e, 'output', b'').decode().strip() or e)
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(stripped)
+        return False
+    return True
+
+
+def _run(cmd):
+    subprocess.check_output(cmd, stderr=subprocess.STDOUT)
+
+
+def read_dynamic(path):
+    """Return the libraries needed by the ELF file and its search path.
+
+    The search path is the RUNPATH of the file or, without one, its RPATH.
+    Both are empty for files without a dynamic section.
+    """
+    with open(path, 'rb') as f:
+        try:
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            # Empty files cannot be mapped.
+            return [], []
+    with data:
+        return _read_dynamic(data)
+
+
+def _read_dynamic(data):
+    order = '<' if data[5] == 1 else '>'
+    if data[4] == 2:
+        shoff, = struct.unpack_from(order + 'Q', data, 0x28)
+        shentsize, shnum = struct.unpack_from(order + 'HH', data, 0x3a)
+        section_format, dyn_format = order + 'IIQQQQIIQQ', order + 'qQ'
+    else:
+        shoff, = struct.unpack_from(order + 'I', data, 0x20)
+        shentsize, shnum = struct.unpack_from(order + 'HH', data, 0x2e)
+        section_format, dyn_format = order + 'IIIIIIIIII', order + 'iI'
+
+    sections = [struct.unpack_from(section_format, data, shoff + i * shentsize)
+                for i in range(shnum)]
+    needed = []
+    rpath = runpath = ''
+    for section in sections:
+        if section[1] != _SHT_DYNAMIC:
+            continue
+        offset, size, link = section[4], section[5], section[6]
+        strtab = sections[link][4]
+        for tag, value in struct.iter_unpack(
+                dyn_format, data[offset:offset + size]):
+            if tag == _DT_NULL:
+                break
+            elif tag in (_DT_NEEDED, _DT_RPATH, _DT_RUNPATH):
+                end = data.find(b'\0', strtab + value)
+                string = data[strtab + value:end].decode()
+                if tag == _DT_NEEDED:
+                    needed.append(string)
+                elif tag == _DT_RPATH:
+                    rpath = string
+                else:
+                    runpath = string
+    return needed, [p for p in (runpath or rpath).split(':') if p]
+
+
+def find_unused_libraries(root, library_paths):
+    """Return the libraries in root none of its ELF files need.
+
+    The libraries are the ELF files directly in the library_paths, which
+    like the RPATHs of the files are absolute paths inside root. Every
+    other ELF file in root is taken to be used and the libraries it needs
+    are followed, as well as those they need in turn. Libraries not found
+    in root are left to the system. Symlinks to unused libraries are
+    returned along with them.
+    """
+    root = os.path.abspath(root)
+    files = []
+    for dirpath, dirnames, filenames in os.walk(root):
+        relpath = os.path.relpath(dirpath, root)
+        files.extend(os.path.normpath(os.path.join(relpath, f))
+                     for f in filenames)
+    elf_files = find_elf_files(root, files)
+
+    libdirs = []
+    for path in library_paths:
+        libdir = os.path.relpath(_in_root(root, path, '/'), root)
+        if libdir not in libdirs:
+            libdirs.append(libdir)
+    libraries = {f for f in elf_files if os.path.dirname(f) in libdirs}
+
+    used = set()
+    pending = [f for f in elf_files if f not in libraries]
+    while pending:
+        path = pending.pop()
+        if path in used:
+            continue
+        used.add(path)
+        try:
+            needed, search_path = read_dynamic(os.path.join(root, path))
+        except (OSError, ValueError, struct.error) as e:
+            logger.warning('Could not read the dynamic section of %s: %s',
+                           path, e)
+            continue
+        origin = '/' + os.path.dirname(path)
+        search_path = [p.replace('$ORIGIN', origin).replace(
+            '${ORIGIN}', origin) for p in search_path]
+        for name in needed:
+            library = _find_library(root, name, search_path, libdirs)
+            if library:
+                pending.append(library)
+
+    unused = []
+    for f in files:
+        path = os.path.join(root, f)
+        if os.path.islink(path):
+            target = _resolve(root, f)
+            if os.path.dirname(f) in libdirs and target in libraries and \
+                    target not in used:
+                unused.append(f)
+        elif f in libraries and f not in used:
+            unused.append(f)
+    return sorted(unused)
+
+
+def _find_library(root, name, search_path, libdirs):
+    if '/' in name:
+        candidates = [name if os.path.isabs(name) else '/' + name]
+    else:
+        candidates = [os.path.join(d, name) for d in search_path] + \
+            ['/' + os.path.join(d, name) for d in libdirs]
+    for candidate in candidates:
+        path = _in_root(root, candidate, '/')
+        if os.path.lexists(path):
+            resolved = _resolve(root, os.path.relpath(path, root))
+            if resolved:
+                return resolved
+    return None
+
+
+def _resolve(root, path):
+    """Follow the symlink at path, relative to root, staying in root.
+
+    Absolute symlinks point into root, as they will once the snap is
+    installed. None is returned for symlinks which cannot be resolved.
+    """
+    for _ in range(40):
+        link = os.path.join(root, path)
+        if not os.path.islink(link):
+            return path if os.path.exists(link) else None
+        target = _in_root(root, os.readlink(link),
+                          '/' + os.path.dirname(path))
+        path = os.path.relpath(target, root)
+    return None
+
+
+def _in_root(root, path, cwd):
+    """Return path, taken to be relative to root, as a path within root."""
+    path = os.path.normpath(os.path.join(cwd, path))
+    if path == root or path.startswith(root + os.sep):
+        # Library paths from the environment already include root.
+        return path
+    return os.path.join(root, path.lstrip('/'))
@@ -14,13 +14,16 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import concurrent.futures
 import logging
+import os
 
 import snapcraft
 import snapcraft.yaml
 
 from snapcraft import (
     common,
+    elf,
     meta,
     pluginhandler,
     repo,
@@ -30,7 +33,7 @@ from snapcraft import (
 logger = logging.getLogger(__name__)
 
 
-def execute(step, part_names=None):
+def execute(step, part_names=None, jobs=1, pipeline=False):
     """Exectute until step in the lifecycle.
 
     Lifecycle execution will happen for each step iterating over all
@@ -41,7 +44,17 @@ def execute(step, part_names=None):
     forced until the stage step for such part. If part_names was provided
     and after is not in this set, an exception will be raised.
 
+    If jobs is greater than 1 the pull and build steps of parts that do
+    not depend on each other are run concurrently in up to jobs worker
+    processes, stage and strip are always run one part at a time.
+
+    If pipeline is set each part advances to its next step as soon as its
+    own previous step and the staging of its prerequisites are done,
+    instead of waiting for every other part to finish the same step.
+
     :param str step: A valid step in the lifecycle: pull, build, strip or snap.
+    :param int jobs: The maximum number of parts to work on concurrently.
+    :param bool pipeline: Whether to run the lifecycle part by part.
     :raises RuntimeError: If a prerequesite of the part needs to be staged
                           and such part is not in the list of parts to iterate
                           over.
@@ -49,18 +62,50 @@ def execute(step, part_names=None):
     """
     config = snapcraft.yaml.load_config()
     repo.install_build_packages(config.build_tools)
+    _fetch_stage_packages(config, part_names)
 
-    _Executor(config).run(step, part_names)
+    if jobs > 1 or pipeline:
+        _ParallelExecutor(config, jobs, pipeline).run(step, part_names)
+    else:
+        _Executor(config).run(step, part_names)
 
     return {'name': config.data['name'],
             'version': config.data['version'],
             'arch': config.data['architectures']}
 
 
+def _fetch_stage_packages(config, part_names=None):
+    """Get the stage-packages of all the parts about to be pulled at once.
+
+    Parts sharing the same sources have their stage-packages resolved
+    together and fetched only once, each part is then left to unpack its
+    own packages when pulled.
+    """
+    if part_names:
+        parts = [p for p in config.all_parts if p.name in part_names]
+    else:
+        parts = list(config.all_parts)
+    for part in parts:
+        parts.extend(d for d in part.deps if d not in parts)
+
+    requests = {}
+    for part in parts:
+        if part.code.stage_packages and part.should_step_run('pull'):
+            sources = part.code.PLUGIN_STAGE_SOURCES or None
+            requests.setdefault(sources, {})[part.ubuntudir] = \
+                part.code.stage_packages
+
+    for sources, packages in requests.items():
+        repo.get_stage_packages(packages, sources)
+
+
 class _Executor:
 
     def __init__(self, config):
         self.config = config
+        # Whether the strip step ran for any part, the libraries in the
+        # snap can only have changed if it did.
+        self.stripped = False
 
     def run(self, step, part_names=None, recursed=False):
         if part_names:
@@ -101,9 +146,229 @@ class _Executor:
             self.run('stage', prereqs, recursed=True)
 
         common.env = self.config.build_env_for_part(part)
+        self._run_part_step(step, part)
+
+    def _run_part_step(self, step, part):
+        if step == 'strip' and part.should_step_run('strip'):
+            self.stripped = True
         getattr(part, step)()
 
     def _create_meta(self, step, part_names):
         if step == 'strip' and part_names == self.config.part_names:
             common.env = self.config.snap_env()
+            if self.stripped:
+                self._check_libraries()
+            saved = pluginhandler.link_duplicates(
+                common.get_snapdir(), self.config.all_parts)
+            if saved:
+                logger.info('Linked files with the same contents, saving '
+                            '{} bytes'.format(saved))
             meta.create(self.config.data)
+
+    def _check_libraries(self):
+        snapdir = common.get_snapdir()
+        unused = elf.find_unused_libraries(
+            snapdir, self.config.snap_library_paths())
+        if not unused:
+            return
+        if self.config.data.get('prune-libraries'):
+            for path in unused:
+                os.remove(os.path.join(snapdir, path))
+            logger.info('Removed {} libraries not needed by the snap'.format(
+                len(unused)))
+        else:
+            logger.info(
+                'The following libraries are not needed by the snap, set '
+                'prune-libraries to remove them:\n{}'.format(
+                    '\n'.join(unused)))
+
+
+# Steps that only touch the part's own directories and can therefore be
+# run for independent parts at the same time. The other steps migrate
+# files into the shared stage and snap directories.
+_CONCURRENT_STEPS = ('pull', 'build')
+
+# The configuration used by the worker processes, these are forked from
+# the main process so it is inherited instead of being pickled.
+_worker_config = None
+
+
+def _run_step_in_worker(step, part_name):
+    part = next(p for p in _worker_config.all_parts if p.name == part_name)
+    common.reset_env()
+    common.env = _worker_config.build_env_for_part(part)
+    try:
+        getattr(part, step)()
+    except Exception as e:
+        # Not every exception raised by a plugin can be pickled back to
+        # the main process, so only the message is carried over.
+        raise RuntimeError('Failed to {} {!r}: {}'.format(
+            step, part_name, getattr(e, 'message', None) or e)) from None
+
+
+class _ParallelExecutor(_Executor):
+
+    def __init__(self, config, jobs, pipeline=False):
+        super().__init__(config)
+        self.jobs = jobs
+        self.pipeline = pipeline
+
+    def run(self, step, part_names=None):
+        if part_names:
+            self.config.validate_parts(part_names)
+        else:
+            part_names = self.config.part_names
+
+        last_steps = self._last_steps(step, part_names)
+
+        global _worker_config
+        _worker_config = self.config
+        with concurrent.futures.ProcessPoolExecutor(self.jobs) as pool:
+            if self.pipeline:
+                self._run_pipelined(pool, last_steps)
+            else:
+                for level in self._levels(last_steps):
+                    self._run_level(pool, level, last_steps)
+
+        self._create_meta(step, part_names)
+
+    def _last_steps(self, step, part_names):
+        """Return a dict with the last step to run for every needed part.
+
+        The requested parts run until step, their prerequisites, and the
+        prerequisites of those, need to run until stage.
+        """
+        last_steps = {}
+        for part_name in part_names:
+            prereqs = self.config.part_prereqs(part_name)
+            if not prereqs.issubset(part_names):
+                raise RuntimeError(
+                    'Requested {!r} of {!r} but there are unsatisfied '
+                    'prerequisites: {!r}'.format(
+                        step, part_name, ' '.join(sorted(prereqs))))
+            last_steps[part_name] = step
+
+        pending = list(part_names)
+        while pending:
+            for prereq in self.config.part_prereqs(pending.pop()):
+                if _step_index(last_steps.get(prereq, 'pull')) < \
+                        _step_index('stage'):
+                    last_steps[prereq] = 'stage'
+                    pending.append(prereq)
+
+        return last_steps
+
+    def _levels(self, last_steps):
+        """Yield lists of parts which have all of their prerequisites done.
+
+        Parts are taken in the order of config.all_parts, which is sorted
+        so that prerequisites come before the parts depending on them.
+        """
+        pending = [p for p in self.config.all_parts if p.name in last_steps]
+        done = set()
+        while pending:
+            level = [p for p in pending
+                     if self.config.part_prereqs(p.name).issubset(done)]
+            yield level
+            done |= {p.name for p in level}
+            pending = [p for p in pending if p not in level]
+
+    def _run_level(self, pool, level, last_steps):
+        last_index = max(_step_index(last_steps[p.name]) for p in level)
+        for step in common.COMMAND_ORDER[0:last_index + 1]:
+            parts = [p for p in level
+                     if _step_index(step) <= _step_index(last_steps[p.name])]
+            if step == 'stage':
+                pluginhandler.check_for_collisions(self.config.all_parts)
+
+            if step in _CONCURRENT_STEPS and len(parts) > 1:
+                self._run_concurrently(pool, step, parts)
+            else:
+                for part in parts:
+                    self._run_step_here(step, part)
+
+    def _run_pipelined(self, pool, last_steps):
+        """Run every part through its steps as soon as it is able to.
+
+        Completion is tracked for each part and step, a part starts
+        pulling once its prerequisites are staged and moves on to its
+        next step as soon as its own current step is done. Steps that
+        write to the shared directories are run here, one at a time,
+        while the pool keeps working on pulls and builds.
+        """
+        parts = [p for p in self.config.all_parts if p.name in last_steps]
+        # The index of the next step to run for each unfinished part.
+        pending = {p.name: 0 for p in parts}
+        staged = set()
+        running = {}
+
+        def complete(part, step):
+            if step == 'stage':
+                staged.add(part.name)
+            pending[part.name] += 1
+            if pending[part.name] > _step_index(last_steps[part.name]):
+                del pending[part.name]
+
+        try:
+            while pending:
+                busy = {part.name for part, step in running.values()}
+                ready = [p for p in parts
+                         if p.name in pending and p.name not in busy and
+                         self.config.part_prereqs(p.name).issubset(staged)]
+                local = []
+                for part in ready:
+                    step = common.COMMAND_ORDER[pending[part.name]]
+                    if step in _CONCURRENT_STEPS:
+                        future = pool.submit(
+                            _run_step_in_worker, step, part.name)
+                        running[future] = (part, step)
+                    else:
+                        local.append((part, step))
+
+                if local:
+                    part, step = local[0]
+                    if step == 'stage':
+                        self._check_built_for_collisions(pending)
+                    self._run_step_here(step, part)
+                    complete(part, step)
+                    continue
+
+                finished, _ = concurrent.futures.wait(
+                    running, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in finished:
+                    part, step = running.pop(future)
+                    future.result()
+                    complete(part, step)
+        except BaseException:
+            for future in running:
+                future.cancel()
+            raise
+
+    def _check_built_for_collisions(self, pending):
+        # Parts still to build in this run have incomplete install
+        # directories, they are checked once they get staged themselves.
+        parts = [p for p in self.config.all_parts
+                 if pending.get(p.name, len(common.COMMAND_ORDER)) >
+                 _step_index('build')]
+        pluginhandler.check_for_collisions(parts)
+
+    def _run_step_here(self, step, part):
+        common.reset_env()
+        common.env = self.config.build_env_for_part(part)
+        self._run_part_step(step, part)
+
+    def _run_concurrently(self, pool, step, parts):
+        futures = [pool.submit(_run_step_in_worker, step, p.name)
+                   for p in parts]
+        done, not_done = concurrent.futures.wait(
+            futures, return_when=concurrent.futures.FIRST_EXCEPTION)
+        for future in not_done:
+            future.cancel()
+        concurrent.futures.wait(not_done)
+        for future in futures:
+            if future.done() and not future.cancelled():
+                future.result()
+
+
+def _step_index(step):
+    return common.COMMAND_ORDER.index(step)
@@ -14,14 +14,24 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import collections
+import concurrent.futures
 import contextlib
-import filecmp
+import copy
+import fnmatch
 import glob
+import hashlib
 import importlib
+import json
 import logging
+import mmap
 import os
+import re
 import shutil
+import stat
 import sys
+import tarfile
+import tempfile
 
 import jsonschema
 import yaml
@@ -29,12 +39,19 @@ import yaml
 import snapcraft
 from snapcraft import (
     common,
+    elf,
     repo,
 )
 
 logger = logging.getLogger(__name__)
 
 
+# Properties that only affect the stage and strip steps, any other
+# property is considered an input to pulling the part.
+_STAGE_PROPERTIES = ('stage',)
+_STRIP_PROPERTIES = ('snap', 'strip-binaries', 'debug-symbols')
+
+
 def _local_plugindir():
     return os.path.abspath(os.path.join('parts', 'plugins'))
 
@@ -65,6 +82,12 @@ class PluginHandler:
         self.stagedir = os.path.join(os.getcwd(), 'stage')
         self.snapdir = os.path.join(os.getcwd(), 'snap')
         self.statefile = os.path.join(parts_dir, part_name, 'state')
+        self.fingerprintfile = os.path.join(
+            parts_dir, part_name, 'fingerprints')
+        # Options can be modified by plugins, keep a pristine copy to
+        # fingerprint the inputs to each step with.
+        self._properties = copy.deepcopy(properties)
+        self._plugin_name = plugin_name
 
         try:
             self._load_code(plugin_name, properties)
@@ -95,6 +118,7 @@ class PluginHandler:
         plugin = _get_plugin(module)
         options = _make_options(properties, plugin.schema())
         self.code = plugin(self.name, options)
+        self._plugin_file = getattr(module, '__file__', None)
 
     def makedirs(self):
         dirs = [
@@ -111,23 +135,112 @@ class PluginHandler:
         try:
             with open(self.statefile, 'r') as f:
                 lastStep = f.read()
-                return (common.COMMAND_ORDER.index(stage) >
-                        common.COMMAND_ORDER.index(lastStep))
+                if (common.COMMAND_ORDER.index(stage) >
+                        common.COMMAND_ORDER.index(lastStep)):
+                    return True
         except Exception:
             return True
 
+        # Steps recorded without fingerprints, i.e.; by an older snapcraft,
+        # are trusted to be up to date.
+        recorded = self._load_fingerprints().get(stage)
+        if recorded is None:
+            return False
+        return recorded['inputs'] != self._step_inputs(stage)
+
     def should_step_run(self, step, force=False):
         return force or self.is_dirty(step)
 
-    def mark_done(self, stage):
+    def mark_done(self, stage, outputs=None):
+        fingerprints = self._load_fingerprints()
+        fingerprints[stage] = {
+            'inputs': self._step_inputs(stage),
+            'outputs': outputs,
+        }
+        with open(self.fingerprintfile, 'w') as f:
+            yaml.dump(fingerprints, f, default_flow_style=False)
+
         with open(self.statefile, 'w+') as f:
             f.write(stage)
 
+    def staged_outputs(self):
+        """Return the fingerprint of the files this part last staged."""
+        return self._load_fingerprints().get('stage', {}).get('outputs')
+
+    def load_manifest(self, step):
+        """Return the files and directories this part last migrated in step.
+
+        The files map to records of their size, modification time and
+        digest, symlinks have no record.
+        """
+        return _load_manifest(self._manifest_file(step))
+
+    def save_manifest(self, step, manifest):
+        with open(self._manifest_file(step), 'w') as f:
+            json.dump(manifest, f)
+
+    def _manifest_file(self, step):
+        return os.path.join(self.code.partdir, '{}-manifest'.format(step))
+
+    def _migrated_by_others(self, step):
+        """Return the paths the other parts migrated in step."""
+        paths = set()
+        partsdir = os.path.dirname(self.code.partdir)
+        with contextlib.suppress(FileNotFoundError):
+            for name in os.listdir(partsdir):
+                if name == self.name:
+                    continue
+                manifest = _load_manifest(os.path.join(
+                    partsdir, name, '{}-manifest'.format(step)))
+                paths.update(manifest['files'], manifest['dirs'])
+        return paths
+
+    def _load_fingerprints(self):
+        try:
+            with open(self.fingerprintfile) as f:
+                return yaml.load(f) or {}
+        except (FileNotFoundError, yaml.YAMLError):
+            return {}
+
+    def _step_inputs(self, step):
+        if step == 'pull':
+            properties = {k: v for k, v in self._properties.items()
+                          if self._is_pull_property(k)}
+            return {
+                'plugin': self._plugin_name,
+                'properties': _digest(properties),
+                'source': _source_digest(self._properties.get('source')),
+                'stage-packages': sorted(self.code.stage_packages),
+            }
+        elif step == 'build':
+            # organize is done on what the build installed, changing it
+            # needs a new install to organize.
+            properties = {k: v for k, v in self._properties.items()
+                          if not self._is_pull_property(k) and
+                          k not in _STAGE_PROPERTIES + _STRIP_PROPERTIES}
+            return {
+                'plugin': _file_digest(self._plugin_file),
+                'properties': _digest(properties),
+                'prerequisites': {
+                    dep.name: dep.staged_outputs() for dep in self.deps},
+            }
+        elif step == 'stage':
+            return {'properties': _digest(
+                {k: self._properties.get(k) for k in _STAGE_PROPERTIES})}
+        else:
+            return {'properties': _digest(
+                {k: self._properties.get(k) for k in _STRIP_PROPERTIES})}
+
+    def _is_pull_property(self, name):
+        return name.startswith('source') or name == 'stage-packages' or \
+            name in self.code.pull_properties()
+
     def _setup_stage_packages(self):
         if self.code.stage_packages:
             ubuntu = repo.Ubuntu(
                 self.ubuntudir, sources=self.code.PLUGIN_STAGE_SOURCES)
-            ubuntu.get(self.code.stage_packages)
+            if not ubuntu.is_fetched(self.code.stage_packages):
+                ubuntu.get(self.code.stage_packages)
             ubuntu.unpack(self.code.installdir)
 
     def pull(self, force=False):
@@ -151,7 +264,7 @@ class PluginHandler:
 
     def migratable_fileset_for(self, stage):
         plugin_fileset = self.code.snap_fileset()
-        fileset = getattr(self.code.options, stage, ['*']) or ['*']
+        fileset = list(getattr(self.code.options, stage, ['*']) or ['*'])
         fileset.extend(plugin_fileset)
         return _migratable_filesets(fileset, self.code.installdir)
 
@@ -161,6 +274,9 @@ class PluginHandler:
         for key in organize_fileset:
             src = os.path.join(self.code.installdir, key)
             dst = os.path.join(self.code.installdir, organize_fileset[key])
+            if not os.path.lexists(src) and os.path.lexists(dst):
+                # Organized by an earlier run of stage.
+                continue
 
             os.makedirs(os.path.dirname(dst), exist_ok=True)
 
@@ -184,15 +300,20 @@ class PluginHandler:
         self._organize()
         snap_files, snap_dirs = self.migratable_fileset_for('stage')
 
+        previous = self.load_manifest('stage')
         try:
             _migrate_files(snap_files, snap_dirs, self.code.installdir,
-                           self.stagedir)
+                           self.stagedir, previous,
+                           lambda: self._migrated_by_others('stage'))
         except FileNotFoundError as e:
             logger.error('Could not find file %s defined in stage',
                          os.path.relpath(e.filename, os.path.curdir))
             return False
 
-        self.mark_done('stage')
+        self.save_manifest('stage', _make_manifest(
+            snap_files, snap_dirs, self.code.installdir, previous))
+        self.mark_done('stage', outputs=_fileset_digest(
+            snap_files | snap_dirs, self.code.installdir))
 
         return True
 
@@ -205,26 +326,131 @@ class PluginHandler:
         self.notify_stage('Stripping')
         snap_files, snap_dirs = self.migratable_fileset_for('snap')
 
+        previous = self.load_manifest('strip')
+        strip_binaries = getattr(self.code.options, 'strip_binaries', False)
+        # The binaries stripped from stage files that did not change since
+        # are left as they are.
+        sources = {}
+        if strip_binaries:
+            sources = _stripped_before(
+                snap_files, self.stagedir, self.snapdir, previous)
         try:
-            _migrate_files(snap_files, snap_dirs, self.stagedir, self.snapdir)
+            _migrate_files(snap_files, snap_dirs, self.stagedir, self.snapdir,
+                           previous, lambda: self._migrated_by_others('strip'),
+                           unchanged=sources)
         except FileNotFoundError as e:
                 logger.error('Could not find file %s defined in snap',
                              os.path.relpath(e.filename, os.path.curdir))
                 return False
 
+        if strip_binaries:
+            for f in self._strip_binaries(snap_files - set(sources), sources):
+                sources[f] = list(_digest_key(
+                    os.lstat(os.path.join(self.stagedir, f))))
+        # Only the files new or changed since the last strip are read, for
+        # the snap not to read them again. The others keep their digests.
+        manifest = _make_manifest(
+            snap_files, snap_dirs, self.snapdir, previous, read=True)
+        for f, source in sources.items():
+            manifest['files'][f] = manifest['files'][f][:3] + [source]
+        self.save_manifest('strip', manifest)
         self.mark_done('strip')
 
         return True
 
+    def _strip_binaries(self, snap_files, kept):
+        """Strip the ELF files in snap_files, returning them.
+
+        The binaries in kept were stripped before, the debug information
+        taken out of them is kept.
+        """
+        debug_symbols = getattr(self.code.options, 'debug_symbols', None)
+        elf_files = elf.find_elf_files(self.snapdir, snap_files)
+        if debug_symbols == 'tree':
+            stripped = elf.strip_files(
+                self.snapdir, elf_files, common.get_debugdir())
+        elif debug_symbols == 'archive':
+            archive = os.path.join(
+                common.get_debugdir(), '{}.tar.xz'.format(self.name))
+            with tempfile.TemporaryDirectory() as debugdir:
+                _extract_debug_files(archive, debugdir, kept)
+                stripped = elf.strip_files(
+                    self.snapdir, elf_files, debugdir)
+                os.makedirs(common.get_debugdir(), exist_ok=True)
+                with tarfile.open(archive, 'w:xz') as tar:
+                    for f in sorted(os.listdir(debugdir)):
+                        tar.add(os.path.join(debugdir, f), arcname=f)
+        else:
+            stripped = elf.strip_files(self.snapdir, elf_files)
+        logger.info('Stripped %d of %d binaries in %s', len(stripped),
+                    len(elf_files), self.name)
+        return elf_files
+
     def env(self, root):
         return self.code.env(root)
 
     def clean(self):
         logger.info('Cleaning up for part "{}"'.format(self.name))
+        # Take out what the part put in the shared directories first, the
+        # manifests saying what that is are in the part directory.
+        for step, directory in (('stage', self.stagedir),
+                                ('strip', self.snapdir)):
+            previous = self.load_manifest(step)
+            if previous['files'] or previous['dirs']:
+                _migrate_files(set(), set(), None, directory, previous,
+                               lambda: self._migrated_by_others(step))
         if os.path.exists(self.code.partdir):
             shutil.rmtree(self.code.partdir)
 
 
+def _digest(data):
+    return hashlib.sha256(
+        yaml.dump(data, default_flow_style=False).encode()).hexdigest()
+
+
+def _file_digest(path):
+    if not path:
+        return None
+    sha = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(2**20), b''):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def _fileset_digest(fileset, directory):
+    """Return a digest of the names, sizes and modification times."""
+    sha = hashlib.sha256()
+    for path in sorted(fileset):
+        st = os.lstat(os.path.join(directory, path))
+        sha.update('{}\0{}\0{}\0'.format(
+            path, st.st_size, st.st_mtime_ns).encode())
+    return sha.hexdigest()
+
+
+def _source_digest(source):
+    """Return a digest for a local source tree or tarball.
+
+    Remote sources are fully identified by the source properties.
+    """
+    if not source or common.isurl(source):
+        return None
+    if os.path.isfile(source):
+        return _file_digest(source)
+    if not os.path.isdir(source):
+        return None
+
+    fileset = set()
+    for root, dirs, files in os.walk(source):
+        if root == source:
+            # The project directory itself is a common local source.
+            dirs[:] = [d for d in dirs if not common.is_snapcraft_file(d)]
+            files = [f for f in files if not common.is_snapcraft_file(f)]
+        fileset |= {os.path.relpath(os.path.join(root, f), source)
+                    for f in files}
+    return _fileset_digest(fileset, source)
+
+
 def _make_options(properties, schema):
     jsonschema.validate(properties, schema)
 
@@ -292,35 +518,81 @@ def load_plugin(part_name, plugin_name, properties=None):
 
 def _migratable_filesets(fileset, srcdir):
     includes, excludes = _get_file_list(fileset)
+    return _FilesetMatcher(includes, excludes).match(srcdir)
+
+
+def _migrate_files(snap_files, snap_dirs, srcdir, dstdir, previous=None,
+                   migrated_by_others=set, unchanged=()):
+    """Hard link the files and create the dirs from srcdir in dstdir.
+
+    The paths in the previous manifest were migrated by this same part
+    before. Those no longer migrated are removed, unless another part
+    migrated them too as told by migrated_by_others, and those that were
+    replaced in srcdir since are linked again. The files in unchanged are
+    known to be up to date in dstdir, even if not links to srcdir.
+    """
+    previous_files = set(previous['files']) if previous else set()
+    previous_dirs = set(previous['dirs']) if previous else set()
+    dropped_files = previous_files - snap_files
+    dropped_dirs = previous_dirs - snap_dirs
+    if dropped_files or dropped_dirs:
+        others = migrated_by_others()
+        for snap_file in dropped_files - others:
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(os.path.join(dstdir, snap_file))
+        # Deepest first, directories still holding files are left.
+        for directory in sorted(dropped_dirs - others, reverse=True):
+            with contextlib.suppress(OSError):
+                os.rmdir(os.path.join(dstdir, directory))
 
-    include_files = _generate_include_set(srcdir, includes)
-    exclude_files, exclude_dirs = _generate_exclude_set(srcdir, excludes)
-
-    # And chop files, including whole trees if any dirs are mentioned
-    snap_files = include_files - exclude_files
-    for exclude_dir in exclude_dirs:
-        snap_files = set([x for x in snap_files
-                          if not x.startswith(exclude_dir + '/')])
-
-    # Separate dirs from files
-    snap_dirs = set([x for x in snap_files
-                     if os.path.isdir(os.path.join(srcdir, x)) and
-                     not os.path.islink(os.path.join(srcdir, x))])
-    snap_files = snap_files - snap_dirs
-
-    return snap_files, snap_dirs
-
-
-def _migrate_files(snap_files, snap_dirs, srcdir, dstdir):
     for directory in snap_dirs:
         os.makedirs(os.path.join(dstdir, directory), exist_ok=True)
 
     for snap_file in snap_files:
+        if snap_file in unchanged:
+            continue
         src = os.path.join(srcdir, snap_file)
         dst = os.path.join(dstdir, snap_file)
         os.makedirs(os.path.dirname(dst), exist_ok=True)
-        if not os.path.exists(dst) and not os.path.islink(dst):
-            os.link(src, dst, follow_symlinks=False)
+        if os.path.lexists(dst):
+            if snap_file not in previous_files or \
+                    os.path.samestat(os.lstat(src), os.lstat(dst)):
+                continue
+            os.remove(dst)
+        os.link(src, dst, follow_symlinks=False)
+
+
+def _stripped_before(files, srcdir, dstdir, previous):
+    """Return the files of the previous manifest stripped from srcdir.
+
+    Only those that did not change in srcdir nor dstdir since are returned,
+    with the key of the file in srcdir they were stripped from.
+    """
+    sources = {}
+    for f in files:
+        record = previous['files'].get(f)
+        if not record or len(record) < 4:
+            continue
+        try:
+            src_st = os.lstat(os.path.join(srcdir, f))
+            dst_st = os.lstat(os.path.join(dstdir, f))
+        except FileNotFoundError:
+            continue
+        if list(_digest_key(src_st)) == record[3] and \
+                list(record[:2]) == [dst_st.st_size, dst_st.st_mtime_ns]:
+            sources[f] = record[3]
+    return sources
+
+
+def _extract_debug_files(archive, debugdir, files):
+    """Extract the debug information of files from archive in debugdir."""
+    if not files:
+        return
+    names = {f + '.debug' for f in files}
+    with contextlib.suppress(FileNotFoundError, tarfile.TarError):
+        with tarfile.open(archive) as tar:
+            tar.extractall(debugdir, [m for m in tar.getmembers()
+                                      if m.name in names])
 
 
 def _get_file_list(stage_set):
@@ -342,81 +614,447 @@ def _get_file_list(stage_set):
     return includes, excludes
 
 
-def _generate_include_set(directory, includes):
-    include_files = set()
-    for include in includes:
-        if '*' in include:
-            matches = glob.glob(os.path.join(directory, include))
-            include_files |= set(matches)
+class _PatternNode:
+    """A node in a trie of path patterns, one level per path component."""
+
+    def __init__(self):
+        self.literals = {}
+        self.wildcards = []
+        self.match = False
+        self.dir_match = False
+
+    def is_leaf(self):
+        return not (self.literals or self.wildcards)
+
+
+def _compile_patterns(patterns, globbed):
+    """Return a trie of patterns, globbing those globbed() is True for."""
+    root = _PatternNode()
+    wildcards = {}
+    for pattern in patterns:
+        is_glob = globbed(pattern)
+        # A trailing slash only matches directories, as it does for glob.
+        dir_only = pattern.endswith(('/', '/.'))
+        pattern = os.path.normpath(pattern)
+        node = root
+        if pattern != '.':
+            for component in pattern.split('/'):
+                if not (is_glob and glob.has_magic(component)):
+                    node = node.literals.setdefault(component, _PatternNode())
+                    continue
+                key = (id(node), component)
+                if key not in wildcards:
+                    wildcards[key] = _PatternNode()
+                    node.wildcards.append((
+                        re.compile(fnmatch.translate(component)).match,
+                        component.startswith('.'), wildcards[key]))
+                node = wildcards[key]
+        if dir_only:
+            node.dir_match = True
         else:
-            include_files |= set([os.path.join(directory, include), ])
+            node.match = True
+    return root
+
+
+def _advance_patterns(nodes, name, is_dir):
+    """Return the nodes reached with name and whether a pattern matched."""
+    reached = []
+    for node in nodes:
+        if name in node.literals:
+            reached.append(node.literals[name])
+        for match, hidden, child in node.wildcards:
+            # Like glob, wildcards do not match hidden files unless the
+            # pattern itself starts with a dot.
+            if (hidden or not name.startswith('.')) and match(name):
+                reached.append(child)
+
+    matched = any(n.match or (n.dir_match and is_dir) for n in reached)
+    if not is_dir:
+        reached = []
+    return [n for n in reached if not n.is_leaf()], matched
+
+
+def _scandir(directory):
+    """Return the entries of directory, as os.scandir does."""
+    scandir = getattr(os, 'scandir', None)
+    if scandir:
+        return list(scandir(directory))
+    # os.scandir is only there since Python 3.5.
+    return [_DirEntry(directory, name) for name in os.listdir(directory)]
+
+
+class _DirEntry:
+    """The part of os.DirEntry used for filesets, without os.scandir."""
+
+    def __init__(self, directory, name):
+        self.name = name
+        self.path = os.path.join(directory, name)
+
+    def is_dir(self):
+        return os.path.isdir(self.path)
+
+    def is_symlink(self):
+        return os.path.islink(self.path)
+
+
+class _FilesetMatcher:
+    """Select the files in a directory with include and exclude patterns.
+
+    Patterns containing a '*' behave as if they were globbed, other
+    includes are taken literally even if they do not exist. Included
+    directories bring in everything under them and excluded ones take it
+    all out. The directory is scanned once for all the patterns.
+    """
+
+    def __init__(self, includes, excludes):
+        self._literals = [os.path.normpath(i) for i in includes
+                          if '*' not in i]
+        self._includes = _compile_patterns(includes, lambda i: '*' in i)
+        self._excludes = _compile_patterns(excludes, lambda e: True)
+
+    def match(self, srcdir):
+        """Return the sets of files and directories selected in srcdir."""
+        files = set()
+        dirs = set()
+        excluded = set()
+        excluded_dirs = set()
+
+        subtree = self._includes.match or self._includes.dir_match
+        if self._excludes.match or self._excludes.dir_match:
+            excluded.add('.')
+        elif subtree:
+            dirs.add('.')
+
+        stack = [('', srcdir, [self._includes], [self._excludes], subtree)]
+        while stack:
+            reldir, directory, includes, excludes, subtree = stack.pop()
+            try:
+                entries = _scandir(directory)
+            except OSError:
+                continue
+            for entry in entries:
+                path = os.path.join(reldir, entry.name)
+                try:
+                    is_dir = entry.is_dir()
+                except OSError:
+                    # Such as symlink loops, glob skips these too.
+                    is_dir = False
+                next_excludes, is_excluded = _advance_patterns(
+                    excludes, entry.name, is_dir)
+                if is_excluded:
+                    excluded.add(path)
+                    if is_dir:
+                        # Nothing under an excluded directory is selected.
+                        excluded_dirs.add(path)
+                        continue
+                next_includes, is_included = _advance_patterns(
+                    includes, entry.name, is_dir)
+                if not is_excluded and (subtree or is_included):
+                    if is_dir and not entry.is_symlink():
+                        dirs.add(path)
+                    else:
+                        files.add(path)
+
+                # Included directories are walked without following the
+                # symlinks in them, the patterns follow every directory.
+                walk = is_included or (subtree and not entry.is_symlink())
+                if is_dir and (walk or next_includes):
+                    stack.append((path, entry.path, next_includes,
+                                  next_excludes, walk))
+
+        for path in self._literals:
+            if path in files or path in dirs or path in excluded:
+                continue
+            parent = os.path.dirname(path)
+            while parent and parent not in excluded_dirs:
+                parent = os.path.dirname(parent)
+            if not parent:
+                files.add(path)
+
+        return files, dirs
+
 
-    include_dirs = [x for x in include_files if os.path.isdir(x)]
-    include_files = set([os.path.relpath(x, directory) for x in include_files])
+def _validate_relative_paths(files):
+    for d in files:
+        if os.path.isabs(d):
+            raise PluginError('path "{}" must be relative'.format(d))
 
-    # Expand includeFiles, so that an exclude like '*/*.so' will still match
-    # files from an include like 'lib'
-    for include_dir in include_dirs:
-        for root, dirs, files in os.walk(include_dir):
-            include_files |= \
-                set([os.path.relpath(os.path.join(root, d), directory)
-                     for d in dirs])
-            include_files |= \
-                set([os.path.relpath(os.path.join(root, f), directory)
-                     for f in files])
 
-    return include_files
+# The digests of the files read, by inode and the size and modification
+# time it had then, so that they hold for every hard link to a file.
+_digests = {}
 
 
-def _generate_exclude_set(directory, excludes):
-    exclude_files = set()
+def _digest_key(st):
+    return st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns
 
-    for exclude in excludes:
-        matches = glob.glob(os.path.join(directory, exclude))
-        exclude_files |= set(matches)
 
-    exclude_dirs = [os.path.relpath(x, directory)
-                    for x in exclude_files if os.path.isdir(x)]
-    exclude_files = set([os.path.relpath(x, directory)
-                         for x in exclude_files])
+def _read_digests(paths, stats):
+    """Return the digests of the files at paths, reading them in threads.
 
-    return exclude_files, exclude_dirs
+    Hashing releases the GIL, so the files are read concurrently.
+    """
+    with concurrent.futures.ThreadPoolExecutor() as executor:
+        digests = list(executor.map(_mapped_file_digest, paths))
+    for st, digest in zip(stats, digests):
+        if digest:
+            _digests[_digest_key(st)] = digest
+    return digests
 
 
-def _validate_relative_paths(files):
-    for d in files:
-        if os.path.isabs(d):
-            raise PluginError('path "{}" must be relative'.format(d))
+def _load_manifest(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (FileNotFoundError, NotADirectoryError, ValueError):
+        return {'files': {}, 'dirs': []}
+
+
+def _make_manifest(files, dirs, directory, previous, read=False):
+    """Return a manifest for files and dirs in directory.
+
+    Digests are carried over from the previous manifest, as long as the
+    file looks the same, or from the files already read. With read, the
+    other files are read too. Manifests can list hundreds of thousands of
+    files, they are saved as json which is a lot faster than yaml for that.
+    """
+    records = {}
+    to_read = {}
+    for f in files:
+        path = os.path.join(directory, f)
+        st = os.lstat(path)
+        if stat.S_ISLNK(st.st_mode):
+            records[f] = None
+            continue
+        record = [st.st_size, st.st_mtime_ns, None]
+        known = previous['files'].get(f)
+        if known and list(known[:2]) == record[:2]:
+            record[2] = known[2]
+        record[2] = record[2] or _digests.get(_digest_key(st))
+        if not record[2] and read:
+            to_read[f] = st
+        records[f] = record
+
+    if to_read:
+        for f, digest in zip(to_read, _read_digests(
+                [os.path.join(directory, f) for f in to_read],
+                to_read.values())):
+            records[f][2] = digest
+    return {'files': records, 'dirs': sorted(dirs)}
 
 
 def check_for_collisions(parts):
-    """Raises an EnvironmentError if conflicts are found between two parts."""
-    parts_files = {}
+    """Raises an EnvironmentError if conflicts are found between two parts.
+
+    Every conflict is reported at once. Files are only read when they have
+    the same size and are not the same inode, and then just once each.
+    Parts staged before and not changed since are not checked against
+    each other again, their files are taken from their stage manifest.
+    """
+    # Which parts have a file at each path, in order.
+    owners = {}
+    manifests = {}
+    candidates = []
     for part in parts:
-        # Gather our own files up
-        part_files, _ = part.migratable_fileset_for('stage')
-
-        # Scan previous parts for collisions
-        for other_part_name in parts_files:
-            common = part_files & parts_files[other_part_name]['files']
-            conflict_files = []
-            for f in common:
-                this = os.path.join(part.installdir, f)
-                other = os.path.join(
-                    parts_files[other_part_name]['installdir'],
-                    f)
-                if os.path.islink(this) and os.path.islink(other):
-                    continue
-                if not filecmp.cmp(this, other, shallow=False):
-                    conflict_files.append(f)
-
-            if conflict_files:
-                raise EnvironmentError(
-                    'Parts {!r} and {!r} have the following file paths in '
-                    'common which have different contents:\n{}'.format(
-                        other_part_name, part.name,
-                        '\n'.join(sorted(conflict_files))))
-
-        # And add our files to the list
-        parts_files[part.name] = {'files': part_files,
-                                  'installdir': part.installdir}
+        manifest = part.load_manifest('stage')['files']
+        changed = not manifest or part.should_step_run('stage')
+        if changed:
+            part_files, _ = part.migratable_fileset_for('stage')
+        else:
+            part_files = manifest.keys()
+        manifests[part.name] = manifest
+        for f in part_files:
+            others = owners.setdefault(f, [])
+            for other, other_changed in others:
+                if changed or other_changed:
+                    candidates.append((other, part, f))
+            others.append((part, changed))
+
+    stats = {}
+    to_hash = {}
+    possible = []
+    for other, part, f in candidates:
+        this = os.path.join(part.installdir, f)
+        that = os.path.join(other.installdir, f)
+        if os.path.islink(this) and os.path.islink(that):
+            continue
+        for path in (this, that):
+            if path not in stats:
+                with contextlib.suppress(OSError):
+                    stats[path] = os.stat(path)
+        this_stat, that_stat = stats.get(this), stats.get(that)
+        if this_stat and that_stat:
+            if os.path.samestat(this_stat, that_stat):
+                continue
+            if this_stat.st_size == that_stat.st_size:
+                to_hash[this] = (part, f)
+                to_hash[that] = (other, f)
+        possible.append((other, part, f, this, that))
+
+    digests = {}
+    for path, (part, f) in to_hash.items():
+        st = stats[path]
+        known = manifests[part.name].get(f)
+        if known and list(known[:2]) == [st.st_size, st.st_mtime_ns]:
+            digests[path] = known[2]
+        digests[path] = digests.get(path) or _digests.get(_digest_key(st))
+
+    to_read = [path for path in to_hash if not digests.get(path)]
+    digests.update(zip(to_read, _read_digests(
+        to_read, [stats[path] for path in to_read])))
+    _update_stage_manifests(manifests, to_hash, stats, digests)
+
+    conflicts = collections.OrderedDict()
+    for other, part, f, this, that in possible:
+        if digests.get(this) and digests[this] == digests.get(that):
+            continue
+        conflicts.setdefault((other.name, part.name), []).append(f)
+
+    if conflicts:
+        raise EnvironmentError('\n'.join(
+            'Parts {!r} and {!r} have the following file paths in '
+            'common which have different contents:\n{}'.format(
+                other_name, part_name, '\n'.join(sorted(conflict_files)))
+            for (other_name, part_name), conflict_files in conflicts.items()))
+
+
+def _update_stage_manifests(manifests, owners, stats, digests):
+    """Save the digests missing from the manifests of the parts."""
+    updated = {}
+    for path, (part, f) in owners.items():
+        record = manifests[part.name].get(f)
+        st = stats[path]
+        if record and not record[2] and digests.get(path) and \
+                list(record[:2]) == [st.st_size, st.st_mtime_ns]:
+            record[2] = digests[path]
+            updated[part.name] = part
+    for name, part in updated.items():
+        manifest = part.load_manifest('stage')
+        manifest['files'] = manifests[name]
+        part.save_manifest('stage', manifest)
+
+
+def link_duplicates(directory, parts=()):
+    """Hard link the files in directory which have the same contents.
+
+    Only files with the same size, mode and owner are compared, so the
+    links look the same as the files they replace. Digests are taken from
+    the strip manifests of parts when the files did not change since.
+    Returns the number of bytes no longer stored twice.
+    """
+    known = {}
+    for part in parts:
+        for f, record in part.load_manifest('strip')['files'].items():
+            if record and record[2]:
+                known[os.path.join(directory, f)] = record
+
+    # Paths of every inode, by what a link must keep the same.
+    groups = {}
+    for dirpath, _, filenames in os.walk(directory):
+        for filename in filenames:
+            path = os.path.join(dirpath, filename)
+            st = os.lstat(path)
+            if not stat.S_ISREG(st.st_mode) or not st.st_size:
+                continue
+            inodes = groups.setdefault(
+                (st.st_size, st.st_mode, st.st_uid, st.st_gid), {})
+            inodes.setdefault((st.st_dev, st.st_ino), (st, []))[1].append(
+                path)
+
+    digests = {}
+    to_read = []
+    for inodes in groups.values():
+        if len(inodes) < 2:
+            continue
+        for st, paths in inodes.values():
+            paths.sort()
+            record = known.get(paths[0])
+            if record and list(record[:2]) == [st.st_size, st.st_mtime_ns]:
+                digests[paths[0]] = _digests[_digest_key(st)] = record[2]
+            elif _digest_key(st) in _digests:
+                digests[paths[0]] = _digests[_digest_key(st)]
+            else:
+                to_read.append((paths[0], st))
+    digests.update(zip([path for path, _ in to_read], _read_digests(
+        [path for path, _ in to_read], [st for _, st in to_read])))
+
+    saved = 0
+    for inodes in groups.values():
+        if len(inodes) < 2:
+            continue
+        first = {}
+        for st, paths in sorted(inodes.values(), key=lambda i: i[1]):
+            digest = digests.get(paths[0])
+            if not digest:
+                continue
+            if digest not in first:
+                first[digest] = paths[0]
+                continue
+            for path in paths:
+                tmp = path + '.snapcraft-link'
+                os.link(first[digest], tmp)
+                os.rename(tmp, path)
+            saved += st.st_size
+    return saved
+
+
+def fingerprint_directory(directory, previous=None):
+    """Return a digest of everything in directory and of each of its files.
+
+    The digests of files are taken from the strip manifests of the parts,
+    or from the file digests previously returned, for files with the same
+    size and modification time as recorded there, so only the files that
+    changed since are read.
+    """
+    known = {}
+    for path in glob.glob(os.path.join(
+            common.get_partsdir(), '*', 'strip-manifest')):
+        known.update(_load_manifest(path)['files'])
+    known.update(previous or {})
+
+    entries = {}
+    files = {}
+    to_read = []
+    for dirpath, dirnames, filenames in os.walk(directory):
+        for name in dirnames + filenames:
+            path = os.path.join(dirpath, name)
+            f = os.path.relpath(path, directory)
+            st = os.lstat(path)
+            if stat.S_ISLNK(st.st_mode):
+                entries[f] = ['link', os.readlink(path)]
+            elif stat.S_ISDIR(st.st_mode):
+                entries[f] = ['dir', st.st_mode]
+            else:
+                entries[f] = ['file', st.st_mode]
+                record = [st.st_size, st.st_mtime_ns, None]
+                known_record = known.get(f)
+                if known_record and list(known_record[:2]) == record[:2]:
+                    record[2] = known_record[2]
+                record[2] = record[2] or _digests.get(_digest_key(st))
+                if not record[2]:
+                    to_read.append((f, st))
+                files[f] = record
+
+    for (f, _), digest in zip(to_read, _read_digests(
+            [os.path.join(directory, f) for f, _ in to_read],
+            [st for _, st in to_read])):
+        files[f][2] = digest
+    for f, record in files.items():
+        entries[f].append(record[2])
+
+    fingerprint = hashlib.sha256(
+        json.dumps(entries, sort_keys=True).encode()).hexdigest()
+    return fingerprint, files
+
+
+def _mapped_file_digest(path):
+    """Return the digest of the file at path, None if it cannot be read."""
+    sha = hashlib.sha256()
+    try:
+        with open(path, 'rb') as f:
+            if os.fstat(f.fileno()).st_size:
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+                    sha.update(m)
+    except (OSError, ValueError):
+        return None
+    return sha.hexdigest()
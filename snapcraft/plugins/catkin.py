@@ -78,6 +78,10 @@ deb http://${security}.ubuntu.com/${suffix} trusty-security main universe
 
         return schema
 
+    @classmethod
+    def pull_properties(cls):
+        return ['rosdistro', 'catkin-packages']
+
     def __init__(self, name, options):
         super().__init__(name, options)
 
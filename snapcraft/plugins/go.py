@@ -59,6 +59,10 @@ class GoPlugin(snapcraft.BasePlugin):
 
         return schema
 
+    @classmethod
+    def pull_properties(cls):
+        return ['go-packages']
+
     def __init__(self, name, options):
         super().__init__(name, options)
         self.build_packages.append('golang-go')
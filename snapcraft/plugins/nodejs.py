@@ -30,6 +30,7 @@ Additionally, this plugin uses the following plugin-specific keywords:
       A list of dependencies to fetch using npm.
 """
 
+import hashlib
 import logging
 import os
 import platform
@@ -72,8 +73,8 @@ class NodePlugin(snapcraft.BasePlugin):
 
     def __init__(self, name, options):
         super().__init__(name, options)
-        self._nodejs_tar = sources.Tar(_get_nodejs_release(),
-                                       os.path.join(self.partdir, 'npm'))
+        self._nodejs_tar = _NodejsRelease(_get_nodejs_release(),
+                                          os.path.join(self.partdir, 'npm'))
 
     def pull(self):
         super().pull()
@@ -89,13 +90,27 @@ class NodePlugin(snapcraft.BasePlugin):
             self.run(['npm', 'install', '-g'])
 
 
-def _get_nodejs_base():
+class _NodejsRelease(sources.Tar):
+    """A node.js release, which never changes once it is published."""
+
+    def _cache_key(self):
+        # The version is part of the url, which is then enough to only
+        # download the release once for every part using it.
+        return super()._cache_key() or \
+            hashlib.sha256(self.source.encode()).hexdigest()
+
+
+def _get_nodejs_arch():
     machine = platform.machine()
     if machine not in _NODEJS_ARCHES:
         raise EnvironmentError('architecture not supported ({})'.format(
             machine))
+    return _NODEJS_ARCHES[machine]
+
+
+def _get_nodejs_base():
     return _NODEJS_BASE.format(version=_NODEJS_VERSION,
-                               arch=_NODEJS_ARCHES[machine])
+                               arch=_get_nodejs_arch())
 
 
 def _get_nodejs_release():
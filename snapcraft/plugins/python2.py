@@ -63,6 +63,10 @@ class Python2Plugin(snapcraft.BasePlugin):
 
         return schema
 
+    @classmethod
+    def pull_properties(cls):
+        return ['requirements', 'python-packages']
+
     def __init__(self, name, options):
         super().__init__(name, options)
         self.stage_packages.extend([
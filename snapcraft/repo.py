@@ -14,23 +14,31 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import concurrent.futures
+import contextlib
 import glob
+import hashlib
 import itertools
 import logging
 import os
 import platform
 import string
 import shutil
-import stat
 import subprocess
+import tarfile
+import tempfile
 import urllib
 import urllib.request
 import sys
+import time
 
 import apt
 from xml.etree import ElementTree
 
-from snapcraft import common
+from snapcraft import (
+    cache,
+    common,
+)
 
 logger = logging.getLogger(__name__)
 
@@ -46,13 +54,26 @@ deb http://${security}.ubuntu.com/${suffix} ${release}-security universe
 deb http://${security}.ubuntu.com/${suffix} ${release}-security multiverse
 '''
 _GEOIP_SERVER = "http://geoip.ubuntu.com/lookup"
+_DEB_CACHE_SIZE = 4 * 1024 ** 3
+_APT_INDEX_TTL = 24 * 60 * 60
+_DPKG_STATUS = '/var/lib/dpkg/status'
 
 
 def install_build_packages(packages):
-    new_packages = []
+    unique_packages = []
     for pkg in packages:
+        if pkg not in unique_packages:
+            unique_packages.append(pkg)
+
+    # Avoid opening an apt cache when everything is already there.
+    if set(unique_packages).issubset(_get_installed_packages()):
+        return
+
+    apt_cache = apt.Cache()
+    new_packages = []
+    for pkg in unique_packages:
         try:
-            if not apt.Cache()[pkg].installed:
+            if not apt_cache[pkg].installed:
                 new_packages.append(pkg)
         except KeyError:
             logger.error('Could not find all the "build-packages" required '
@@ -67,6 +88,32 @@ def install_build_packages(packages):
                                '-y', 'install'] + new_packages)
 
 
+def _get_installed_packages():
+    """Return the names of the installed packages from the dpkg status.
+
+    Names are also returned qualified with their architecture.
+    """
+    installed = set()
+    try:
+        with open(_DPKG_STATUS) as f:
+            paragraphs = f.read().split('\n\n')
+    except FileNotFoundError:
+        return installed
+
+    for paragraph in paragraphs:
+        fields = {}
+        for line in paragraph.splitlines():
+            key, sep, value = line.partition(':')
+            if sep and not line[0].isspace():
+                fields[key] = value.strip()
+        if fields.get('Status', '').endswith(' installed'):
+            installed.add(fields['Package'])
+            installed.add('{}:{}'.format(
+                fields['Package'], fields.get('Architecture')))
+
+    return installed
+
+
 class PackageNotFoundError(Exception):
 
     @property
@@ -82,10 +129,14 @@ class UnpackError(Exception):
 
     @property
     def message(self):
-        return 'Error while provisioning "{}"'.format(self.package_name)
+        message = 'Error while provisioning "{}"'.format(self.package_name)
+        if self.reason:
+            message += ': {}'.format(self.reason)
+        return message
 
-    def __init__(self, package_name):
+    def __init__(self, package_name, reason=None):
         self.package_name = package_name
+        self.reason = reason
 
 
 class Ubuntu:
@@ -101,13 +152,44 @@ class Ubuntu:
             print('using local sources')
             sources = _get_local_sources_list()
             local = True
-        self.apt_cache, self.apt_progress = _setup_apt_cache(
-            rootdir, sources, local)
+        self._sources = sources
+        self._local = local
+        self._apt_cache = None
+        self._apt_locks = contextlib.ExitStack()
+        self.apt_progress = None
+
+    @property
+    def apt_cache(self):
+        # Only set up when needed, unpacking packages fetched ahead of
+        # time does not require it.
+        if not self._apt_cache:
+            self._apt_cache, self.apt_progress = _setup_apt_cache(
+                self.rootdir, self._sources, self._local, self._apt_locks)
+        return self._apt_cache
+
+    def close(self):
+        """Let other processes update the package index again."""
+        self._apt_cache = None
+        self._apt_locks.close()
 
     def get(self, package_names):
         os.makedirs(self.downloaddir, exist_ok=True)
+        try:
+            self._mark_install(package_names)
+            self._fetch_archives()
+        finally:
+            self.close()
+
+    def is_fetched(self, package_names):
+        """Return True if package_names were fetched by get_stage_packages."""
+        try:
+            with open(os.path.join(self.rootdir, 'fetched')) as f:
+                return f.read().split() == sorted(package_names)
+        except FileNotFoundError:
+            return False
 
-        manifest_dep_names = self._manifest_dep_names()
+    def _mark_install(self, package_names):
+        manifest_dep_names = _get_manifest_names()
 
         for name in package_names:
             try:
@@ -122,8 +204,9 @@ class Ubuntu:
         # note that this will break the consistency check inside apt_cache
         # (self.apt_cache.broken_count will be > 0)
         # but that is ok as it was consistent before we excluded
-        # these base package
-        for pkg in self.apt_cache:
+        # these base package. Only the packages marked for install need
+        # to be looked at, not the whole archive.
+        for pkg in self.apt_cache.get_changes():
             # those should be already on each system, it also prevents
             # diving into downloading libc6
             if (pkg.candidate.priority in 'essential' and
@@ -143,33 +226,132 @@ class Ubuntu:
             print('Skipping blacklisted from manifest packages:',
                   skipped_blacklisted)
 
+    def _fetch_archives(self):
+        deb_cache = _get_deb_cache()
+        archives = []
+        for pkg in self.apt_cache.get_changes():
+            key = _deb_cache_key(pkg)
+            path = os.path.join(self.downloaddir, _archive_filename(pkg))
+            if os.path.exists(path) or (key and deb_cache.link(key, path)):
+                # Already in place, there is no need to fetch it.
+                pkg.mark_keep()
+            if key:
+                archives.append((key, path))
+
         # download the remaining ones with proper progress
         apt.apt_pkg.config.set("Dir::Cache::Archives", self.downloaddir)
         self.apt_cache.fetch_archives(progress=self.apt_progress)
 
+        for key, path in archives:
+            if os.path.exists(path) and not deb_cache.get(key):
+                deb_cache.add(key, path)
+        deb_cache.prune()
+
     def unpack(self, rootdir):
         pkgs_abs_path = glob.glob(os.path.join(self.downloaddir, '*.deb'))
-        for pkg in pkgs_abs_path:
-            # TODO needs elegance and error control
-            try:
-                subprocess.check_call(['dpkg-deb', '--extract', pkg, rootdir])
-            except subprocess.CalledProcessError:
-                raise UnpackError(pkg)
-
-        _fix_contents(rootdir)
+        _unpack_debs(sorted(pkgs_abs_path), rootdir)
         _fix_xml_tools(rootdir)
 
-    def _manifest_dep_names(self):
-        manifest_dep_names = set()
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(os.path.join(self.rootdir, 'fetched'))
 
+
+_manifest_names = None
+
+
+def _get_manifest_names():
+    global _manifest_names
+    if _manifest_names is None:
         with open(os.path.abspath(os.path.join(__file__, '..',
                                                'manifest.txt'))) as f:
-            for line in f:
-                pkg = line.strip()
-                if pkg in self.apt_cache:
-                    manifest_dep_names.add(pkg)
+            _manifest_names = {line.strip() for line in f if line.strip()}
+
+    return _manifest_names
+
 
-        return manifest_dep_names
+def get_stage_packages(requests, sources=None):
+    """Resolve and fetch the packages for several parts at once.
+
+    All the packages are resolved together and their union is fetched
+    only once. Each part then gets the archives for its own packages and
+    their dependencies in its download directory, ready for unpack.
+
+    :param dict requests: The package names to get, keyed by the
+                          directory each part would create an Ubuntu
+                          instance for.
+    :param str sources: The sources.list the packages come from.
+    """
+    with tempfile.TemporaryDirectory() as tmpdir:
+        ubuntu = Ubuntu(tmpdir, sources=sources)
+        os.makedirs(ubuntu.downloaddir)
+        try:
+            ubuntu._mark_install(sorted(set().union(*requests.values())))
+            marked = {pkg.name: pkg
+                      for pkg in ubuntu.apt_cache.get_changes()}
+            ubuntu._fetch_archives()
+        finally:
+            ubuntu.close()
+
+        for rootdir, package_names in requests.items():
+            downloaddir = os.path.join(rootdir, 'download')
+            os.makedirs(downloaddir, exist_ok=True)
+            archives = {_archive_filename(pkg) for pkg in
+                        _dependency_closure(package_names, marked)}
+            for archive in os.listdir(downloaddir):
+                if archive.endswith('.deb') and archive not in archives:
+                    os.remove(os.path.join(downloaddir, archive))
+            for archive in archives:
+                path = os.path.join(downloaddir, archive)
+                if not os.path.exists(path):
+                    cache.link_or_copy(
+                        os.path.join(ubuntu.downloaddir, archive), path)
+
+            with open(os.path.join(rootdir, 'fetched'), 'w') as f:
+                f.write('\n'.join(sorted(package_names)))
+
+
+def _dependency_closure(package_names, marked):
+    """Return the packages in marked that package_names depend on."""
+    closure = {}
+    pending = list(package_names)
+    while pending:
+        pkg = marked.get(pending.pop())
+        if not pkg or pkg.name in closure:
+            continue
+        closure[pkg.name] = pkg
+        for dependency in pkg.candidate.dependencies:
+            # Follow the first alternative that was marked for install.
+            for target in itertools.chain.from_iterable(
+                    d.target_versions for d in dependency.or_dependencies):
+                if target.package.name in marked:
+                    pending.append(target.package.name)
+                    break
+
+    return closure.values()
+
+
+def _get_deb_cache():
+    max_size = int(os.environ.get('SNAPCRAFT_DEB_CACHE_SIZE', _DEB_CACHE_SIZE))
+    return cache.FileCache('debs', max_size)
+
+
+def _deb_cache_key(pkg):
+    if not pkg.candidate.sha256:
+        return None
+    return '{}_{}_{}_{}.deb'.format(
+        _quote(pkg.shortname), _quote(pkg.candidate.version),
+        _quote(pkg.candidate.architecture), pkg.candidate.sha256)
+
+
+def _archive_filename(pkg):
+    # The same name apt gives to the archives it downloads.
+    return '{}_{}_{}.deb'.format(
+        _quote(pkg.shortname), _quote(pkg.candidate.version),
+        _quote(pkg.candidate.architecture))
+
+
+def _quote(s):
+    return s.replace('_', '%5f').replace(':', '%3a')
 
 
 def _get_local_sources_list():
@@ -217,16 +399,46 @@ def _format_sources_list(sources, arch, release='vivid'):
     })
 
 
-def _setup_apt_cache(rootdir, sources, local=False):
-    os.makedirs(os.path.join(rootdir, 'etc', 'apt'), exist_ok=True)
-    srcfile = os.path.join(rootdir, 'etc', 'apt', 'sources.list')
+def _get_apt_index_ttl():
+    return int(os.environ.get('SNAPCRAFT_APT_INDEX_TTL', _APT_INDEX_TTL))
+
+
+def expire_apt_indexes():
+    """Have the shared package indexes updated the next time they are used.
+    """
+    for stampfile in glob.glob(os.path.join(
+            common.get_cachedir(), 'apt', '*', 'update-stamp')):
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(stampfile)
+
+
+def _apt_index_expired(stampfile):
+    try:
+        updated = os.path.getmtime(stampfile)
+    except FileNotFoundError:
+        return True
+    return time.time() - updated >= _get_apt_index_ttl()
+
+
+def _setup_apt_cache(rootdir, sources, local=False, locks=None):
+    """Return an apt cache for sources and its progress reporter.
+
+    The package index is updated if it expired. It is read under a shared
+    lock held until locks, an ExitStack, is closed, so that it is not
+    updated by other processes in the meantime.
+    """
+    os.makedirs(rootdir, exist_ok=True)
 
     if not local:
         series = platform.linux_distribution()[2]
         sources = _format_sources_list(sources, common.get_arch(), series)
 
-    with open(srcfile, 'w') as f:
-        f.write(sources)
+    # The package index is shared by every part using the same sources.
+    aptroot = os.path.join(common.get_cachedir(), 'apt',
+                           hashlib.sha256(sources.encode()).hexdigest())
+    os.makedirs(os.path.join(aptroot, 'etc', 'apt'), exist_ok=True)
+    srcfile = os.path.join(aptroot, 'etc', 'apt', 'sources.list')
+    stampfile = os.path.join(aptroot, 'update-stamp')
 
     # Do not install recommends
     apt.apt_pkg.config.set('Apt::Install-Recommends', 'False')
@@ -242,39 +454,166 @@ def _setup_apt_cache(rootdir, sources, local=False):
         progress.pulse = lambda owner: True
         progress._width = 0
 
-    apt_cache = apt.Cache(rootdir=rootdir, memonly=True)
-    apt_cache.update(fetch_progress=progress, sources_list=srcfile)
-    apt_cache.open()
-
-    return apt_cache, progress
-
-
-def _fix_contents(debdir):
-    '''
-    Sometimes debs will contain absolute symlinks (e.g. if the relative
-    path would go all the way to root, they just do absolute).  We can't
-    have that, so instead clean those absolute symlinks.
-
-    Some unpacked items will also contain suid binaries which we do not want in
-    the resulting snap.
-    '''
-    for root, dirs, files in os.walk(debdir):
-        # Symlinks to directories will be in dirs, while symlinks to
-        # non-directories will be in files.
-        for entry in itertools.chain(files, dirs):
-            path = os.path.join(root, entry)
-            if os.path.islink(path) and os.path.isabs(os.readlink(path)):
-                target = os.path.join(debdir, os.readlink(path)[1:])
-                if _skip_link(os.readlink(path)):
-                    logger.debug('Skipping {}'.format(target))
-                    continue
-                if not os.path.exists(target):
-                    if not _try_copy_local(path, target):
-                        continue
-                os.remove(path)
-                os.symlink(os.path.relpath(target, root), path)
-            elif os.path.exists(path):
-                _fix_filemode(path)
+    if _apt_index_expired(stampfile):
+        with cache.lock(aptroot):
+            # Another process may have updated it while waiting for the
+            # lock.
+            if _apt_index_expired(stampfile):
+                with open(srcfile, 'w') as f:
+                    f.write(sources)
+                apt.Cache(rootdir=aptroot).update(
+                    fetch_progress=progress, sources_list=srcfile)
+                open(stampfile, 'w').close()
+
+    if locks is None:
+        locks = contextlib.ExitStack()
+    locks.enter_context(cache.lock(aptroot, shared=True))
+    return apt.Cache(rootdir=aptroot), progress
+
+
+def _unpack_debs(debs, rootdir):
+    """Extract debs into rootdir concurrently.
+
+    The suid and sgid bits are dropped while extracting, absolute symlinks
+    are only fixed once every deb is extracted as their targets can come
+    from any of them.
+    """
+    absolute_links = []
+    with concurrent.futures.ProcessPoolExecutor() as pool:
+        futures = [pool.submit(_extract_deb, deb, rootdir) for deb in debs]
+        for future in futures:
+            absolute_links.extend(future.result())
+
+    for path in absolute_links:
+        # The same path can be shipped by more than one deb, not always as
+        # an absolute symlink.
+        if os.path.islink(path) and os.path.isabs(os.readlink(path)):
+            _fix_symlink(path, rootdir)
+
+
+class _ArMember:
+    """A read only file object for a member of an ar archive."""
+
+    def __init__(self, fileobj, size):
+        self._fileobj = fileobj
+        self._left = size
+
+    def read(self, size=-1):
+        if size < 0 or size > self._left:
+            size = self._left
+        data = self._fileobj.read(size)
+        self._left -= len(data)
+        return data
+
+
+def _open_deb_data(fileobj):
+    """Return the name and a file object for the data member of a deb."""
+    if fileobj.read(8) != b'!<arch>\n':
+        raise ValueError('not an ar archive')
+
+    while True:
+        header = fileobj.read(60)
+        if len(header) < 60:
+            raise ValueError('no data member')
+        name = header[0:16].decode().strip().rstrip('/')
+        size = int(header[48:58])
+        if name.startswith('data.tar'):
+            return name, _ArMember(fileobj, size)
+        # Members are aligned to an even offset.
+        fileobj.seek(size + size % 2, os.SEEK_CUR)
+
+
+def _extract_deb(deb, rootdir):
+    """Extract the contents of deb into rootdir.
+
+    Returns the list of absolute symlinks which were extracted.
+    """
+    try:
+        # Unbuffered so that zstd can read from the right offset.
+        with open(deb, 'rb', buffering=0) as f:
+            name, data = _open_deb_data(f)
+            if name.endswith('.zst'):
+                # tarfile does not know about zstd, stream it through
+                # the zstd tool instead.
+                with subprocess.Popen(['zstd', '-dcq'], stdin=f,
+                                      stdout=subprocess.PIPE) as proc:
+                    with tarfile.open(fileobj=proc.stdout, mode='r|') as tar:
+                        return _extract_members(tar, rootdir)
+            with tarfile.open(fileobj=data, mode='r|*') as tar:
+                return _extract_members(tar, rootdir)
+    except _MissingLinkTarget as e:
+        raise UnpackError(deb, str(e))
+    except (OSError, ValueError, tarfile.TarError) as e:
+        logger.debug('Failed to extract %s: %s', deb, e)
+        raise UnpackError(deb)
+
+
+class _MissingLinkTarget(ValueError):
+    pass
+
+
+def _extract_members(tar, rootdir):
+    absolute_links = []
+    for member in tar:
+        path = _member_path(rootdir, member.name)
+        if not path:
+            continue
+
+        if member.isdir():
+            os.makedirs(path, exist_ok=True)
+            os.chmod(path, member.mode & 0o1777 | 0o700)
+            continue
+
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        if os.path.isdir(path) and not os.path.islink(path):
+            logger.warning('Not replacing directory {}'.format(path))
+            continue
+
+        # Other debs extracted at the same time can ship the same path,
+        # each one is created aside and renamed over it.
+        tmp = '{}.snapcraft-{}'.format(path, os.getpid())
+        if member.issym():
+            os.symlink(member.linkname, tmp)
+            if os.path.isabs(member.linkname):
+                absolute_links.append(path)
+        elif member.islnk():
+            target = _member_path(rootdir, member.linkname)
+            if not target or not os.path.lexists(target):
+                raise _MissingLinkTarget(
+                    '{} is a hard link to {}, which was not extracted'.format(
+                        member.name, member.linkname))
+            os.link(target, tmp)
+        elif member.isfile():
+            with open(tmp, 'wb') as f:
+                shutil.copyfileobj(tar.extractfile(member), f)
+            if member.mode & 0o6000:
+                logger.warning('Removing suid/guid from {}'.format(path))
+            os.chmod(tmp, member.mode & 0o1777)
+            os.utime(tmp, (member.mtime, member.mtime))
+        else:
+            continue
+        os.replace(tmp, path)
+
+    return absolute_links
+
+
+def _member_path(rootdir, name):
+    name = os.path.normpath(name).lstrip('/')
+    if name in ('.', '..') or name.startswith('../'):
+        return None
+    return os.path.join(rootdir, name)
+
+
+def _fix_symlink(path, debdir):
+    target = os.path.join(debdir, os.readlink(path)[1:])
+    if _skip_link(os.readlink(path)):
+        logger.debug('Skipping {}'.format(target))
+        return
+    if not os.path.exists(target):
+        if not _try_copy_local(path, target):
+            return
+    os.remove(path)
+    os.symlink(os.path.relpath(target, os.path.dirname(path)), path)
 
 
 def _fix_xml_tools(root):
@@ -291,13 +630,6 @@ def _fix_xml_tools(root):
                 format(root), xslt_config_path])
 
 
-def _fix_filemode(path):
-    mode = stat.S_IMODE(os.stat(path, follow_symlinks=False).st_mode)
-    if mode & 0o4000 or mode & 0o2000:
-        logger.warning('Removing suid/guid from {}'.format(path))
-        os.chmod(path, mode & 0o1777)
-
-
 _skip_list = None
 
 
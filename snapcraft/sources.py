@@ -32,7 +32,7 @@ A part that uses common source options can have these keyword entries:
                    - mercurial
                    - hg
                    - git
-                   - tar
+                   - tar (also for zip files)
 
     - source-branch:
       (string)
@@ -44,25 +44,67 @@ A part that uses common source options can have these keyword entries:
     - source-subdir:
       (string)
       A source directory within a repository or tarfile to enter and build
-      from.
+      from. Only this directory is checked out from git sources, and only
+      this directory is extracted from tar sources.
+    - source-checksum:
+      (string)
+      The digest a tar source must have, as the name of a hashlib algorithm
+      and the hex digest separated by a slash, as in sha256/<digest>.
+      Tarballs downloaded with a checksum are kept in the snapcraft cache
+      and not downloaded again.
+    - source-depth:
+      (integer)
+      Only fetch the history needed for the branch or tag being built from.
+      For git this is the number of commits to fetch, bzr sources get a
+      lightweight checkout and mercurial sources are cloned up to the tag or
+      branch only.
+
+Remote bzr, git and mercurial sources are mirrored in the snapcraft cache
+when not fetched with a source-depth, so pulling them again only fetches
+what changed since.
+
+Tar sources are decompressed by pixz, pigz, pbzip2 or zstd, using every
+core, when installed, and by xz or Python otherwise. Zstandard compressed
+tarballs need zstd.
 """
 
 
+import contextlib
+import hashlib
 import logging
 import os
 import os.path
 import requests
 import shutil
+import stat
 import tarfile
 import re
 import subprocess
 import tempfile
+import threading
+import zipfile
 
 import snapcraft.common
+from snapcraft import cache
 
 
 logging.getLogger('urllib3').setLevel(logging.CRITICAL)
 
+_DOWNLOAD_CHUNK_SIZE = 1024 ** 2
+_TARBALL_CACHE_SIZE = 4 * 1024 ** 3
+# For the mirrors of each kind of VCS.
+_MIRROR_CACHE_SIZE = 4 * 1024 ** 3
+_MAGIC_SIZE = 6
+_ZSTD_MAGIC = b'\x28\xb5\x2f\xfd'
+# The commands decompressing stdin to stdout used for tar sources, those
+# using more than one thread first. Python decompresses the rest.
+_DECOMPRESSORS = (
+    (b'\xfd7zXZ\x00', (('pixz', '-d'), ('xz', '-d', '-c', '-T0'))),
+    (b'\x1f\x8b', (('pigz', '-d', '-c'),)),
+    (b'BZh', (('pbzip2', '-d', '-c'),)),
+    (_ZSTD_MAGIC, (('zstd', '-d', '-c', '-T0'),)),
+)
+
 
 class IncompatibleOptionsError(Exception):
 
@@ -73,75 +115,193 @@ class IncompatibleOptionsError(Exception):
 class Base:
 
     def __init__(self, source, source_dir, source_tag=None,
-                 source_branch=None):
+                 source_branch=None, source_depth=None, source_subdir=None,
+                 source_checksum=None):
         self.source = source
         self.source_dir = source_dir
         self.source_tag = source_tag
         self.source_branch = source_branch
+        self.source_depth = source_depth
+        self.source_subdir = source_subdir
+        self.source_checksum = source_checksum
+
+    def _use_mirror(self):
+        return not self.source_depth and not os.path.isdir(self.source)
+
+    @contextlib.contextmanager
+    def _mirror(self, vcs, clone_cmd, update_cmd):
+        """Bring the mirror of the source in the cache up to date.
+
+        clone_cmd and update_cmd take the path to the mirror and return the
+        command to create it and to update it from the source. The path to
+        the mirror is given, which is kept from other processes for as long
+        as the context lasts.
+        """
+        mirrors = _get_mirror_cache(vcs)
+        key = hashlib.sha1(self.source.encode()).hexdigest()
+        with mirrors.use(key) as mirror:
+            updated = False
+            if os.path.exists(mirror):
+                try:
+                    subprocess.check_call(update_cmd(mirror))
+                    updated = True
+                except subprocess.CalledProcessError:
+                    # A mirror left broken is made again.
+                    shutil.rmtree(mirror)
+            if not updated:
+                try:
+                    subprocess.check_call(clone_cmd(mirror))
+                except subprocess.CalledProcessError:
+                    shutil.rmtree(mirror, ignore_errors=True)
+                    raise
+            yield mirror
+        mirrors.prune()
 
 
 class Bazaar(Base):
 
     def __init__(self, source, source_dir, source_tag=None,
-                 source_branch=None):
-        super().__init__(source, source_dir, source_tag, source_branch)
+                 source_branch=None, source_depth=None, source_subdir=None,
+                 source_checksum=None):
+        super().__init__(source, source_dir, source_tag, source_branch,
+                         source_depth, source_subdir, source_checksum)
         if source_branch:
             raise IncompatibleOptionsError(
                 'can\'t specify a source-branch for a bzr source')
+        elif source_checksum:
+            raise IncompatibleOptionsError(
+                'can\'t specify a source-checksum for a bzr source')
 
     def pull(self):
         tag_opts = []
         if self.source_tag:
             tag_opts = ['-r', 'tag:' + self.source_tag]
-        if os.path.exists(os.path.join(self.source_dir, '.bzr')):
-            cmd = ['bzr', 'pull'] + tag_opts + \
-                  [self.source, '-d', self.source_dir]
-        else:
-            os.rmdir(self.source_dir)
-            cmd = ['bzr', 'branch'] + tag_opts + \
-                  [self.source, self.source_dir]
-
-        subprocess.check_call(cmd)
+        with contextlib.ExitStack() as stack:
+            if os.path.exists(os.path.join(self.source_dir, '.bzr')):
+                if self.source_depth:
+                    cmd = ['bzr', 'update'] + tag_opts + [self.source_dir]
+                else:
+                    cmd = ['bzr', 'pull'] + tag_opts + \
+                          [self.source, '-d', self.source_dir]
+            elif self.source_depth:
+                os.rmdir(self.source_dir)
+                cmd = ['bzr', 'checkout', '--lightweight'] + tag_opts + \
+                      [self.source, self.source_dir]
+            else:
+                os.rmdir(self.source_dir)
+                source = self.source
+                if self._use_mirror():
+                    source = stack.enter_context(self._mirror(
+                        'bzr', lambda m: ['bzr', 'branch', '--no-tree',
+                                          self.source, m],
+                        lambda m: ['bzr', 'pull', '--overwrite', '-d', m,
+                                   self.source]))
+                cmd = ['bzr', 'branch'] + tag_opts + \
+                      [source, self.source_dir]
+
+            subprocess.check_call(cmd)
 
 
 class Git(Base):
 
     def __init__(self, source, source_dir, source_tag=None,
-                 source_branch=None):
-        super().__init__(source, source_dir, source_tag, source_branch)
+                 source_branch=None, source_depth=None, source_subdir=None,
+                 source_checksum=None):
+        super().__init__(source, source_dir, source_tag, source_branch,
+                         source_depth, source_subdir, source_checksum)
         if source_tag and source_branch:
             raise IncompatibleOptionsError(
                 'can\'t specify both source-tag and source-branch for '
                 'a git source')
+        elif source_checksum:
+            raise IncompatibleOptionsError(
+                'can\'t specify a source-checksum for a git source')
 
     def pull(self):
+        sparse = False
+        depth_opts = []
+        if self.source_depth:
+            depth_opts = ['--depth', str(self.source_depth)]
         if os.path.exists(os.path.join(self.source_dir, '.git')):
             refspec = 'HEAD'
             if self.source_branch:
                 refspec = 'refs/heads/' + self.source_branch
             elif self.source_tag:
                 refspec = 'refs/tags/' + self.source_tag
-            cmd = ['git', '-C', self.source_dir, 'pull', self.source, refspec]
+            cmd = ['git', '-C', self.source_dir, 'pull'] + depth_opts + \
+                  [self.source, refspec]
         else:
             branch_opts = []
             if self.source_tag or self.source_branch:
                 branch_opts = ['--branch',
                                self.source_tag or self.source_branch]
+            if depth_opts:
+                branch_opts += depth_opts + ['--single-branch']
+            if self.source_subdir and \
+                    _get_git_version() >= _SPARSE_GIT_VERSION:
+                # Only the blobs of the subdir get fetched, when checked out.
+                branch_opts += ['--filter=blob:none', '--no-checkout']
+                sparse = True
+            elif self._use_mirror():
+                # Only the objects missing from the mirror are fetched, the
+                # clone does not depend on the mirror once done.
+                with self._mirror(
+                        'git', lambda m: ['git', 'clone', '--mirror',
+                                          self.source, m],
+                        lambda m: ['git', '-C', m, 'fetch', '--prune']) \
+                        as mirror:
+                    subprocess.check_call(
+                        ['git', 'clone'] + branch_opts +
+                        ['--reference', mirror, '--dissociate',
+                         self.source, self.source_dir])
+                return
             cmd = ['git', 'clone'] + branch_opts + \
                   [self.source, self.source_dir]
 
         subprocess.check_call(cmd)
+        if sparse:
+            if _get_git_version() >= _CONE_GIT_VERSION:
+                patterns = ['--cone', self.source_subdir]
+            else:
+                # Without cone mode a pattern matches at any depth unless
+                # anchored to the top.
+                patterns = ['/{}/'.format(self.source_subdir.strip('/'))]
+            subprocess.check_call(['git', '-C', self.source_dir,
+                                   'sparse-checkout', 'set'] + patterns)
+            subprocess.check_call(['git', '-C', self.source_dir, 'checkout'])
+
+
+# The first git with sparse-checkout, partial clones came before it.
+_SPARSE_GIT_VERSION = (2, 25)
+# The first git with sparse-checkout set --cone.
+_CONE_GIT_VERSION = (2, 35)
+_git_version = None
+
+
+def _get_git_version():
+    global _git_version
+    if _git_version is None:
+        output = subprocess.check_output(['git', '--version']).decode()
+        match = re.search(r'(\d+)\.(\d+)', output)
+        _git_version = tuple(int(v) for v in match.groups()) if match \
+            else (0, 0)
+    return _git_version
 
 
 class Mercurial(Base):
 
     def __init__(self, source, source_dir, source_tag=None,
-                 source_branch=None):
-        super().__init__(source, source_dir, source_tag, source_branch)
+                 source_branch=None, source_depth=None, source_subdir=None,
+                 source_checksum=None):
+        super().__init__(source, source_dir, source_tag, source_branch,
+                         source_depth, source_subdir, source_checksum)
         if source_tag and source_branch:
             raise IncompatibleOptionsError(
                 'can\'t specify both source-tag and source-branch for a '
                 'mercurial source')
+        elif source_checksum:
+            raise IncompatibleOptionsError(
+                'can\'t specify a source-checksum for a mercurial source')
 
     def pull(self):
         if os.path.exists(os.path.join(self.source_dir, '.hg')):
@@ -155,6 +315,18 @@ class Mercurial(Base):
             ref = []
             if self.source_tag or self.source_branch:
                 ref = ['-u', self.source_tag or self.source_branch]
+            if self.source_depth:
+                # Only the history of what is updated to is cloned.
+                rev = self.source_tag or self.source_branch or 'default'
+                ref = ['-r', rev, '-u', rev]
+            elif self._use_mirror():
+                with self._mirror(
+                        'hg', lambda m: ['hg', 'clone', '-U', self.source, m],
+                        lambda m: ['hg', 'pull', '-R', m, self.source]) \
+                        as mirror:
+                    subprocess.check_call(
+                        ['hg', 'clone'] + ref + [mirror, self.source_dir])
+                return
             cmd = ['hg', 'clone'] + ref + [self.source, self.source_dir]
 
         subprocess.check_call(cmd)
@@ -163,33 +335,139 @@ class Mercurial(Base):
 class Tar(Base):
 
     def __init__(self, source, source_dir, source_tag=None,
-                 source_branch=None):
-        super().__init__(source, source_dir, source_tag, source_branch)
+                 source_branch=None, source_depth=None, source_subdir=None,
+                 source_checksum=None):
+        super().__init__(source, source_dir, source_tag, source_branch,
+                         source_depth, source_subdir, source_checksum)
         if source_tag:
             raise IncompatibleOptionsError(
                 'can\'t specify a source-tag for a tar source')
         elif source_branch:
             raise IncompatibleOptionsError(
                 'can\'t specify a source-branch for a tar source')
+        elif source_depth:
+            raise IncompatibleOptionsError(
+                'can\'t specify a source-depth for a tar source')
+        if source_checksum:
+            algorithm, _, digest = source_checksum.partition('/')
+            if algorithm not in hashlib.algorithms_guaranteed or not digest:
+                raise IncompatibleOptionsError(
+                    'source-checksum must be an algorithm and a digest '
+                    'such as sha256/<digest>, not {!r}'.format(
+                        source_checksum))
 
     def pull(self):
-        if snapcraft.common.isurl(self.source):
-            self._download()
-        self.provision(self.source_dir)
+        if not snapcraft.common.isurl(self.source):
+            if self.source_checksum:
+                self._verify(self.source)
+            self.provision(self.source_dir)
+            return
 
-    def _download(self):
+        file = os.path.join(self.source_dir, os.path.basename(self.source))
+        tarball_cache = _get_tarball_cache()
+        key = self._cache_key()
+        if key:
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(file)
+            if tarball_cache.link(key, file):
+                self.provision(self.source_dir)
+                return
+
+        # Left behind by an interrupted download to be resumed.
+        partial = file + '.partial'
+        if os.path.exists(partial):
+            self._fetch(partial)
+            if self.source_checksum:
+                self._verify(partial)
+            os.rename(partial, file)
+            self.provision(self.source_dir)
+        elif not self._download_and_extract(partial):
+            os.rename(partial, file)
+            # It could not be read as a stream, no need to try again.
+            self.provision(self.source_dir, stream=False)
+        else:
+            os.rename(partial, file)
+
+        if key:
+            tarball_cache.add(key, file)
+            tarball_cache.prune()
+
+    def _download_and_extract(self, partial):
+        """Extract the tarball as it is downloaded, keeping it in partial.
+
+        The tarball is only read once, whatever its size. False is returned
+        if it could not be extracted that way, once it is fully downloaded.
+        """
         req = requests.get(self.source, stream=True, allow_redirects=True)
-        if req.status_code is not 200:
+        if req.status_code != 200:
+            raise EnvironmentError('unexpected http status code when '
+                                   'downloading {}'.format(req.status_code))
+        req.raw.decode_content = True
+
+        self._clean(self.source_dir, partial)
+        checksum = None
+        if self.source_checksum:
+            checksum = hashlib.new(self.source_checksum.partition('/')[0])
+        with open(partial, 'wb') as f:
+            reader = _TeeReader(req.raw, f, checksum)
+            extracted = self._extract_stream(reader, self.source_dir)
+            # Whatever is after the end of the archive is kept too.
+            while reader.read(_DOWNLOAD_CHUNK_SIZE):
+                pass
+
+        if checksum:
+            try:
+                self._check_digest(partial, checksum.hexdigest())
+            except EnvironmentError:
+                self._clean(self.source_dir, partial)
+                raise
+        return extracted
+
+    def _fetch(self, partial):
+        headers = {}
+        with contextlib.suppress(FileNotFoundError):
+            headers['Range'] = 'bytes={}-'.format(os.path.getsize(partial))
+        req = requests.get(self.source, stream=True, allow_redirects=True,
+                           headers=headers)
+        if req.status_code == 416 and headers:
+            # The partial download is as big as the whole file or bigger,
+            # it cannot be resumed.
+            os.remove(partial)
+            return self._fetch(partial)
+        if req.status_code not in (200, 206):
             raise EnvironmentError('unexpected http status code when '
                                    'downloading {}'.format(req.status_code))
 
-        file = os.path.join(self.source_dir, os.path.basename(self.source))
-        with open(file, 'wb') as f:
-            for chunk in req.iter_content(1024):
+        # Servers that do not support ranges send the whole file again.
+        with open(partial, 'ab' if req.status_code == 206 else 'wb') as f:
+            for chunk in req.iter_content(_DOWNLOAD_CHUNK_SIZE):
                 f.write(chunk)
 
-    def provision(self, dst, clean_target=True):
-        # TODO add unit tests.
+    def _cache_key(self):
+        if not self.source_checksum:
+            return None
+        algorithm, _, digest = self.source_checksum.partition('/')
+        return '{}_{}-{}'.format(
+            hashlib.sha256(self.source.encode()).hexdigest(), algorithm,
+            digest.lower())
+
+    def _verify(self, path):
+        checksum = hashlib.new(self.source_checksum.partition('/')[0])
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(_DOWNLOAD_CHUNK_SIZE), b''):
+                checksum.update(chunk)
+        self._check_digest(path, checksum.hexdigest())
+
+    def _check_digest(self, path, hexdigest):
+        algorithm, _, digest = self.source_checksum.partition('/')
+        if hexdigest != digest.lower():
+            if path != self.source:
+                os.remove(path)
+            raise EnvironmentError(
+                'the {} digest of {} is {}, expected {}'.format(
+                    algorithm, self.source, hexdigest, digest))
+
+    def provision(self, dst, clean_target=True, stream=True):
         if snapcraft.common.isurl(self.source):
             tarball = os.path.join(
                 self.source_dir,
@@ -198,47 +476,321 @@ class Tar(Base):
             tarball = os.path.abspath(self.source)
 
         if clean_target:
-            tmp_tarball = tempfile.NamedTemporaryFile().name
-            shutil.move(tarball, tmp_tarball)
-            shutil.rmtree(dst)
-            os.makedirs(dst)
-            shutil.move(tmp_tarball, tarball)
-
-        self._extract(tarball, dst)
-
-    def _extract(self, tarball, dst):
-        with tarfile.open(tarball) as tar:
-            def filter_members(tar):
-                """Filters members and member names:
-                    - strips common prefix
-                    - bans dangerous names"""
-                members = tar.getmembers()
-                common = os.path.commonprefix([m.name for m in members])
-
-                # commonprefix() works a character at a time and will
-                # consider "d/ab" and "d/abc" to have common prefix "d/ab";
-                # check all members either start with common dir
-                for m in members:
-                    if not (m.name.startswith(common + '/') or
-                            m.isdir() and m.name == common):
-                        # commonprefix() didn't return a dir name; go up one
-                        # level
-                        common = os.path.dirname(common)
-                        break
-
-                for m in members:
-                    if m.name == common:
-                        continue
-                    if m.name.startswith(common + '/'):
-                        m.name = m.name[len(common + '/'):]
-                    # strip leading '/', './' or '../' as many times as needed
-                    m.name = re.sub(r'^(\.{0,2}/)*', r'', m.name)
-                    # We mask all files to be writable to be able to easily
-                    # extract on top.
-                    m.mode = m.mode | 0o200
-                    yield m
-
-            tar.extractall(members=filter_members(tar), path=dst)
+            self._clean(dst, tarball)
+
+        self._extract(tarball, dst, stream)
+
+    def _clean(self, dst, keep):
+        """Remove everything in dst but keep."""
+        os.makedirs(dst, exist_ok=True)
+        for name in os.listdir(dst):
+            path = os.path.join(dst, name)
+            if os.path.abspath(path) == os.path.abspath(keep):
+                continue
+            if os.path.isdir(path) and not os.path.islink(path):
+                shutil.rmtree(path)
+            else:
+                os.remove(path)
+
+    def _extract(self, tarball, dst, stream=True):
+        if zipfile.is_zipfile(tarball):
+            self._extract_zip(tarball, dst)
+            return
+        if stream:
+            with open(tarball, 'rb') as f:
+                if self._extract_stream(f, dst):
+                    return
+        self._extract_with_index(tarball, dst)
+
+    def _extract_stream(self, fileobj, dst):
+        """Extract the tarball read from fileobj in a single pass.
+
+        The common top directory of the members is stripped as they come,
+        assuming that of the first one until a member outside of it shows
+        up, when what was extracted so far is moved down to where it
+        belongs. With a source_subdir that is not possible, what was
+        extracted is removed and False returned for the tarball to be
+        extracted with all of its members known beforehand, as it is for
+        tarballs that cannot be read as a stream or have links that cannot
+        be made from it.
+        """
+        # The names extracted in dst, relative to the common directory.
+        created = set()
+        try:
+            with _decompressed(fileobj) as stream, \
+                    tarfile.open(fileobj=stream, mode='r|*',
+                                 errorlevel=2) as tar:
+                return self._extract_members(tar, dst, created)
+        except (tarfile.TarError, KeyError, OSError):
+            # Such as a truncated tarball or, as a KeyError, a hard link to
+            # a member that is gone from the stream.
+            _remove_all(dst, created)
+            return False
+
+    def _extract_with_index(self, tarball, dst):
+        """Extract the tarball once the common directory is known.
+
+        The tarball is read twice, first only for the names of its members.
+        """
+        prefix = None
+        with open(tarball, 'rb') as f, _decompressed(f) as stream, \
+                tarfile.open(fileobj=stream, mode='r|*') as tar:
+            for m in tar:
+                parts = _member_parts(m.name)
+                if parts is not None:
+                    parent = parts if m.isdir() else parts[:-1]
+                    prefix = parent if prefix is None else \
+                        os.path.commonprefix([prefix, parent])
+                tar.members = []
+
+        with open(tarball, 'rb') as f, _decompressed(f) as stream, \
+                tarfile.open(fileobj=stream, mode='r|*',
+                             errorlevel=2) as tar:
+            if self._extract_members(tar, dst, set(), prefix):
+                return
+
+        # Links to what is not extracted are made from the members they
+        # point to, which only a tarball that can be seeked can give.
+        with tarfile.open(tarball, errorlevel=2) as tar:
+            self._extract_members(tar, dst, set(), prefix, stream=False)
+
+    def _extract_members(self, tar, dst, created, prefix=None, stream=True):
+        subdir = self._subdir()
+        for m in tar:
+            parts = _member_parts(m.name)
+            if parts is None:
+                continue
+            parent = parts if m.isdir() else parts[:-1]
+            if prefix is None:
+                prefix = parent
+            common = len(os.path.commonprefix([prefix, parent]))
+            if common < len(prefix):
+                if subdir:
+                    _remove_all(dst, created)
+                    return False
+                moved = _move_down(dst, created, prefix[common:])
+                created.clear()
+                created.update(moved)
+                prefix = prefix[:common]
+
+            name = '/'.join(parts[len(prefix):])
+            # Renamed even when left out, links are looked up by name.
+            m.name = name
+            if not _in_subdir(name, subdir):
+                continue
+            if m.islnk():
+                link_parts = _member_parts(m.linkname) or []
+                if link_parts[:len(prefix)] == prefix:
+                    m.linkname = '/'.join(link_parts[len(prefix):])
+            if m.issym() or m.islnk():
+                # tarfile falls back to extracting what the link points to
+                # when it cannot be made, reading the rest of a stream to
+                # find it and skipping the members in there.
+                _remove_all(dst, [name])
+                if stream and m.islnk() and not os.path.lexists(
+                        os.path.join(dst, m.linkname)):
+                    _remove_all(dst, created)
+                    return False
+            # We mask all files to be writable to be able to easily
+            # extract on top.
+            m.mode = m.mode | 0o200
+            created.add(parts[len(prefix)])
+            tar.extract(m, dst)
+            if stream:
+                # Only the current member is needed in a stream.
+                tar.members = []
+        return True
+
+    def _extract_zip(self, path, dst):
+        subdir = self._subdir()
+        with zipfile.ZipFile(path) as zf:
+            members = []
+            prefix = None
+            for info in zf.infolist():
+                parts = _member_parts(info.filename)
+                if parts is None:
+                    continue
+                isdir = info.filename.endswith('/')
+                parent = parts if isdir else parts[:-1]
+                prefix = parent if prefix is None else \
+                    os.path.commonprefix([prefix, parent])
+                members.append((parts, isdir, info))
+
+            for parts, isdir, info in members:
+                name = '/'.join(parts[len(prefix):])
+                if not _in_subdir(name, subdir):
+                    continue
+                target = os.path.join(dst, name)
+                if isdir:
+                    os.makedirs(target, exist_ok=True)
+                    continue
+                os.makedirs(os.path.dirname(target), exist_ok=True)
+                # The file type and permissions of files zipped on unix.
+                mode = info.external_attr >> 16
+                if stat.S_ISLNK(mode):
+                    os.symlink(zf.read(info).decode(), target)
+                    continue
+                with zf.open(info) as src, open(target, 'wb') as f:
+                    shutil.copyfileobj(src, f, _DOWNLOAD_CHUNK_SIZE)
+                if stat.S_IMODE(mode):
+                    os.chmod(target, stat.S_IMODE(mode) | 0o200)
+
+    def _subdir(self):
+        if self.source_subdir:
+            return os.path.normpath(self.source_subdir).strip('/')
+        return None
+
+
+class _PrefixedReader:
+    """Read head and then the rest of a file."""
+
+    def __init__(self, head, fileobj):
+        self.head = head
+        self.fileobj = fileobj
+
+    def read(self, size=-1):
+        head, self.head = self.head, b''
+        if size < 0:
+            return head + self.fileobj.read()
+        if len(head) > size:
+            self.head = head[size:]
+            return head[:size]
+        return head + self.fileobj.read(size - len(head))
+
+
+@contextlib.contextmanager
+def _decompressed(fileobj):
+    """Decompress fileobj with a parallel decompressor if there is one.
+
+    Without one the file is left for tarfile to decompress.
+    """
+    head = fileobj.read(_MAGIC_SIZE)
+    fileobj = _PrefixedReader(head, fileobj)
+    command = _find_decompressor(head)
+    if not command:
+        yield fileobj
+        return
+
+    proc = subprocess.Popen(command, stdin=subprocess.PIPE,
+                            stdout=subprocess.PIPE,
+                            stderr=subprocess.DEVNULL)
+    errors = []
+    feeder = threading.Thread(target=_feed,
+                              args=(fileobj, proc.stdin, errors))
+    feeder.start()
+    try:
+        yield proc.stdout
+        # Whatever is after the end of the archive is decompressed too.
+        while proc.stdout.read(_DOWNLOAD_CHUNK_SIZE):
+            pass
+    finally:
+        proc.stdout.close()
+        feeder.join()
+        proc.wait()
+    if errors:
+        raise errors[0]
+    if proc.returncode:
+        raise tarfile.ReadError('{} could not decompress the tarball'.format(
+            command[0]))
+
+
+def _find_decompressor(head):
+    for magic, commands in _DECOMPRESSORS:
+        if not head.startswith(magic):
+            continue
+        for command in commands:
+            if shutil.which(command[0]):
+                return list(command)
+        if magic == _ZSTD_MAGIC:
+            raise EnvironmentError(
+                'zstd is needed to extract zstd compressed tarballs')
+    return None
+
+
+def _feed(fileobj, pipe, errors):
+    try:
+        for chunk in iter(lambda: fileobj.read(_DOWNLOAD_CHUNK_SIZE), b''):
+            pipe.write(chunk)
+    except BrokenPipeError:
+        # The decompressor stopped, the error is in its exit status.
+        pass
+    except Exception as e:
+        errors.append(e)
+    finally:
+        with contextlib.suppress(BrokenPipeError):
+            pipe.close()
+
+
+class _TeeReader:
+    """Write what is read from a file to another and to a checksum."""
+
+    def __init__(self, fileobj, copy, checksum=None):
+        self.fileobj = fileobj
+        self.copy = copy
+        self.checksum = checksum
+
+    def read(self, size=-1):
+        data = self.fileobj.read(size)
+        self.copy.write(data)
+        if self.checksum:
+            self.checksum.update(data)
+        return data
+
+
+def _member_parts(name):
+    """Return the components of a member name, None for unsafe names.
+
+    Leading '/', './' and '../' are stripped as many times as needed.
+    """
+    name = re.sub(r'^(\.{0,2}/)*', r'', name)
+    parts = [p for p in name.split('/') if p and p != '.']
+    if '..' in parts:
+        return None
+    return parts
+
+
+def _in_subdir(name, subdir):
+    if not name:
+        return False
+    return not subdir or name == subdir or name.startswith(subdir + '/')
+
+
+def _remove_all(dst, names):
+    for name in names:
+        path = os.path.join(dst, name)
+        if os.path.isdir(path) and not os.path.islink(path):
+            shutil.rmtree(path)
+        else:
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(path)
+
+
+def _move_down(dst, names, parts):
+    """Move names in dst into the directory made of parts in dst.
+
+    Return the names of what is now in dst.
+    """
+    tmpdir = tempfile.mkdtemp(dir=dst)
+    for name in names:
+        os.rename(os.path.join(dst, name), os.path.join(tmpdir, name))
+    target = os.path.join(dst, *parts)
+    os.makedirs(target, exist_ok=True)
+    for name in names:
+        os.rename(os.path.join(tmpdir, name), os.path.join(target, name))
+    os.rmdir(tmpdir)
+    return {parts[0]}
+
+
+def _get_mirror_cache(vcs):
+    max_size = int(os.environ.get('SNAPCRAFT_MIRROR_CACHE_SIZE',
+                                  _MIRROR_CACHE_SIZE))
+    return cache.DirectoryCache(vcs, max_size)
+
+
+def _get_tarball_cache():
+    max_size = int(os.environ.get('SNAPCRAFT_TARBALL_CACHE_SIZE',
+                                  _TARBALL_CACHE_SIZE))
+    return cache.FileCache('tarballs', max_size)
 
 
 class Local(Base):
@@ -264,10 +816,14 @@ def get(sourcedir, builddir, options):
     source_type = getattr(options, 'source_type', None)
     source_tag = getattr(options, 'source_tag', None)
     source_branch = getattr(options, 'source_branch', None)
+    source_depth = getattr(options, 'source_depth', None)
+    source_subdir = getattr(options, 'source_subdir', None)
+    source_checksum = getattr(options, 'source_checksum', None)
 
     handler_class = _get_source_handler(source_type, options.source)
     handler = handler_class(options.source, sourcedir, source_tag,
-                            source_branch)
+                            source_branch, source_depth, source_subdir,
+                            source_checksum)
     handler.pull()
 
 
@@ -287,7 +843,7 @@ def _get_source_handler(source_type, source):
     return _source_handler.get(source_type, Local)
 
 
-_tar_type_regex = re.compile(r'.*\.((tar\.(xz|gz|bz2))|tgz)$')
+_tar_type_regex = re.compile(r'.*\.((tar\.(xz|gz|bz2|zst))|tgz|zip)$')
 
 
 def _get_source_type_from_uri(source):
@@ -217,3 +217,15 @@ class BuildTestCase(tests.TestCase):
         for file_ in common.SNAPCRAFT_FILES:
             self.assertFalse(
                 os.path.exists(os.path.join(plugin.builddir, file_)))
+
+    def test_build_ignores_snaps_in_source_dir(self):
+        plugin = snapcraft.BasePlugin('test-part', options=None)
+        plugin.sourcedir = 'src'
+        plugin.builddir = 'build'
+        os.makedirs('src')
+        for file_ in ('proj_1_amd64.snap', 'file'):
+            open(os.path.join('src', file_), 'w').close()
+
+        plugin.build()
+
+        self.assertEqual(os.listdir('build'), ['file'])
@@ -0,0 +1,109 @@
+# -*- Mode:Python; indent-tabs-mode:nil; tab-width:4 -*-
+#
+# Copyright (C) 2016 Canonical Ltd
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 3 as
+# published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import threading
+
+from snapcraft import (
+    cache,
+    tests,
+)
+
+
+class FileCacheTestCase(tests.TestCase):
+
+    def make_file(self, name, content='content'):
+        with open(name, 'w') as f:
+            f.write(content)
+        return name
+
+    def test_cache_is_in_xdg_cache_home(self):
+        file_cache = cache.FileCache('test', 100)
+
+        self.assertEqual(
+            file_cache.cachedir,
+            os.path.join(os.environ['XDG_CACHE_HOME'], 'snapcraft', 'test'))
+
+    def test_get_missing_entry(self):
+        file_cache = cache.FileCache('test', 100)
+
+        self.assertEqual(file_cache.get('key'), None)
+        self.assertFalse(file_cache.link('key', 'dst'))
+        self.assertFalse(os.path.exists('dst'))
+
+    def test_add_and_link(self):
+        file_cache = cache.FileCache('test', 100)
+        file_cache.add('key', self.make_file('src'))
+
+        self.assertTrue(file_cache.link('key', 'dst'))
+
+        with open('dst') as f:
+            self.assertEqual(f.read(), 'content')
+        self.assertEqual(os.stat('src').st_ino, os.stat('dst').st_ino)
+
+    def test_prune_removes_least_recently_used(self):
+        file_cache = cache.FileCache('test', 20)
+        for i, key in enumerate(['a', 'b', 'c']):
+            file_cache.add(key, self.make_file(key, '0123456789'))
+            os.utime(os.path.join(file_cache.cachedir, key), (i, i))
+        # Using an entry makes it the most recently used one.
+        file_cache.get('a')
+
+        file_cache.prune()
+
+        self.assertTrue(file_cache.get('a'))
+        self.assertEqual(file_cache.get('b'), None)
+        self.assertTrue(file_cache.get('c'))
+
+
+class DirectoryCacheTestCase(tests.TestCase):
+
+    def make_entry(self, directory_cache, key, mtime):
+        with directory_cache.use(key) as path:
+            os.mkdir(path)
+            with open(os.path.join(path, 'file'), 'w') as f:
+                f.write('0123456789')
+        os.utime(path, (mtime, mtime))
+
+    def test_unrelated_entries_are_used_concurrently(self):
+        directory_cache = cache.DirectoryCache('test', 100)
+        used = []
+
+        def use_b():
+            with directory_cache.use('b') as path:
+                used.append(path)
+
+        with directory_cache.use('a'):
+            thread = threading.Thread(target=use_b)
+            thread.start()
+            thread.join(5)
+            self.assertFalse(thread.is_alive())
+
+        self.assertEqual(
+            used, [os.path.join(directory_cache.cachedir, 'b')])
+
+    def test_prune_leaves_entries_in_use(self):
+        directory_cache = cache.DirectoryCache('test', 20)
+        for i, key in enumerate(['a', 'b', 'c']):
+            self.make_entry(directory_cache, key, i)
+
+        with directory_cache.use('a'):
+            directory_cache.prune()
+
+        self.assertEqual(
+            sorted(n for n in os.listdir(directory_cache.cachedir)
+                   if not n.endswith('.lock')),
+            ['a', 'c'])
@@ -17,6 +17,7 @@
 import logging
 import os
 import os.path
+from unittest import mock
 
 import fixtures
 
@@ -118,3 +119,13 @@ parts:
                              'Pulled wrong part')
             self.assertFalse(os.path.exists(parts[i]['state_file']),
                              'Expected for only to be a state file for build1')
+
+    @mock.patch('snapcraft.repo.expire_apt_indexes')
+    def test_build_refreshing_the_apt_index(self, mock_expire):
+        fake_logger = fixtures.FakeLogger(level=logging.ERROR)
+        self.useFixture(fake_logger)
+        self.make_snapcraft_yaml()
+
+        build.main(['--refresh-apt-index'])
+
+        mock_expire.assert_called_once_with()
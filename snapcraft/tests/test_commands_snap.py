@@ -23,9 +23,18 @@ import fixtures
 
 from snapcraft import (
     common,
+    lifecycle,
+    pluginhandler,
     tests,
 )
-from snapcraft.commands import snap
+from snapcraft.commands import (
+    clean,
+    snap,
+)
+
+
+def _fake_mksquashfs(cmd, **kwargs):
+    open(cmd[2], 'w').close()
 
 
 class SnapCommandTestCase(tests.TestCase):
@@ -46,7 +55,7 @@ parts:
         super().make_snapcraft_yaml(self.yaml_template)
         self.state_file = os.path.join(common.get_partsdir(), 'part1', 'state')
 
-    @mock.patch('subprocess.check_call')
+    @mock.patch('subprocess.check_call', side_effect=_fake_mksquashfs)
     def test_snap_defaults(self, mock_call):
         fake_logger = fixtures.FakeLogger(level=logging.INFO)
         self.useFixture(fake_logger)
@@ -79,7 +88,18 @@ parts:
             'mksquashfs', common.get_snapdir(), 'snap-test_1.0_amd64.snap',
             '-noappend', '-comp', 'xz'])
 
-    @mock.patch('subprocess.check_call')
+    @mock.patch('snapcraft.repo.expire_apt_indexes')
+    @mock.patch('subprocess.check_call', side_effect=_fake_mksquashfs)
+    def test_snap_refreshing_the_apt_index(self, mock_call, mock_expire):
+        fake_logger = fixtures.FakeLogger(level=logging.ERROR)
+        self.useFixture(fake_logger)
+        self.make_snapcraft_yaml()
+
+        snap.main(['--refresh-apt-index'])
+
+        mock_expire.assert_called_once_with()
+
+    @mock.patch('subprocess.check_call', side_effect=_fake_mksquashfs)
     def test_snap_defaults_with_parts_in_strip(self, mock_call):
         fake_logger = fixtures.FakeLogger(level=logging.INFO)
         self.useFixture(fake_logger)
@@ -127,3 +147,177 @@ architectures: [amd64, armhf]
         mock_call.assert_called_once_with([
             'mksquashfs', os.path.abspath('mysnap'), 'my_snap_99_multi.snap',
             '-noappend', '-comp', 'xz'])
+
+    @mock.patch('subprocess.check_call', side_effect=_fake_mksquashfs)
+    def test_snap_with_compression_options(self, mock_call):
+        self.make_snapcraft_yaml()
+
+        snap.main(['--compression=zstd', '--compression-level=3',
+                   '--block-size=1M', '--processors=2'])
+
+        mock_call.assert_called_once_with([
+            'mksquashfs', common.get_snapdir(), 'snap-test_1.0_amd64.snap',
+            '-noappend', '-comp', 'zstd', '-Xcompression-level', '3',
+            '-b', '1M', '-processors', '2'])
+
+    @mock.patch('subprocess.check_call', side_effect=_fake_mksquashfs)
+    def test_snap_with_compression_from_yaml(self, mock_call):
+        self.yaml_template += """
+compression:
+    algorithm: gzip
+    level: 9
+"""
+        self.make_snapcraft_yaml()
+
+        snap.main(['--compression-level=1'])
+
+        mock_call.assert_called_once_with([
+            'mksquashfs', common.get_snapdir(), 'snap-test_1.0_amd64.snap',
+            '-noappend', '-comp', 'gzip', '-Xcompression-level', '1'])
+
+    @mock.patch('snapcraft.lifecycle.execute')
+    def test_snap_with_level_for_xz_fails(self, mock_execute):
+        self.make_snapcraft_yaml()
+
+        with self.assertRaises(ValueError) as raised:
+            snap.main(['--compression-level=9'])
+
+        self.assertEqual(str(raised.exception),
+                         "A compression level cannot be set for 'xz'")
+        self.assertFalse(mock_execute.called)
+
+    @mock.patch('snapcraft.lifecycle.execute')
+    def test_snap_with_invalid_compression_fails_before_building(
+            self, mock_execute):
+        self.make_snapcraft_yaml()
+
+        for args, message in (
+                (['--compression=bzip2'],
+                 "The compression must be one of gzip, lzo, lz4, xz, zstd, "
+                 "not 'bzip2'"),
+                (['--compression=gzip', '--compression-level=high'],
+                 "The compression level must be a positive integer, "
+                 "not 'high'"),
+                (['--processors=0'],
+                 "The compression processors must be a positive integer, "
+                 "not '0'"),
+                (['--block-size=1G'],
+                 'The block size must be a number of bytes, optionally '
+                 "followed by K or M, not '1G'")):
+            with self.subTest(args=args):
+                with self.assertRaises(ValueError) as raised:
+                    snap.main(args)
+                self.assertEqual(str(raised.exception), message)
+
+        self.assertFalse(mock_execute.called)
+
+    @mock.patch('snapcraft.lifecycle.execute')
+    def test_snap_with_level_for_xz_in_yaml_fails_before_building(
+            self, mock_execute):
+        self.yaml_template += """
+compression:
+    level: 9
+"""
+        self.make_snapcraft_yaml()
+
+        with self.assertRaises(ValueError):
+            snap.main()
+
+        self.assertFalse(mock_execute.called)
+
+    @mock.patch('subprocess.Popen')
+    def test_available_compressors(self, mock_popen):
+        mock_popen.return_value.communicate.return_value = (
+            b'SYNTAX:mksquashfs source1 source2 ...  dest [options]\n'
+            b'\t-comp <comp>\t\tselect <comp> compression\n'
+            b'Compressors available and compressor specific options:\n'
+            b'\tgzip (default)\n'
+            b'\t  -Xcompression-level <compression-level>\n'
+            b'\tlz4\n'
+            b'\t  -Xhc\n', None)
+
+        self.assertEqual(snap._available_compressors(), ['gzip', 'lz4'])
+
+    @mock.patch('snapcraft.commands.snap._available_compressors',
+                return_value=['gzip', 'lz4'])
+    @mock.patch('subprocess.check_call')
+    def test_benchmark_compression(self, mock_call, mock_compressors):
+        fake_logger = fixtures.FakeLogger(level=logging.INFO)
+        self.useFixture(fake_logger)
+        self.make_snapcraft_yaml()
+
+        # The benchmark snaps are not created by the mocked mksquashfs.
+        with mock.patch('os.path.getsize', return_value=42):
+            snap.main(['--benchmark-compression', '--compression-level=9'])
+
+        self.assertEqual(
+            [c[0][0][3:] for c in mock_call.call_args_list],
+            [['-noappend', '-comp', 'gzip', '-Xcompression-level', '9'],
+             ['-noappend', '-comp', 'lz4']])
+        self.assertIn('gzip', fake_logger.output)
+        self.assertNotIn('Snapping', fake_logger.output)
+
+    @mock.patch('subprocess.check_call', side_effect=_fake_mksquashfs)
+    def test_unchanged_snap_is_not_squashed_again(self, mock_call):
+        fake_logger = fixtures.FakeLogger(level=logging.INFO)
+        self.useFixture(fake_logger)
+        self.make_snapcraft_yaml()
+        snap.main()
+
+        snap.main()
+
+        self.assertEqual(mock_call.call_count, 1)
+        self.assertIn('Skipping snap snap-test_1.0_amd64.snap '
+                      '(already snapped)', fake_logger.output)
+
+    @mock.patch('subprocess.check_call', side_effect=_fake_mksquashfs)
+    def test_changed_snap_is_squashed_again(self, mock_call):
+        self.make_snapcraft_yaml()
+        snap.main()
+
+        with open(os.path.join(common.get_snapdir(), 'new'), 'w') as f:
+            f.write('new')
+        snap.main()
+        snap.main(['--compression=lz4'])
+        os.remove('snap-test_1.0_amd64.snap')
+        snap.main(['--compression=lz4'])
+
+        self.assertEqual(mock_call.call_count, 4)
+
+    @mock.patch('subprocess.check_call', side_effect=_fake_mksquashfs)
+    def test_clean_after_snap_leaves_nothing_behind(self, mock_call):
+        self.make_snapcraft_yaml()
+        snap.main()
+
+        clean.main()
+
+        self.assertEqual(sorted(os.listdir()),
+                         ['snap-test_1.0_amd64.snap', 'snapcraft.yaml'])
+
+    @mock.patch('subprocess.check_call', side_effect=_fake_mksquashfs)
+    def test_snap_takes_the_digests_from_the_strip_manifests(
+            self, mock_call):
+        self.make_snapcraft_yaml()
+        installdir = os.path.join(common.get_partsdir(), 'part1', 'install')
+        os.makedirs(os.path.join(installdir, 'bin'))
+        with open(os.path.join(installdir, 'bin', 'app'), 'w') as f:
+            f.write('app')
+        lifecycle.execute('strip')
+        # As if snapping in another run.
+        pluginhandler._digests.clear()
+
+        with mock.patch('snapcraft.pluginhandler._mapped_file_digest',
+                        wraps=pluginhandler._mapped_file_digest) as \
+                mock_digest:
+            snap.main()
+
+        # Only the files written in meta after stripping are read.
+        read = [c[0][0] for c in mock_digest.call_args_list]
+        self.assertTrue(read)
+        for path in read:
+            self.assertEqual(
+                os.path.relpath(path, common.get_snapdir()).split('/')[0],
+                'meta')
+        mock_call.assert_called_once_with([
+            'mksquashfs', common.get_snapdir(), 'snap-test_1.0_amd64.snap',
+            '-noappend', '-comp', 'xz'])
@@ -17,6 +17,7 @@
 import logging
 import os
 import os.path
+from unittest import mock
 
 import fixtures
 
@@ -176,3 +177,13 @@ parts:
             'Skipping stage strip0  (already ran)\n'
             'Skipping strip strip0  (already ran)\n',
             fake_logger.output)
+
+    @mock.patch('snapcraft.repo.expire_apt_indexes')
+    def test_strip_refreshing_the_apt_index(self, mock_expire):
+        fake_logger = fixtures.FakeLogger(level=logging.ERROR)
+        self.useFixture(fake_logger)
+        self.make_snapcraft_yaml()
+
+        strip.main(['--refresh-apt-index'])
+
+        mock_expire.assert_called_once_with()
@@ -15,6 +15,9 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import os
+import unittest.mock
+
+import fixtures
 
 from snapcraft import (
     common,
@@ -47,3 +50,50 @@ class CommonTestCase(tests.TestCase):
         self.assertFalse(common.isurl('./'))
         self.assertFalse(common.isurl('/foo'))
         self.assertFalse(common.isurl('/fo:o'))
+
+
+class RunTestCase(tests.TestCase):
+
+    def test_run_output_with_env(self):
+        common.env = ['FOO="$HOME/foo:$FOO"', 'BAR=${FOO}bar']
+        self.useFixture(fixtures.EnvironmentVariable('HOME', '/home'))
+        self.useFixture(fixtures.EnvironmentVariable('FOO', '/foo'))
+
+        self.assertEqual(
+            common.run_output(['sh', '-c', 'echo "$FOO $BAR"']),
+            '/home/foo:/foo /home/foo:/foobar')
+
+    def test_run_output_keeps_arguments(self):
+        self.assertEqual(
+            common.run_output(['echo', 'a  b', '$HOME', '*']),
+            'a  b $HOME *')
+
+    @unittest.mock.patch('subprocess.check_output')
+    def test_env_is_evaluated_once_without_a_shell(self, mock_output):
+        common.env = ['PATH="/stage/bin:$PATH"', 'FOO=bar']
+
+        common.run_output(['true'])
+        common.run_output(['true'], cwd='/')
+
+        self.assertEqual(mock_output.call_count, 2)
+        for args, kwargs in mock_output.call_args_list:
+            self.assertEqual(args, (['true'],))
+        env = mock_output.call_args[1]['env']
+        self.assertEqual(env['PATH'], '/stage/bin:' + os.environ['PATH'])
+        self.assertEqual(env['FOO'], 'bar')
+        self.assertTrue(
+            env is mock_output.call_args_list[0][1]['env'])
+
+    def test_env_needing_a_shell(self):
+        common.env = [
+            'FOO=foo',
+            'echo ignored\nBAR=$(echo $FOO)bar',
+            'BAZ="${BAR:-unset}"',
+        ]
+
+        env = common._get_run_env({'PATH': os.environ['PATH']})
+
+        self.assertEqual(env['FOO'], 'foo')
+        # Only exported variables make it to the commands.
+        self.assertFalse('BAR' in env)
+        self.assertEqual(env['BAZ'], 'foobar')
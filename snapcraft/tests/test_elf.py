@@ -0,0 +1,181 @@
+# -*- Mode:Python; indent-tabs-mode:nil; tab-width:4 -*-
+#
+# Copyright (C) 2016 Canonical Ltd
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 3 as
+# published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import shutil
+import subprocess
+import unittest
+
+import fixtures
+
+from snapcraft import (
+    elf,
+    tests,
+)
+
+
+@unittest.skipUnless(
+    all(shutil.which(t) for t in ('gcc', 'strip', 'objcopy')),
+    'needs gcc and binutils')
+class ElfTestCase(tests.TestCase):
+
+    def setUp(self):
+        super().setUp()
+        os.makedirs('root/bin')
+        with open('hello.c', 'w') as f:
+            f.write('int main(void) { return 0; }\n')
+        subprocess.check_call(['gcc', '-g', '-o', 'root/bin/hello', 'hello.c'])
+        with open('root/README', 'w') as f:
+            f.write('not a binary')
+
+    def test_is_elf(self):
+        self.assertTrue(elf.is_elf('root/bin/hello'))
+        self.assertFalse(elf.is_elf('root/README'))
+        self.assertFalse(elf.is_elf('root/missing'))
+
+    def test_find_elf_files(self):
+        os.symlink('hello', 'root/bin/hello-link')
+
+        self.assertEqual(
+            elf.find_elf_files(
+                'root', ['bin/hello', 'bin/hello-link', 'README']),
+            ['bin/hello'])
+
+    def test_strip_files(self):
+        size = os.path.getsize('root/bin/hello')
+
+        self.assertEqual(elf.strip_files('root', ['bin/hello']), ['bin/hello'])
+        self.assertLess(os.path.getsize('root/bin/hello'), size)
+        self.assertTrue(os.access('root/bin/hello', os.X_OK))
+        self.assertEqual(os.listdir('root/bin'), ['hello'])
+
+    def test_strip_files_keeps_hardlinks_of_stripped_files(self):
+        elf.strip_files('root', ['bin/hello'])
+        os.link('root/bin/hello', 'stripped')
+
+        self.assertEqual(elf.strip_files('root', ['bin/hello']), [])
+        self.assertTrue(os.path.samefile('root/bin/hello', 'stripped'))
+
+    def test_strip_files_breaks_hardlinks_of_changed_files(self):
+        os.link('root/bin/hello', 'unstripped')
+
+        elf.strip_files('root', ['bin/hello'])
+
+        self.assertFalse(os.path.samefile('root/bin/hello', 'unstripped'))
+
+    def test_strip_files_with_debugdir(self):
+        elf.strip_files('root', ['bin/hello'], 'debug')
+
+        self.assertTrue(os.path.exists('debug/bin/hello.debug'))
+        sections = subprocess.check_output(
+            ['objdump', '-h', 'root/bin/hello']).decode()
+        self.assertIn('.gnu_debuglink', sections)
+        self.assertNotIn('.debug_info', sections)
+
+    def test_strip_files_failure_is_not_fatal(self):
+        fake_logger = fixtures.FakeLogger()
+        self.useFixture(fake_logger)
+        with open('root/bin/broken', 'wb') as f:
+            f.write(b'\x7fELF\x02\x01\x01' + b'\0' * 9 + b'\x02\0')
+
+        self.assertEqual(elf.strip_files('root', ['bin/broken']), [])
+        self.assertEqual(sorted(os.listdir('root/bin')), ['broken', 'hello'])
+        self.assertIn('Could not strip root/bin/broken', fake_logger.output)
+
+
+@unittest.skipUnless(shutil.which('gcc'), 'needs gcc')
+class LibrariesTestCase(tests.TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.root = os.path.abspath('root')
+        self.libdir = os.path.join(self.root, 'usr', 'lib')
+        os.makedirs(self.libdir)
+        os.makedirs(os.path.join(self.root, 'bin'))
+        self.build_library('baz')
+        self.build_library('foo', 'baz')
+        self.build_library('unused')
+
+    def build_library(self, name, *needed):
+        with open(name + '.c', 'w') as f:
+            f.write('int {}(void) {{ return 0; }}\n'.format(name))
+        soname = 'lib{}.so.1'.format(name)
+        subprocess.check_call(
+            ['gcc', '-shared', '-fPIC', '-Wl,-soname,' + soname, '-o',
+             os.path.join(self.libdir, soname), name + '.c',
+             '-L' + self.libdir, '-Wl,--no-as-needed'] +
+            ['-l:lib{}.so.1'.format(n) for n in needed])
+        os.symlink(soname, os.path.join(self.libdir, 'lib{}.so'.format(name)))
+
+    def build_binary(self, path, *args):
+        with open('app.c', 'w') as f:
+            f.write('int main(void) { return 0; }\n')
+        subprocess.check_call(
+            ['gcc', '-o', os.path.join(self.root, path), 'app.c',
+             '-L' + self.libdir, '-Wl,-rpath-link,' + self.libdir,
+             '-Wl,--no-as-needed'] + list(args))
+
+    def test_read_dynamic(self):
+        self.build_binary('bin/app', '-lfoo', '-Wl,-rpath,$ORIGIN/../lib')
+
+        needed, search_path = elf.read_dynamic(
+            os.path.join(self.root, 'bin', 'app'))
+
+        self.assertIn('libfoo.so.1', needed)
+        self.assertEqual(search_path, ['$ORIGIN/../lib'])
+
+    def test_unused_libraries(self):
+        self.build_binary('bin/app', '-lfoo')
+
+        self.assertEqual(
+            elf.find_unused_libraries(self.root, [self.libdir]),
+            ['usr/lib/libunused.so', 'usr/lib/libunused.so.1'])
+
+    def test_libraries_found_through_rpath(self):
+        os.makedirs(os.path.join(self.root, 'opt'))
+        self.build_binary('opt/app', '-lfoo',
+                          '-Wl,-rpath,$ORIGIN/../usr/lib')
+
+        self.assertEqual(
+            elf.find_unused_libraries(self.root, []), [])
+        self.assertEqual(
+            elf.find_unused_libraries(self.root, [self.libdir]),
+            ['usr/lib/libunused.so', 'usr/lib/libunused.so.1'])
+
+    def test_libraries_outside_library_paths_are_used(self):
+        self.build_binary('bin/app')
+        os.makedirs(os.path.join(self.root, 'usr', 'lib', 'plugins'))
+        os.rename(os.path.join(self.libdir, 'libunused.so.1'),
+                  os.path.join(self.libdir, 'plugins', 'libunused.so.1'))
+        os.remove(os.path.join(self.libdir, 'libunused.so'))
+
+        self.assertEqual(
+            elf.find_unused_libraries(self.root, [self.libdir]),
+            ['usr/lib/libbaz.so', 'usr/lib/libbaz.so.1',
+             'usr/lib/libfoo.so', 'usr/lib/libfoo.so.1'])
+
+    def test_absolute_symlinks_stay_in_root(self):
+        self.build_binary('bin/app', '-lfoo')
+        os.remove(os.path.join(self.libdir, 'libfoo.so.1'))
+        os.rename(os.path.join(self.libdir, 'libunused.so.1'),
+                  os.path.join(self.libdir, 'libfoo.so.1.0'))
+        os.symlink('/usr/lib/libfoo.so.1.0',
+                   os.path.join(self.libdir, 'libfoo.so.1'))
+
+        # libfoo.so.1.0 is the former libunused.so.1, needing nothing.
+        self.assertEqual(
+            elf.find_unused_libraries(self.root, [self.libdir]),
+            ['usr/lib/libbaz.so', 'usr/lib/libbaz.so.1'])
@@ -14,10 +14,17 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import concurrent.futures
 import logging
+import os
+from unittest.mock import (
+    Mock,
+    patch,
+)
 
 import fixtures
 
+import snapcraft.yaml
 from snapcraft import (
     lifecycle,
     tests,
@@ -83,3 +90,181 @@ parts:
             'Staging part1 \n'
             'Pulling part2 \n',
             fake_logger.output)
+
+
+class LibrariesTestCase(tests.TestCase):
+
+    yaml = """name: libraries
+version: 0
+vendor: To Be Removed <vendor@example.com>
+summary: test strip
+description: unused libraries are reported or removed
+icon: icon.png
+{}
+parts:
+  part1:
+    plugin: nil
+  part2:
+    plugin: nil
+"""
+
+    def setUp(self):
+        super().setUp()
+        patcher = patch('snapcraft.elf.find_unused_libraries')
+        self.find_unused = patcher.start()
+        self.find_unused.return_value = ['usr/lib/libunused.so.1']
+        self.addCleanup(patcher.stop)
+
+    def make_snapcraft_yaml(self, extra=''):
+        super().make_snapcraft_yaml(self.yaml.format(extra))
+        open('icon.png', 'w').close()
+        os.makedirs(os.path.join('snap', 'usr', 'lib'))
+        self.library = os.path.join('snap', 'usr', 'lib', 'libunused.so.1')
+        open(self.library, 'w').close()
+
+    def test_unused_libraries_are_reported(self):
+        fake_logger = fixtures.FakeLogger(level=logging.INFO)
+        self.useFixture(fake_logger)
+        self.make_snapcraft_yaml()
+
+        lifecycle.execute('strip')
+
+        self.assertIn('usr/lib/libunused.so.1', fake_logger.output)
+        self.assertTrue(os.path.exists(self.library))
+        snapdir = os.path.join(os.getcwd(), 'snap')
+        self.find_unused.assert_called_once_with(
+            snapdir, snapcraft.yaml.load_config().snap_library_paths())
+
+    def test_unused_libraries_are_pruned(self):
+        self.make_snapcraft_yaml('prune-libraries: true\n')
+
+        lifecycle.execute('strip')
+
+        self.assertFalse(os.path.exists(self.library))
+
+    def test_libraries_are_not_checked_for_some_parts(self):
+        self.make_snapcraft_yaml('prune-libraries: true\n')
+
+        lifecycle.execute('strip', part_names=['part1'])
+
+        self.assertFalse(self.find_unused.called)
+
+    def test_libraries_are_not_checked_again_when_strip_is_clean(self):
+        self.make_snapcraft_yaml()
+        lifecycle.execute('strip')
+        self.find_unused.reset_mock()
+
+        lifecycle.execute('strip')
+
+        self.assertFalse(self.find_unused.called)
+
+    def test_libraries_are_checked_when_strip_runs_in_parallel(self):
+        self.make_snapcraft_yaml()
+
+        lifecycle.execute('strip', jobs=2)
+
+        self.assertTrue(self.find_unused.called)
+
+
+class ParallelExecutionTestCase(tests.TestCase):
+
+    yaml = """name: after
+version: 0
+vendor: To Be Removed <vendor@example.com>
+summary: test stage
+description: if the build is succesful the state file will be updated
+icon: icon.png
+
+parts:
+  part1:
+    plugin: nil
+  part2:
+    plugin: nil
+  part3:
+    plugin: nil
+    after:
+      - part1
+      - part2
+"""
+
+    def setUp(self):
+        super().setUp()
+        self.make_snapcraft_yaml(self.yaml)
+        open('icon.png', 'w').close()
+
+    def get_state(self, part_name):
+        with open(os.path.join('parts', part_name, 'state')) as f:
+            return f.read()
+
+    def test_prerequisites_are_staged(self):
+        lifecycle.execute('pull', jobs=2)
+
+        self.assertEqual(self.get_state('part1'), 'stage')
+        self.assertEqual(self.get_state('part2'), 'stage')
+        self.assertEqual(self.get_state('part3'), 'pull')
+
+    def test_exception_when_dependency_is_required(self):
+        with self.assertRaises(RuntimeError) as raised:
+            lifecycle.execute('build', part_names=['part3'], jobs=2)
+
+        self.assertEqual(
+            raised.exception.__str__(),
+            "Requested 'build' of 'part3' but there are unsatisfied "
+            "prerequisites: 'part1 part2'")
+
+    def test_levels_follow_prerequisites(self):
+        config = snapcraft.yaml.load_config()
+        executor = lifecycle._ParallelExecutor(config, 2)
+
+        levels = executor._levels(
+            {'part1': 'build', 'part2': 'stage', 'part3': 'build'})
+
+        self.assertEqual(
+            [sorted(p.name for p in level) for level in levels],
+            [['part1', 'part2'], ['part3']])
+
+    def test_worker_errors_are_raised(self):
+        config = snapcraft.yaml.load_config()
+        executor = lifecycle._ParallelExecutor(config, 2)
+        for part in config.all_parts:
+            part.code.pull = Mock(side_effect=OSError('no network'))
+
+        lifecycle._worker_config = config
+        with concurrent.futures.ProcessPoolExecutor(2) as pool:
+            with self.assertRaises(RuntimeError) as raised:
+                executor._run_concurrently(
+                    pool, 'pull', config.all_parts[0:1])
+
+        self.assertEqual(
+            raised.exception.__str__(),
+            "Failed to pull {!r}: no network".format(
+                config.all_parts[0].name))
+
+    def test_pipeline_runs_every_part_to_the_step(self):
+        lifecycle.execute('build', jobs=2, pipeline=True)
+
+        self.assertEqual(self.get_state('part1'), 'stage')
+        self.assertEqual(self.get_state('part2'), 'stage')
+        self.assertEqual(self.get_state('part3'), 'build')
+
+    def test_pipeline_stages_prerequisites_before_pulling(self):
+        config = snapcraft.yaml.load_config()
+        executor = lifecycle._ParallelExecutor(config, 1, pipeline=True)
+        steps = []
+        executor._run_step_here = lambda step, part: steps.append(
+            (part.name, step))
+
+        class Pool:
+            def submit(self, fn, step, part_name):
+                future = concurrent.futures.Future()
+                future.set_result(steps.append((part_name, step)))
+                return future
+
+        executor._run_pipelined(
+            Pool(), {'part1': 'stage', 'part2': 'stage', 'part3': 'build'})
+
+        for prereq in ('part1', 'part2'):
+            self.assertLess(steps.index((prereq, 'stage')),
+                            steps.index(('part3', 'pull')))
+        self.assertEqual(steps[-1], ('part3', 'build'))
+        self.assertEqual(len(steps), 8)
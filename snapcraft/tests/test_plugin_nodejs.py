@@ -14,7 +14,9 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import io
 import os
+import tarfile
 
 from os import path
 from unittest import mock
@@ -32,7 +34,7 @@ class NodePluginTestCase(tests.TestCase):
         self.run_mock = patcher.start()
         self.addCleanup(patcher.stop)
 
-        patcher = mock.patch('snapcraft.sources.Tar')
+        patcher = mock.patch('snapcraft.plugins.nodejs._NodejsRelease')
         self.tar_mock = patcher.start()
         self.addCleanup(patcher.stop)
 
@@ -126,6 +128,9 @@ class NodePluginTestCase(tests.TestCase):
                                    'uniqueItems': True},
                  'source': {'type': 'string'},
                  'source-branch': {'default': '', 'type': 'string'},
+                 'source-checksum': {'default': '', 'type': 'string'},
+                 'source-depth': {'default': 0, 'minimum': 0,
+                                  'type': 'integer'},
                  'source-subdir': {'default': None, 'type': 'string'},
                  'source-tag': {'default': '', 'type:': 'string'},
                  'source-type': {'default': '', 'type': 'string'}},
@@ -136,3 +141,35 @@ class NodePluginTestCase(tests.TestCase):
         schema_mock.return_value = {'properties': {}}
 
         self.assertTrue('required' not in nodejs.NodePlugin.schema())
+
+
+class NodejsReleaseTestCase(tests.TestCase):
+
+    @mock.patch('platform.machine', return_value='x86_64')
+    @mock.patch('requests.get')
+    def test_release_is_downloaded_once_for_all_parts(self, mock_get,
+                                                      mock_machine):
+        data = io.BytesIO()
+        with tarfile.open(fileobj=data, mode='w:gz') as tar:
+            for name in ('bin/node', 'README.md'):
+                info = tarfile.TarInfo('node-v4.2.2-linux-x64/' + name)
+                tar.addfile(info, io.BytesIO())
+
+        def get(*args, **kwargs):
+            response = mock.Mock(status_code=200)
+            response.raw = io.BytesIO(data.getvalue())
+            return response
+        mock_get.side_effect = get
+
+        class Options:
+            source = None
+            node_packages = []
+
+        for name in ('part1', 'part2'):
+            plugin = nodejs.NodePlugin(name, Options())
+            plugin.pull()
+            self.assertTrue(os.path.exists(
+                os.path.join(plugin.partdir, 'npm', 'bin', 'node')))
+
+        mock_get.assert_called_once_with(
+            nodejs._get_nodejs_release(), stream=True, allow_redirects=True)
@@ -14,10 +14,17 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import hashlib
 import logging
 import os
+import shutil
+import subprocess
+import tarfile
 import tempfile
+import time
+import unittest
 from unittest.mock import (
+    ANY,
     Mock,
     patch,
 )
@@ -26,6 +33,7 @@ import fixtures
 
 from snapcraft import (
     common,
+    elf,
     pluginhandler,
     tests,
 )
@@ -222,6 +230,117 @@ class PluginTestCase(tests.TestCase):
             'path "/abs/exclude" must be relative', str(raised.exception))
 
 
+class FilesetMatcherTestCase(tests.TestCase):
+
+    scenarios = [
+        ('all', {
+            'fileset': ['*'],
+            'files': ['bin/app', 'broken', 'lib/.hidden', 'lib/libfoo.so',
+                      'lib/sub/libbar.so', 'lib64', 'lib64/.hidden',
+                      'lib64/libfoo.so', 'lib64/sub/libbar.so'],
+            'dirs': ['bin', 'lib', 'lib/sub', 'lib64/sub'],
+        }),
+        ('symlinked dir', {
+            'fileset': ['lib64'],
+            'files': ['lib64', 'lib64/.hidden', 'lib64/libfoo.so',
+                      'lib64/sub/libbar.so'],
+            'dirs': ['lib64/sub'],
+        }),
+        ('through symlinks', {
+            'fileset': ['*/*.so'],
+            'files': ['lib/libfoo.so', 'lib64/libfoo.so'],
+            'dirs': [],
+        }),
+        ('exclude symlinked dir', {
+            'fileset': ['*', '-lib64'],
+            'files': ['bin/app', 'broken', 'lib/.hidden', 'lib/libfoo.so',
+                      'lib/sub/libbar.so'],
+            'dirs': ['bin', 'lib', 'lib/sub'],
+        }),
+        ('exclude hidden', {
+            'fileset': ['*', '-*/.*'],
+            'files': ['bin/app', 'broken', 'lib/libfoo.so',
+                      'lib/sub/libbar.so', 'lib64', 'lib64/libfoo.so',
+                      'lib64/sub/libbar.so'],
+            'dirs': ['bin', 'lib', 'lib/sub', 'lib64/sub'],
+        }),
+        ('include hidden', {
+            'fileset': ['.*', 'lib/', '-lib/sub'],
+            'files': ['.config/file', 'lib/.hidden', 'lib/libfoo.so'],
+            'dirs': ['.config', 'lib'],
+        }),
+        ('missing', {
+            'fileset': ['missing', 'lib/missing', '-lib'],
+            'files': ['missing'],
+            'dirs': [],
+        }),
+        ('only star is globbed in includes', {
+            'fileset': ['lib?'],
+            'files': ['lib?'],
+            'dirs': [],
+        }),
+    ]
+
+    def test_migratable_filesets(self):
+        self.assert_migratable_filesets()
+
+    @patch('os.scandir', None)
+    def test_migratable_filesets_without_scandir(self):
+        self.assert_migratable_filesets()
+
+    def assert_migratable_filesets(self):
+        os.makedirs('install/bin')
+        os.makedirs('install/lib/sub')
+        os.makedirs('install/.config')
+        for f in ('bin/app', 'lib/libfoo.so', 'lib/.hidden',
+                  'lib/sub/libbar.so', '.config/file'):
+            open(os.path.join('install', f), 'w').close()
+        os.symlink('lib', 'install/lib64')
+        os.symlink('/nonexistent', 'install/broken')
+
+        files, dirs = pluginhandler._migratable_filesets(
+            self.fileset, 'install')
+
+        self.assertEqual(sorted(files), self.files)
+        self.assertEqual(sorted(dirs), self.dirs)
+
+
+@unittest.skipUnless(os.environ.get('SNAPCRAFT_BENCHMARK'),
+                     'SNAPCRAFT_BENCHMARK is not set')
+class FilesetMatcherBenchmark(tests.TestCase):
+
+    def make_tree(self, size):
+        for i in range(size):
+            libdir = os.path.join(
+                'install', 'usr', 'lib', str(i // 1000), str(i // 100 % 10))
+            if i % 100 == 0:
+                os.makedirs(libdir)
+            open(os.path.join(libdir, 'lib{}.so'.format(i)), 'w').close()
+
+    def test_matching_scales_linearly(self):
+        filesets = [
+            ['*'],
+            ['*', '-usr/lib/1', '-usr/lib/*/2', '-*/*/*/*/*.a'],
+            ['usr/lib/*/*/lib1*.so'],
+        ]
+        timings = {}
+        for size in (10 ** 4, 10 ** 5, 10 ** 6):
+            shutil.rmtree('install', ignore_errors=True)
+            self.make_tree(size)
+            for fileset in filesets:
+                start = time.time()
+                pluginhandler._migratable_filesets(fileset, 'install')
+                timings[size, str(fileset)] = time.time() - start
+
+        # The time per file must not grow with the number of files, with
+        # some room for the noise of small runs.
+        for fileset in filesets:
+            with self.subTest(fileset=fileset):
+                small = timings[10 ** 4, str(fileset)] / 10 ** 4
+                large = timings[10 ** 6, str(fileset)] / 10 ** 6
+                self.assertLess(large, small * 3, timings)
+
+
 class PluginMakedirsTestCase(tests.TestCase):
 
     scenarios = [
@@ -334,3 +453,498 @@ class CollisionTestCase(tests.TestCase):
             raised.exception.__str__(),
             "Parts 'part2' and 'part3' have the following file paths in "
             "common which have different contents:\n1\na/2")
+
+    def test_all_collisions_are_reported(self):
+        part4 = pluginhandler.load_plugin('part4', 'nil')
+        part4.code.installdir = os.path.join(self.path, 'install4')
+        os.makedirs(part4.installdir)
+        with open(os.path.join(part4.installdir, '2'), 'w') as f:
+            f.write('2')
+
+        with self.assertRaises(EnvironmentError) as raised:
+            pluginhandler.check_for_collisions(
+                [self.part2, self.part3, part4])
+
+        self.assertEqual(
+            str(raised.exception),
+            "Parts 'part2' and 'part3' have the following file paths in "
+            "common which have different contents:\n1\na/2\n"
+            "Parts 'part2' and 'part4' have the following file paths in "
+            "common which have different contents:\n2")
+
+    @patch('snapcraft.pluginhandler._mapped_file_digest')
+    def test_same_files_are_not_read(self, mock_digest):
+        part4 = pluginhandler.load_plugin('part4', 'nil')
+        part4.code.installdir = os.path.join(self.path, 'install4')
+        os.makedirs(part4.installdir)
+        os.link(os.path.join(self.part2.installdir, '1'),
+                os.path.join(part4.installdir, '1'))
+        with open(os.path.join(part4.installdir, '2'), 'w') as f:
+            f.write('longer')
+
+        with self.assertRaises(EnvironmentError) as raised:
+            pluginhandler.check_for_collisions([self.part2, part4])
+
+        self.assertFalse(mock_digest.called)
+        self.assertTrue(str(raised.exception).endswith(':\n2'))
+
+    def test_same_contents_do_not_collide(self):
+        part4 = pluginhandler.load_plugin('part4', 'nil')
+        part4.code.installdir = os.path.join(self.path, 'install4')
+        os.makedirs(os.path.join(part4.installdir, 'a'))
+        with open(os.path.join(part4.installdir, 'a', '2'), 'w') as f:
+            f.write('a/2')
+
+        pluginhandler.check_for_collisions([self.part2, part4])
+
+    def mark_staged(self, *parts):
+        for part in parts:
+            os.makedirs(os.path.dirname(part.statefile), exist_ok=True)
+            files, dirs = part.migratable_fileset_for('stage')
+            part.save_manifest('stage', pluginhandler._make_manifest(
+                files, dirs, part.installdir, {'files': {}}))
+            part.mark_done('stage')
+
+    def test_staged_parts_are_not_checked_again(self):
+        self.mark_staged(self.part2, self.part3)
+
+        with patch.object(self.part2, 'migratable_fileset_for') as mock_set:
+            pluginhandler.check_for_collisions([self.part2, self.part3])
+
+        self.assertFalse(mock_set.called)
+
+    def test_changed_parts_are_checked_against_staged_ones(self):
+        self.mark_staged(self.part2)
+
+        with self.assertRaises(EnvironmentError) as raised:
+            pluginhandler.check_for_collisions([self.part2, self.part3])
+
+        self.assertEqual(
+            str(raised.exception),
+            "Parts 'part2' and 'part3' have the following file paths in "
+            "common which have different contents:\n1\na/2")
+
+    def test_digests_are_kept_in_the_stage_manifest(self):
+        self.mark_staged(self.part2)
+
+        with patch('snapcraft.pluginhandler._mapped_file_digest',
+                   wraps=pluginhandler._mapped_file_digest) as mock_digest:
+            for i in range(2):
+                # As if running snapcraft again.
+                pluginhandler._digests.clear()
+                with self.assertRaises(EnvironmentError):
+                    pluginhandler.check_for_collisions(
+                        [self.part2, self.part3])
+
+        # Only the files of the changed part are read again.
+        read = [c[0][0] for c in mock_digest.call_args_list]
+        self.assertEqual(
+            read.count(os.path.join(self.part2.installdir, '1')), 1)
+        self.assertEqual(
+            read.count(os.path.join(self.part3.installdir, '1')), 2)
+        manifest = self.part2.load_manifest('stage')
+        self.assertTrue(manifest['files']['1'][2])
+
+
+class IncrementalMigrationTestCase(tests.TestCase):
+
+    def load_part(self, name, files):
+        part = pluginhandler.load_plugin(name, 'nil')
+        part.makedirs()
+        for f, content in files.items():
+            path = os.path.join(part.installdir, f)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, 'w') as f:
+                f.write(content)
+        return part
+
+    def test_restage_follows_the_install_dir(self):
+        part = self.load_part('part', {'bin/old': 'old', 'bin/app': 'v1'})
+        part.stage()
+
+        os.remove(os.path.join(part.installdir, 'bin', 'old'))
+        os.remove(os.path.join(part.installdir, 'bin', 'app'))
+        with open(os.path.join(part.installdir, 'bin', 'app'), 'w') as f:
+            f.write('v2')
+        os.makedirs(os.path.join(part.installdir, 'lib'))
+        with open(os.path.join(part.installdir, 'lib', 'new'), 'w') as f:
+            f.write('new')
+        part.stage(force=True)
+
+        self.assertEqual(sorted(os.listdir('stage')), ['bin', 'lib'])
+        self.assertEqual(os.listdir(os.path.join('stage', 'bin')), ['app'])
+        with open(os.path.join('stage', 'bin', 'app')) as f:
+            self.assertEqual(f.read(), 'v2')
+        self.assertTrue(os.path.exists(os.path.join('stage', 'lib', 'new')))
+
+    def test_files_of_other_parts_are_kept(self):
+        part1 = self.load_part('part1', {'bin/1': '1', 'share/doc': 'doc'})
+        part2 = self.load_part('part2', {'bin/2': '2', 'share/doc': 'doc'})
+        part1.stage()
+        part2.stage()
+
+        shutil.rmtree(os.path.join(part1.installdir, 'share'))
+        part1.stage(force=True)
+
+        self.assertTrue(os.path.exists(os.path.join('stage', 'share', 'doc')))
+
+    def test_clean_removes_only_the_files_of_the_part(self):
+        part1 = self.load_part('part1', {'bin/1': '1', 'lib/1': '1'})
+        part2 = self.load_part('part2', {'bin/2': '2'})
+        part1.stage()
+        part2.stage()
+        part1.strip()
+
+        part1.clean()
+
+        self.assertEqual(os.listdir('stage'), ['bin'])
+        self.assertEqual(os.listdir(os.path.join('stage', 'bin')), ['2'])
+        self.assertEqual(os.listdir('snap'), [])
+
+
+class LinkDuplicatesTestCase(tests.TestCase):
+
+    def make_file(self, path, content, mode=0o644):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'w') as f:
+            f.write(content)
+        os.chmod(path, mode)
+
+    def test_same_contents_are_linked(self):
+        self.make_file('snap/share/a/font', 'font')
+        self.make_file('snap/share/b/font', 'font')
+        self.make_file('snap/share/c/font', 'font')
+        self.make_file('snap/share/other', 'fnot')
+
+        self.assertEqual(pluginhandler.link_duplicates('snap'), 8)
+        self.assertTrue(os.path.samefile('snap/share/a/font',
+                                         'snap/share/b/font'))
+        self.assertTrue(os.path.samefile('snap/share/a/font',
+                                         'snap/share/c/font'))
+        self.assertFalse(os.path.samefile('snap/share/a/font',
+                                          'snap/share/other'))
+        self.assertEqual(sorted(os.listdir('snap/share/a')), ['font'])
+
+    def test_different_modes_are_not_linked(self):
+        self.make_file('snap/bin/app', 'app', 0o755)
+        self.make_file('snap/share/app', 'app')
+
+        self.assertEqual(pluginhandler.link_duplicates('snap'), 0)
+        self.assertFalse(os.path.samefile('snap/bin/app', 'snap/share/app'))
+
+    def test_links_are_counted_once(self):
+        self.make_file('snap/a', 'same')
+        os.link('snap/a', 'snap/b')
+        self.make_file('snap/c', 'same')
+        os.link('snap/c', 'snap/d')
+
+        self.assertEqual(pluginhandler.link_duplicates('snap'), 4)
+        self.assertEqual(os.stat('snap/a').st_nlink, 4)
+
+    def test_digests_are_taken_from_the_strip_manifest(self):
+        part = pluginhandler.load_plugin('part', 'nil')
+        part.makedirs()
+        for name in ('a', 'b'):
+            self.make_file(os.path.join(part.installdir, name), 'same')
+        part.stage()
+        part.strip()
+        manifest = part.load_manifest('strip')
+        for record in manifest['files'].values():
+            record[2] = 'digest'
+        part.save_manifest('strip', manifest)
+
+        with patch('snapcraft.pluginhandler._mapped_file_digest') as digest:
+            self.assertEqual(
+                pluginhandler.link_duplicates(part.snapdir, [part]), 4)
+
+        self.assertFalse(digest.called)
+
+    def test_digests_are_read_once_from_stage_to_snap(self):
+        part = pluginhandler.load_plugin('part', 'nil')
+        part.makedirs()
+        for name, content in (('a', 'same'), ('b', 'same'), ('c', 'diff')):
+            self.make_file(os.path.join(part.installdir, name), content)
+        part.stage()
+        part.strip()
+        # As if snapping in another run.
+        pluginhandler._digests.clear()
+
+        manifest = part.load_manifest('strip')
+        self.assertTrue(all(r[2] for r in manifest['files'].values()))
+        with patch('snapcraft.pluginhandler._mapped_file_digest') as digest:
+            self.assertEqual(
+                pluginhandler.link_duplicates(part.snapdir, [part]), 4)
+            pluginhandler.fingerprint_directory(part.snapdir)
+
+        self.assertFalse(digest.called)
+
+
+class FingerprintTestCase(tests.TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.part = pluginhandler.load_plugin('part', 'nil')
+        self.part.makedirs()
+        os.makedirs(os.path.join(self.part.installdir, 'bin'))
+        with open(os.path.join(self.part.installdir, 'bin', 'app'), 'w') as f:
+            f.write('app')
+        self.part.stage()
+        self.part.strip()
+
+    def test_fingerprint_follows_the_contents(self):
+        fingerprint, files = pluginhandler.fingerprint_directory('snap')
+        self.assertEqual(list(files), ['bin/app'])
+
+        app = os.path.join('snap', 'bin', 'app')
+        os.remove(app)
+        with open(app, 'w') as f:
+            f.write('app')
+        self.assertEqual(
+            pluginhandler.fingerprint_directory('snap')[0], fingerprint)
+
+        os.chmod(app, 0o755)
+        self.assertNotEqual(
+            pluginhandler.fingerprint_directory('snap')[0], fingerprint)
+
+    def test_known_digests_are_not_read_again(self):
+        manifest = self.part.load_manifest('strip')
+        manifest['files']['bin/app'][2] = 'digest'
+        self.part.save_manifest('strip', manifest)
+        with open(os.path.join('snap', 'new'), 'w') as f:
+            f.write('new')
+
+        with patch('snapcraft.pluginhandler._mapped_file_digest',
+                   return_value='new digest') as digest:
+            fingerprint, files = pluginhandler.fingerprint_directory('snap')
+            pluginhandler.fingerprint_directory('snap', files)
+
+        digest.assert_called_once_with(os.path.join('snap', 'new'))
+        self.assertEqual(files['bin/app'][2], 'digest')
+
+
+@unittest.skipUnless(shutil.which('gcc') and shutil.which('strip'),
+                     'needs gcc and binutils')
+class StripBinariesTestCase(tests.TestCase):
+
+    def strip_part(self, properties):
+        part = pluginhandler.load_plugin('part', 'nil', properties)
+        part.makedirs()
+        os.makedirs(os.path.join(part.installdir, 'bin'))
+        with open('hello.c', 'w') as f:
+            f.write('int main(void) { return 0; }\n')
+        subprocess.check_call(['gcc', '-g', '-o', os.path.join(
+            part.installdir, 'bin', 'hello'), 'hello.c'])
+
+        part.stage()
+        part.strip()
+
+        staged = os.path.join(part.stagedir, 'bin', 'hello')
+        snapped = os.path.join(part.snapdir, 'bin', 'hello')
+        return os.path.getsize(snapped), os.path.getsize(staged)
+
+    def test_binaries_are_not_stripped_by_default(self):
+        snapped, staged = self.strip_part({})
+
+        self.assertEqual(snapped, staged)
+        self.assertFalse(os.path.exists('snap-debug'))
+
+    def test_strip_binaries(self):
+        snapped, staged = self.strip_part({'strip-binaries': True})
+
+        self.assertLess(snapped, staged)
+        self.assertFalse(os.path.exists('snap-debug'))
+
+    def test_strip_manifest_describes_the_stripped_binaries(self):
+        self.strip_part({'strip-binaries': True})
+
+        snapped = os.path.join('snap', 'bin', 'hello')
+        st = os.stat(snapped)
+        with open(snapped, 'rb') as f:
+            digest = hashlib.sha256(f.read()).hexdigest()
+        manifest = pluginhandler.load_plugin('part', 'nil').load_manifest(
+            'strip')
+        self.assertEqual(manifest['files']['bin/hello'][:3],
+                         [st.st_size, st.st_mtime_ns, digest])
+
+    def test_unchanged_binaries_are_not_stripped_again(self):
+        properties = {'strip-binaries': True, 'debug-symbols': 'archive'}
+        self.strip_part(properties)
+        snapped = os.path.join('snap', 'bin', 'hello')
+        size = os.path.getsize(snapped)
+
+        part = pluginhandler.load_plugin('part', 'nil', properties)
+        pluginhandler._digests.clear()
+        with patch('snapcraft.elf.strip_files',
+                   wraps=elf.strip_files) as mock_strip, \
+                patch('snapcraft.pluginhandler._mapped_file_digest') as \
+                mock_digest:
+            part.strip(force=True)
+
+        mock_strip.assert_called_once_with(part.snapdir, [], ANY)
+        self.assertFalse(mock_digest.called)
+        self.assertEqual(os.path.getsize(snapped), size)
+        with tarfile.open(os.path.join('snap-debug', 'part.tar.xz')) as tar:
+            self.assertEqual(tar.getnames(), ['bin', 'bin/hello.debug'])
+
+    def test_changed_binaries_are_stripped_again(self):
+        snapped, staged = self.strip_part({'strip-binaries': True})
+        os.utime(os.path.join('stage', 'bin', 'hello'))
+
+        part = pluginhandler.load_plugin('part', 'nil',
+                                         {'strip-binaries': True})
+        with patch('snapcraft.elf.strip_files',
+                   wraps=elf.strip_files) as mock_strip:
+            part.strip(force=True)
+
+        mock_strip.assert_called_once_with(part.snapdir, ['bin/hello'])
+        self.assertEqual(os.path.getsize(os.path.join('snap', 'bin', 'hello')),
+                         snapped)
+
+    def test_strip_binaries_with_debug_symbols_tree(self):
+        snapped, staged = self.strip_part(
+            {'strip-binaries': True, 'debug-symbols': 'tree'})
+
+        self.assertLess(snapped, staged)
+        self.assertTrue(os.path.exists(
+            os.path.join('snap-debug', 'bin', 'hello.debug')))
+
+    def test_strip_binaries_with_debug_symbols_archive(self):
+        snapped, staged = self.strip_part(
+            {'strip-binaries': True, 'debug-symbols': 'archive'})
+
+        self.assertLess(snapped, staged)
+        with tarfile.open(os.path.join('snap-debug', 'part.tar.xz')) as tar:
+            self.assertEqual(tar.getnames(), ['bin', 'bin/hello.debug'])
+
+
+class StateTestCase(tests.TestCase):
+
+    def load_part(self, properties=None):
+        part = pluginhandler.load_plugin('part', 'nil', properties)
+        part.makedirs()
+        return part
+
+    def test_steps_not_run_are_dirty(self):
+        part = self.load_part()
+
+        for step in common.COMMAND_ORDER:
+            with self.subTest(step=step):
+                self.assertTrue(part.is_dirty(step))
+
+    def test_done_step_with_same_inputs_is_clean(self):
+        self.load_part({'stage': ['bin']}).mark_done('strip')
+
+        part = self.load_part({'stage': ['bin']})
+        for step in common.COMMAND_ORDER:
+            with self.subTest(step=step):
+                self.assertFalse(part.is_dirty(step))
+
+    def test_stage_saves_a_manifest(self):
+        part = self.load_part()
+        os.makedirs(os.path.join(part.installdir, 'bin'))
+        with open(os.path.join(part.installdir, 'bin', 'app'), 'w') as f:
+            f.write('app')
+        os.symlink('app', os.path.join(part.installdir, 'bin', 'link'))
+
+        part.stage()
+
+        manifest = part.load_manifest('stage')
+        self.assertEqual(sorted(manifest['files']), ['bin/app', 'bin/link'])
+        self.assertEqual(manifest['files']['bin/app'][0], 3)
+        self.assertEqual(manifest['files']['bin/link'], None)
+        self.assertEqual(manifest['dirs'], ['bin'])
+
+    def test_changed_stage_property_only_dirties_stage(self):
+        part = self.load_part({'stage': ['bin']})
+        for step in common.COMMAND_ORDER:
+            part.mark_done(step)
+
+        part = self.load_part({'stage': ['lib']})
+        self.assertFalse(part.is_dirty('pull'))
+        self.assertFalse(part.is_dirty('build'))
+        self.assertTrue(part.is_dirty('stage'))
+
+    def test_changed_build_property_only_dirties_build(self):
+        part = self.load_part({'source': '.', 'configflags': ['--a']})
+        for step in common.COMMAND_ORDER:
+            part.mark_done(step)
+
+        part = self.load_part({'source': '.', 'configflags': ['--b']})
+        self.assertFalse(part.is_dirty('pull'))
+        self.assertTrue(part.is_dirty('build'))
+
+    def test_changed_organize_dirties_build(self):
+        part = self.load_part({'organize': {'a': 'b'}})
+        for step in common.COMMAND_ORDER:
+            part.mark_done(step)
+
+        part = self.load_part({'organize': {'a': 'c'}})
+        self.assertFalse(part.is_dirty('pull'))
+        self.assertTrue(part.is_dirty('build'))
+
+    def test_changed_source_property_dirties_pull(self):
+        part = self.load_part({'source': '.', 'source-tag': '1.0'})
+        part.mark_done('pull')
+
+        part = self.load_part({'source': '.', 'source-tag': '2.0'})
+        self.assertTrue(part.is_dirty('pull'))
+
+    def test_changed_stage_on_organized_part(self):
+        properties = {'stage': ['*'], 'organize': {'a': 'b'}}
+        part = self.load_part(properties)
+        open(os.path.join(part.installdir, 'a'), 'w').close()
+        part.stage()
+
+        properties['stage'] = ['b']
+        part = self.load_part(properties)
+        self.assertTrue(part.is_dirty('stage'))
+        part.stage()
+
+        self.assertEqual(os.listdir(part.installdir), ['b'])
+        self.assertEqual(os.listdir(part.stagedir), ['b'])
+
+    def test_changed_local_source_dirties_pull(self):
+        os.mkdir('src')
+        open(os.path.join('src', 'file'), 'w').close()
+        part = self.load_part({'source': 'src'})
+        part.mark_done('pull')
+        self.assertFalse(part.is_dirty('pull'))
+
+        with open(os.path.join('src', 'file'), 'w') as f:
+            f.write('changed')
+
+        self.assertTrue(part.is_dirty('pull'))
+
+    def test_snapping_the_project_does_not_dirty_pull(self):
+        with open('snapcraft.yaml', 'w') as f:
+            f.write('name: proj\n')
+        part = self.load_part({'source': '.'})
+        part.mark_done('pull')
+
+        with open('proj_1_amd64.snap', 'w') as f:
+            f.write('snap')
+        os.makedirs('snap-debug')
+
+        self.assertFalse(part.is_dirty('pull'))
+
+    def test_restaged_prerequisite_dirties_build(self):
+        dep = self.load_part()
+        dep.mark_done('stage', outputs='1')
+        part = pluginhandler.load_plugin('part2', 'nil')
+        part.deps.append(dep)
+        part.makedirs()
+        part.mark_done('build')
+        self.assertFalse(part.is_dirty('build'))
+
+        dep.mark_done('stage', outputs='2')
+
+        self.assertTrue(part.is_dirty('build'))
+
+    def test_state_without_fingerprints_is_trusted(self):
+        part = self.load_part()
+        with open(part.statefile, 'w') as f:
+            f.write('build')
+
+        self.assertFalse(part.is_dirty('pull'))
+        self.assertFalse(part.is_dirty('build'))
+        self.assertTrue(part.is_dirty('stage'))
@@ -14,10 +14,14 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import contextlib
+import fcntl
 import fixtures
+import io
 import logging
 import os
 import stat
+import tarfile
 import tempfile
 import unittest.mock
 
@@ -74,38 +78,350 @@ deb http://ports.ubuntu.com/ubuntu-ports trusty-security multiverse
         self.assertEqual(sources_list, expected_sources_list)
         self.assertFalse(mock_cc.called)
 
-    def test_fix_symlinks(self):
-        os.makedirs(self.tempdir + '/a')
-        open(self.tempdir + '/1', mode='w').close()
+    @unittest.mock.patch('snapcraft.repo.apt')
+    @unittest.mock.patch('snapcraft.repo._setup_apt_cache')
+    def test_get_uses_the_deb_cache(self, mock_setup, mock_apt):
+        def make_pkg(name, sha256):
+            pkg = unittest.mock.Mock()
+            pkg.name = pkg.shortname = name
+            pkg.candidate.version = '1:1.0'
+            pkg.candidate.architecture = 'amd64'
+            pkg.candidate.priority = 'optional'
+            pkg.candidate.sha256 = sha256
+            return pkg
 
-        os.symlink('a', self.tempdir + '/rel-to-a')
-        os.symlink('/a', self.tempdir + '/abs-to-a')
-        os.symlink('/b', self.tempdir + '/abs-to-b')
-        os.symlink('1', self.tempdir + '/rel-to-1')
-        os.symlink('/1', self.tempdir + '/abs-to-1')
+        cached = make_pkg('cached', '1' * 64)
+        missing = make_pkg('missing', '2' * 64)
+        apt_cache = unittest.mock.MagicMock()
+        apt_cache.__iter__.return_value = [cached, missing]
+        apt_cache.get_changes.return_value = [cached, missing]
+        mock_setup.return_value = (apt_cache, None)
 
-        repo._fix_contents(debdir=self.tempdir)
+        deb_cache = repo._get_deb_cache()
+        open('deb', 'w').close()
+        deb_cache.add(repo._deb_cache_key(cached), 'deb')
 
-        self.assertEqual(os.readlink(self.tempdir + '/rel-to-a'), 'a')
-        self.assertEqual(os.readlink(self.tempdir + '/abs-to-a'), 'a')
-        self.assertEqual(os.readlink(self.tempdir + '/abs-to-b'), '/b')
-        self.assertEqual(os.readlink(self.tempdir + '/rel-to-1'), '1')
-        self.assertEqual(os.readlink(self.tempdir + '/abs-to-1'), '1')
+        def fetch_archives(progress):
+            open(os.path.join(
+                self.tempdir, 'download', 'missing_1%3a1.0_amd64.deb'),
+                'w').close()
+        apt_cache.fetch_archives.side_effect = fetch_archives
 
-    def test_fix_suid(self):
+        ubuntu = repo.Ubuntu(self.tempdir)
+        ubuntu.get(['cached', 'missing'])
+
+        self.assertTrue(os.path.exists(os.path.join(
+            self.tempdir, 'download', 'cached_1%3a1.0_amd64.deb')))
+        cached.mark_keep.assert_called_once_with()
+        self.assertFalse(missing.mark_keep.called)
+        self.assertTrue(deb_cache.get(repo._deb_cache_key(missing)))
+
+    @unittest.mock.patch('snapcraft.repo.apt')
+    def test_apt_index_is_shared_and_updated_once(self, mock_apt):
+        for part in ('part1', 'part2'):
+            repo._setup_apt_cache(
+                os.path.join(self.tempdir, part), 'deb sources', local=True)
+
+        aptroot = mock_apt.Cache.call_args[1]['rootdir']
+        self.assertEqual(mock_apt.Cache().update.call_count, 1)
+        self.assertEqual(
+            os.path.dirname(aptroot),
+            os.path.join(os.environ['XDG_CACHE_HOME'], 'snapcraft', 'apt'))
+        with open(os.path.join(aptroot, 'etc', 'apt', 'sources.list')) as f:
+            self.assertEqual(f.read(), 'deb sources')
+
+    @unittest.mock.patch('snapcraft.repo.apt')
+    def test_apt_index_is_updated_once_expired(self, mock_apt):
+        self.useFixture(fixtures.EnvironmentVariable(
+            'SNAPCRAFT_APT_INDEX_TTL', '0'))
+
+        for part in ('part1', 'part2'):
+            repo._setup_apt_cache(
+                os.path.join(self.tempdir, part), 'deb sources', local=True)
+
+        self.assertEqual(mock_apt.Cache().update.call_count, 2)
+
+    @unittest.mock.patch('snapcraft.repo.apt')
+    def test_expired_apt_indexes_are_updated(self, mock_apt):
+        for part in ('part1', 'part2'):
+            repo._setup_apt_cache(
+                os.path.join(self.tempdir, part), 'deb sources', local=True)
+            repo.expire_apt_indexes()
+
+        self.assertEqual(mock_apt.Cache().update.call_count, 2)
+
+    @unittest.mock.patch('snapcraft.repo.apt')
+    def test_apt_index_is_read_under_a_shared_lock(self, mock_apt):
+        def try_lock(operation):
+            with open(os.path.join(aptroot, '.lock')) as f:
+                try:
+                    fcntl.flock(f, operation | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    return False
+                return True
+
+        with contextlib.ExitStack() as locks:
+            repo._setup_apt_cache(
+                os.path.join(self.tempdir, 'part'), 'deb sources',
+                local=True, locks=locks)
+            aptroot = mock_apt.Cache.call_args[1]['rootdir']
+
+            self.assertTrue(try_lock(fcntl.LOCK_SH))
+            self.assertFalse(try_lock(fcntl.LOCK_EX))
+        self.assertTrue(try_lock(fcntl.LOCK_EX))
+
+    @unittest.mock.patch('snapcraft.repo.apt')
+    @unittest.mock.patch('snapcraft.repo._setup_apt_cache')
+    def test_get_stage_packages_for_several_parts(self, mock_setup,
+                                                  mock_apt):
+        def make_pkg(name, *depends):
+            pkg = unittest.mock.Mock()
+            pkg.name = pkg.shortname = name
+            pkg.candidate.version = '1.0'
+            pkg.candidate.architecture = 'amd64'
+            pkg.candidate.priority = 'optional'
+            pkg.candidate.sha256 = ''
+            pkg.candidate.package = pkg
+            pkg.candidate.dependencies = [
+                unittest.mock.Mock(or_dependencies=[
+                    unittest.mock.Mock(target_versions=[d.candidate])])
+                for d in depends]
+            return pkg
+
+        libc = make_pkg('libc')
+        liba = make_pkg('liba', libc)
+        libb = make_pkg('libb', libc)
+        apt_cache = unittest.mock.MagicMock()
+        apt_cache.__iter__.return_value = [libc, liba, libb]
+        apt_cache.get_changes.return_value = [libc, liba, libb]
+        mock_setup.return_value = (apt_cache, None)
+
+        def fetch_archives(progress):
+            downloaddir = mock_apt.apt_pkg.config.set.call_args[0][1]
+            for pkg in ('libc', 'liba', 'libb'):
+                open(os.path.join(
+                    downloaddir, '{}_1.0_amd64.deb'.format(pkg)), 'w').close()
+        apt_cache.fetch_archives.side_effect = fetch_archives
+
+        repo.get_stage_packages({'part1': ['liba'], 'part2': ['libb']})
+
+        self.assertEqual(apt_cache.fetch_archives.call_count, 1)
+        self.assertEqual(
+            sorted(os.listdir(os.path.join('part1', 'download'))),
+            ['liba_1.0_amd64.deb', 'libc_1.0_amd64.deb'])
+        self.assertEqual(
+            sorted(os.listdir(os.path.join('part2', 'download'))),
+            ['libb_1.0_amd64.deb', 'libc_1.0_amd64.deb'])
+        self.assertTrue(repo.Ubuntu('part1').is_fetched(['liba']))
+        self.assertFalse(repo.Ubuntu('part1').is_fetched(['libb']))
+
+
+class BuildPackagesTestCase(tests.TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.status_file = os.path.join(self.path, 'status')
+        patcher = unittest.mock.patch(
+            'snapcraft.repo._DPKG_STATUS', self.status_file)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        with open(self.status_file, 'w') as f:
+            for i in range(5000):
+                f.write('Package: pkg{0}\n'
+                        'Status: install ok installed\n'
+                        'Architecture: amd64\n'
+                        'Description: package {0}\n'
+                        ' with a long description\n\n'.format(i))
+            f.write('Package: removed\n'
+                    'Status: deinstall ok config-files\n'
+                    'Architecture: amd64\n')
+
+    def test_get_installed_packages(self):
+        installed = repo._get_installed_packages()
+
+        self.assertTrue('pkg0' in installed)
+        self.assertTrue('pkg4999:amd64' in installed)
+        self.assertFalse('removed' in installed)
+
+    @unittest.mock.patch('snapcraft.repo.apt')
+    @unittest.mock.patch('subprocess.check_call')
+    def test_installed_packages_skip_apt(self, mock_check_call, mock_apt):
+        packages = ['pkg{}'.format(i) for i in range(0, 5000, 50)]
+
+        repo.install_build_packages(packages + ['pkg0:amd64'])
+
+        self.assertFalse(mock_apt.Cache.called)
+        self.assertFalse(mock_check_call.called)
+
+    @unittest.mock.patch('snapcraft.repo.apt')
+    @unittest.mock.patch('subprocess.check_call')
+    def test_missing_packages_use_one_apt_cache(self, mock_check_call,
+                                                mock_apt):
+        mock_apt.Cache.return_value.__getitem__.side_effect = \
+            lambda name: unittest.mock.Mock(installed=name == 'pkg0')
+
+        repo.install_build_packages(['pkg0', 'new1', 'new2', 'new1'])
+
+        self.assertEqual(mock_apt.Cache.call_count, 1)
+        self.assertEqual(
+            mock_check_call.call_args[0][0][-2:], ['new1', 'new2'])
+
+
+class UnpackTestCase(tests.TestCase):
+
+    def make_deb(self, name, members):
+        data = io.BytesIO()
+        with tarfile.open(fileobj=data, mode='w:xz') as tar:
+            for info, content in members:
+                info.size = len(content)
+                tar.addfile(info, io.BytesIO(content))
+
+        with open(name, 'wb') as f:
+            f.write(b'!<arch>\n')
+            for member, content in [('debian-binary', b'2.0\n'),
+                                    ('control.tar.gz', b'\0'),
+                                    ('data.tar.xz', data.getvalue())]:
+                f.write('{:<16}{:<12}{:<6}{:<6}{:<8}{:<10}`\n'.format(
+                    member, 0, 0, 0, 100644, len(content)).encode())
+                f.write(content)
+                if len(content) % 2:
+                    f.write(b'\n')
+        return os.path.abspath(name)
+
+    def make_member(self, name, mode=0o644, type=tarfile.REGTYPE,
+                    linkname=''):
+        info = tarfile.TarInfo(name)
+        info.mode = mode
+        info.type = type
+        info.linkname = linkname
+        return info
+
+    @unittest.mock.patch('snapcraft.repo._skip_link')
+    def test_unpack_debs(self, mock_skip_link):
+        mock_skip_link.return_value = False
+        debs = [
+            self.make_deb('tool.deb', [
+                (self.make_member('./usr/bin', 0o755, tarfile.DIRTYPE), b''),
+                (self.make_member('./usr/bin/tool', 0o4755), b'tool'),
+                (self.make_member('./usr/bin/same', type=tarfile.LNKTYPE,
+                                  linkname='./usr/bin/tool'), b''),
+            ]),
+            self.make_deb('lib.deb', [
+                (self.make_member('./usr/lib/link', type=tarfile.SYMTYPE,
+                                  linkname='/usr/bin/tool'), b''),
+                (self.make_member('../outside'), b''),
+            ]),
+        ]
+
+        repo._unpack_debs(debs, 'root')
+
+        with open(os.path.join('root', 'usr', 'lib', 'link')) as f:
+            self.assertEqual(f.read(), 'tool')
+        self.assertEqual(
+            os.readlink(os.path.join('root', 'usr', 'lib', 'link')),
+            '../bin/tool')
+        self.assertEqual(
+            stat.S_IMODE(os.stat(os.path.join(
+                'root', 'usr', 'bin', 'tool')).st_mode), 0o755)
+        self.assertEqual(
+            os.stat(os.path.join('root', 'usr', 'bin', 'tool')).st_ino,
+            os.stat(os.path.join('root', 'usr', 'bin', 'same')).st_ino)
+        self.assertFalse(os.path.exists('outside'))
+
+    def open_tar(self, members):
+        data = io.BytesIO()
+        with tarfile.open(fileobj=data, mode='w') as tar:
+            for info, content in members:
+                info.size = len(content)
+                tar.addfile(info, io.BytesIO(content))
+        data.seek(0)
+        return tarfile.open(fileobj=data, mode='r|')
+
+    @unittest.mock.patch('snapcraft.repo._skip_link')
+    def test_extract_members_fixes_absolute_symlinks(self, mock_skip_link):
+        mock_skip_link.return_value = False
+        links = [('rel-to-a', 'a'), ('abs-to-a', '/a'), ('abs-to-b', '/b'),
+                 ('rel-to-1', '1'), ('abs-to-1', '/1')]
+        tar = self.open_tar(
+            [(self.make_member('a', 0o755, tarfile.DIRTYPE), b''),
+             (self.make_member('1'), b'')] +
+            [(self.make_member(name, type=tarfile.SYMTYPE, linkname=target),
+              b'') for name, target in links])
+
+        with tar:
+            absolute_links = repo._extract_members(tar, 'root')
+        for path in absolute_links:
+            repo._fix_symlink(path, 'root')
+
+        self.assertEqual(
+            sorted(absolute_links),
+            [os.path.join('root', name)
+             for name in ('abs-to-1', 'abs-to-a', 'abs-to-b')])
+        self.assertEqual(os.readlink(os.path.join('root', 'rel-to-a')), 'a')
+        self.assertEqual(os.readlink(os.path.join('root', 'abs-to-a')), 'a')
+        self.assertEqual(os.readlink(os.path.join('root', 'abs-to-b')), '/b')
+        self.assertEqual(os.readlink(os.path.join('root', 'rel-to-1')), '1')
+        self.assertEqual(os.readlink(os.path.join('root', 'abs-to-1')), '1')
+
+    def test_extract_members_removes_suid(self):
         files = {
             'suid_file': (0o4765, 0o0765),
             'guid_file': (0o2777, 0o0777),
             'suid_guid_file': (0o6744, 0o0744),
             'suid_guid_sticky_file': (0o7744, 0o1744),
         }
+        tar = self.open_tar([(self.make_member(name, modes[0]), b'')
+                             for name, modes in files.items()])
 
-        for key in files:
-            with self.subTest(key=key):
-                file = os.path.join(self.tempdir, key)
-                open(file, mode='w').close()
-                os.chmod(file, files[key][0])
+        with tar:
+            repo._extract_members(tar, 'root')
 
-                repo._fix_contents(debdir=self.tempdir)
+        for name, modes in files.items():
+            with self.subTest(key=name):
                 self.assertEqual(
-                    stat.S_IMODE(os.stat(file).st_mode), files[key][1])
+                    stat.S_IMODE(os.stat(os.path.join('root', name)).st_mode),
+                    modes[1])
+
+    def test_unpack_debs_shipping_the_same_paths(self):
+        debs = [
+            self.make_deb('pkg{}.deb'.format(i), [
+                (self.make_member('./usr/bin/tool'), b'tool'),
+                (self.make_member('./usr/bin/link', type=tarfile.SYMTYPE,
+                                  linkname='tool'), b''),
+                (self.make_member('./usr/bin/same', type=tarfile.LNKTYPE,
+                                  linkname='./usr/bin/tool'), b''),
+            ]) for i in range(20)]
+
+        repo._unpack_debs(debs, 'root')
+
+        self.assertEqual(
+            sorted(os.listdir(os.path.join('root', 'usr', 'bin'))),
+            ['link', 'same', 'tool'])
+        with open(os.path.join('root', 'usr', 'bin', 'link')) as f:
+            self.assertEqual(f.read(), 'tool')
+
+    def test_unpack_hard_link_to_what_was_not_extracted(self):
+        for target in ('usr/bin/missing', '../outside'):
+            with self.subTest(target=target):
+                deb = self.make_deb('link.deb', [
+                    (self.make_member('usr/bin/link', type=tarfile.LNKTYPE,
+                                      linkname=target), b'')])
+
+                with self.assertRaises(repo.UnpackError) as raised:
+                    repo._unpack_debs([deb], 'root')
+
+                self.assertEqual(raised.exception.package_name, deb)
+                self.assertEqual(
+                    raised.exception.message,
+                    'Error while provisioning "{}": usr/bin/link is a hard '
+                    'link to {}, which was not extracted'.format(deb, target))
+
+    def test_unpack_invalid_deb(self):
+        with open('invalid.deb', 'w') as f:
+            f.write('invalid')
+
+        with self.assertRaises(repo.UnpackError) as raised:
+            repo._unpack_debs(['invalid.deb'], 'root')
+
+        self.assertEqual(raised.exception.package_name, 'invalid.deb')
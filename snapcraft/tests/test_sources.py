@@ -14,10 +14,18 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import hashlib
 import os
 import http.server
+import io
+import lzma
+import re
+import shutil
+import subprocess
+import tarfile
 import threading
 import unittest.mock
+import zipfile
 
 import snapcraft.sources
 
@@ -62,10 +70,309 @@ class TestTar(tests.TestCase):
 
         tar_source.pull()
 
-        mock_prov.assert_called_once_with(dest_dir)
+        mock_prov.assert_called_once_with(dest_dir, stream=False)
         with open(os.path.join(dest_dir, tar_file_name), 'r') as tar_file:
             self.assertEqual('Test fake tarball file', tar_file.read())
 
+    def test_init_with_source_depth_raises_exception(self):
+        with self.assertRaises(
+                snapcraft.sources.IncompatibleOptionsError) as raised:
+            snapcraft.sources.Tar('my-source.tar.gz', 'source_dir',
+                                  source_depth=1)
+
+        self.assertEqual(raised.exception.message,
+                         'can\'t specify a source-depth for a tar source')
+
+    def test_pull_with_subdir_only_extracts_subdir(self):
+        for path in ('project/sub/dir', 'project/other'):
+            os.makedirs(path)
+        for path in ('project/sub/dir/file', 'project/other/file',
+                     'project/top'):
+            with open(path, 'w') as f:
+                f.write(path)
+        with tarfile.open('project.tar.gz', 'w:gz') as tar:
+            tar.add('project')
+        os.mkdir('src')
+
+        tar_source = snapcraft.sources.Tar(
+            'project.tar.gz', 'src', source_subdir='sub/')
+        tar_source.pull()
+
+        self.assertEqual(os.listdir('src'), ['sub'])
+        with open(os.path.join('src', 'sub', 'dir', 'file')) as f:
+            self.assertEqual(f.read(), 'project/sub/dir/file')
+
+    def make_tarball(self, name, *paths):
+        with tarfile.open(name, 'w:gz') as tar:
+            for path in paths:
+                info = tarfile.TarInfo(path)
+                data = path.encode()
+                info.size = len(data)
+                tar.addfile(info, io.BytesIO(data))
+
+    def test_pull_strips_the_first_directory_until_another_shows_up(self):
+        self.make_tarball('project.tar.gz', 'project/sub/dir/file',
+                          'project/sub/other', 'project/top')
+        os.mkdir('src')
+
+        snapcraft.sources.Tar('project.tar.gz', 'src').pull()
+
+        self.assertEqual(sorted(os.listdir('src')), ['sub', 'top'])
+        with open(os.path.join('src', 'sub', 'dir', 'file')) as f:
+            self.assertEqual(f.read(), 'project/sub/dir/file')
+        with open(os.path.join('src', 'sub', 'other')) as f:
+            self.assertEqual(f.read(), 'project/sub/other')
+
+    def test_pull_with_subdir_and_another_directory(self):
+        self.make_tarball('project.tar.gz', 'project/sub/dir/file',
+                          'project/top')
+        os.mkdir('src')
+
+        snapcraft.sources.Tar('project.tar.gz', 'src',
+                              source_subdir='sub').pull()
+
+        self.assertEqual(os.listdir('src'), ['sub'])
+        self.assertEqual(os.listdir(os.path.join('src', 'sub', 'dir')),
+                         ['file'])
+
+    def test_pull_leaves_out_unsafe_names(self):
+        self.make_tarball('project.tar.gz', 'project/file',
+                          'project/../../evil', '/project/other')
+        os.mkdir('src')
+
+        snapcraft.sources.Tar('project.tar.gz', 'src').pull()
+
+        self.assertEqual(sorted(os.listdir('src')), ['file', 'other'])
+        self.assertFalse(os.path.exists('evil'))
+
+    def test_pull_symlink_replacing_a_directory(self):
+        with tarfile.open('project.tar.gz', 'w:gz') as tar:
+            for path in ('top/c/a', 'top/b'):
+                info = tarfile.TarInfo(path)
+                tar.addfile(info, io.BytesIO())
+            info = tarfile.TarInfo('top/c')
+            info.type = tarfile.SYMTYPE
+            info.linkname = 'b'
+            tar.addfile(info)
+            info = tarfile.TarInfo('top/a/b/b')
+            info.size = 1
+            tar.addfile(info, io.BytesIO(b'b'))
+        os.mkdir('src')
+
+        snapcraft.sources.Tar('project.tar.gz', 'src').pull()
+
+        self.assertEqual(sorted(os.listdir('src')), ['a', 'b', 'c'])
+        self.assertEqual(os.readlink(os.path.join('src', 'c')), 'b')
+        with open(os.path.join('src', 'a', 'b', 'b')) as f:
+            self.assertEqual(f.read(), 'b')
+
+    def test_pull_with_subdir_and_hard_link_out_of_it(self):
+        with tarfile.open('project.tar.gz', 'w:gz') as tar:
+            info = tarfile.TarInfo('project/other')
+            info.size = 5
+            tar.addfile(info, io.BytesIO(b'other'))
+            info = tarfile.TarInfo('project/dir/file')
+            info.type = tarfile.LNKTYPE
+            info.linkname = 'project/other'
+            tar.addfile(info)
+        os.mkdir('src')
+
+        snapcraft.sources.Tar('project.tar.gz', 'src',
+                              source_subdir='dir').pull()
+
+        self.assertEqual(os.listdir('src'), ['dir'])
+        with open(os.path.join('src', 'dir', 'file')) as f:
+            self.assertEqual(f.read(), 'other')
+
+
+class TestTarDecompression(tests.TestCase):
+
+    def setUp(self):
+        super().setUp()
+        with tarfile.open('project.tar', 'w') as tar:
+            for path in ('project/dir/file', 'project/other'):
+                info = tarfile.TarInfo(path)
+                info.size = len(path)
+                tar.addfile(info, io.BytesIO(path.encode()))
+        os.mkdir('src')
+
+    def assert_extracted(self):
+        self.assertEqual(sorted(os.listdir('src')), ['dir', 'other'])
+        with open(os.path.join('src', 'dir', 'file')) as f:
+            self.assertEqual(f.read(), 'project/dir/file')
+
+    @unittest.skipUnless(shutil.which('xz'), 'needs xz')
+    def test_pull_xz_tarball(self):
+        subprocess.check_call(['xz', 'project.tar'])
+
+        with unittest.mock.patch('subprocess.Popen',
+                                 wraps=subprocess.Popen) as mock_popen:
+            snapcraft.sources.Tar('project.tar.xz', 'src').pull()
+
+        self.assertEqual(mock_popen.call_args[0][0][0], 'xz')
+        self.assert_extracted()
+
+    @unittest.mock.patch('shutil.which', return_value=None)
+    def test_pull_without_decompressors(self, mock_which):
+        with open('project.tar', 'rb') as f, \
+                lzma.open('project.tar.xz', 'wb') as xz:
+            shutil.copyfileobj(f, xz)
+
+        snapcraft.sources.Tar('project.tar.xz', 'src').pull()
+
+        self.assert_extracted()
+
+    @unittest.skipUnless(shutil.which('zstd'), 'needs zstd')
+    def test_pull_zstd_tarball(self):
+        subprocess.check_call(['zstd', '-q', '--rm', 'project.tar'])
+
+        snapcraft.sources.Tar('project.tar.zst', 'src').pull()
+
+        self.assert_extracted()
+
+    @unittest.mock.patch('shutil.which', return_value=None)
+    def test_pull_zstd_tarball_without_zstd(self, mock_which):
+        with open('project.tar.zst', 'wb') as f:
+            f.write(b'\x28\xb5\x2f\xfd' + b'\0' * 16)
+
+        with self.assertRaises(EnvironmentError) as raised:
+            snapcraft.sources.Tar('project.tar.zst', 'src').pull()
+
+        self.assertEqual(str(raised.exception),
+                         'zstd is needed to extract zstd compressed tarballs')
+
+    def test_parallel_decompressors_are_preferred(self):
+        with unittest.mock.patch('shutil.which',
+                                 side_effect=lambda c: c in ('pixz', 'xz')):
+            self.assertEqual(
+                snapcraft.sources._find_decompressor(b'\xfd7zXZ\x00'),
+                ['pixz', '-d'])
+        with unittest.mock.patch('shutil.which',
+                                 side_effect=lambda c: c == 'xz'):
+            self.assertEqual(
+                snapcraft.sources._find_decompressor(b'\xfd7zXZ\x00'),
+                ['xz', '-d', '-c', '-T0'])
+
+    def test_pull_zip(self):
+        with zipfile.ZipFile('project.zip', 'w') as zf:
+            zf.writestr('project/dir/file', 'project/dir/file')
+            info = zipfile.ZipInfo('project/other')
+            info.external_attr = 0o100755 << 16
+            zf.writestr(info, 'project/other')
+
+        snapcraft.sources.Tar('project.zip', 'src').pull()
+
+        self.assert_extracted()
+        self.assertTrue(os.access(os.path.join('src', 'other'), os.X_OK))
+
+    def test_pull_zip_with_subdir(self):
+        with zipfile.ZipFile('project.zip', 'w') as zf:
+            zf.writestr('project/dir/file', 'project/dir/file')
+            zf.writestr('project/other', 'project/other')
+
+        snapcraft.sources.Tar('project.zip', 'src', source_subdir='dir').pull()
+
+        self.assertEqual(os.listdir('src'), ['dir'])
+
+
+class RangeHTTPRequestHandler(http.server.BaseHTTPRequestHandler):
+
+    data = b'Test fake tarball file'
+    requests = []
+
+    def do_GET(self):
+        self.requests.append(self.headers.get('Range'))
+        data = self.data
+        ranges = re.match(r'bytes=(\d+)-$', self.headers.get('Range', ''))
+        if ranges:
+            data = data[int(ranges.group(1)):]
+            self.send_response(206)
+        else:
+            self.send_response(200)
+        self.send_header('Content-Length', len(data))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, *args):
+        pass
+
+
+@unittest.mock.patch('snapcraft.sources.Tar.provision')
+class TestTarDownload(tests.TestCase):
+
+    def setUp(self):
+        super().setUp()
+        os.environ['no_proxy'] = '127.0.0.1'
+        RangeHTTPRequestHandler.requests = []
+        server = http.server.HTTPServer(
+            ('127.0.0.1', 0), RangeHTTPRequestHandler)
+        server_thread = threading.Thread(target=server.serve_forever)
+        self.addCleanup(server_thread.join)
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        server_thread.start()
+
+        self.source = 'http://{}:{}/test.tar'.format(*server.server_address)
+        self.checksum = 'sha256/' + hashlib.sha256(
+            RangeHTTPRequestHandler.data).hexdigest()
+        for part in ('part1', 'part2'):
+            os.makedirs(os.path.join(part, 'src'))
+
+    def read(self, part):
+        with open(os.path.join(part, 'src', 'test.tar'), 'rb') as f:
+            return f.read()
+
+    def test_download_with_checksum_is_cached(self, mock_prov):
+        snapcraft.sources.Tar(self.source, os.path.join('part1', 'src'),
+                              source_checksum=self.checksum).pull()
+        snapcraft.sources.Tar(self.source, os.path.join('part2', 'src'),
+                              source_checksum=self.checksum).pull()
+
+        self.assertEqual(RangeHTTPRequestHandler.requests, [None])
+        self.assertEqual(self.read('part2'), RangeHTTPRequestHandler.data)
+
+    def test_download_without_checksum_is_not_cached(self, mock_prov):
+        snapcraft.sources.Tar(self.source, os.path.join('part1', 'src')).pull()
+        snapcraft.sources.Tar(self.source, os.path.join('part2', 'src')).pull()
+
+        self.assertEqual(RangeHTTPRequestHandler.requests, [None, None])
+
+    def test_download_with_wrong_checksum(self, mock_prov):
+        tar_source = snapcraft.sources.Tar(
+            self.source, os.path.join('part1', 'src'),
+            source_checksum='sha256/0123')
+
+        with self.assertRaises(EnvironmentError) as raised:
+            tar_source.pull()
+
+        self.assertEqual(str(raised.exception), (
+            'the sha256 digest of {} is {}, expected 0123'.format(
+                self.source, self.checksum[len('sha256/'):])))
+        self.assertEqual(os.listdir(os.path.join('part1', 'src')), [])
+        self.assertFalse(mock_prov.called)
+
+    def test_partial_download_is_resumed(self, mock_prov):
+        with open(os.path.join('part1', 'src', 'test.tar.partial'),
+                  'wb') as f:
+            f.write(RangeHTTPRequestHandler.data[:5])
+
+        snapcraft.sources.Tar(self.source, os.path.join('part1', 'src'),
+                              source_checksum=self.checksum).pull()
+
+        self.assertEqual(RangeHTTPRequestHandler.requests, ['bytes=5-'])
+        self.assertEqual(self.read('part1'), RangeHTTPRequestHandler.data)
+
+    def test_invalid_checksum(self, mock_prov):
+        with self.assertRaises(
+                snapcraft.sources.IncompatibleOptionsError) as raised:
+            snapcraft.sources.Tar(self.source, 'src',
+                                  source_checksum='0123')
+
+        self.assertEqual(
+            raised.exception.message,
+            'source-checksum must be an algorithm and a digest such as '
+            'sha256/<digest>, not \'0123\'')
+
 
 class SourceTestCase(tests.TestCase):
 
@@ -86,6 +393,11 @@ class SourceTestCase(tests.TestCase):
         self.mock_path_exists.return_value = False
         self.addCleanup(patcher.stop)
 
+    def get_mirror(self, vcs, source):
+        return os.path.join(
+            os.environ['XDG_CACHE_HOME'], 'snapcraft', vcs,
+            hashlib.sha1(source.encode()).hexdigest())
+
 
 class TestBazaar(SourceTestCase):
 
@@ -94,18 +406,50 @@ class TestBazaar(SourceTestCase):
 
         bzr.pull()
 
+        mirror = self.get_mirror('bzr', 'lp:my-source')
         self.mock_rmdir.assert_called_once_with('source_dir')
-        self.mock_run.assert_called_once_with(
-            ['bzr', 'branch', 'lp:my-source', 'source_dir'])
+        self.assertEqual(self.mock_run.call_args_list, [
+            unittest.mock.call(
+                ['bzr', 'branch', '--no-tree', 'lp:my-source', mirror]),
+            unittest.mock.call(['bzr', 'branch', mirror, 'source_dir'])])
 
     def test_pull_tag(self):
         bzr = snapcraft.sources.Bazaar(
             'lp:my-source', 'source_dir', source_tag='tag')
         bzr.pull()
 
+        mirror = self.get_mirror('bzr', 'lp:my-source')
+        self.mock_run.assert_called_with(
+            ['bzr', 'branch', '-r', 'tag:tag', mirror, 'source_dir'])
+
+    def test_pull_updates_mirror(self):
+        mirror = self.get_mirror('bzr', 'lp:my-source')
+        self.mock_path_exists.side_effect = lambda path: path == mirror
+
+        bzr = snapcraft.sources.Bazaar('lp:my-source', 'source_dir')
+        bzr.pull()
+
+        self.mock_run.assert_any_call(
+            ['bzr', 'pull', '--overwrite', '-d', mirror, 'lp:my-source'])
+
+    def test_pull_with_depth(self):
+        bzr = snapcraft.sources.Bazaar(
+            'lp:my-source', 'source_dir', source_tag='tag', source_depth=1)
+        bzr.pull()
+
         self.mock_run.assert_called_once_with(
-            ['bzr', 'branch', '-r', 'tag:tag', 'lp:my-source',
-             'source_dir'])
+            ['bzr', 'checkout', '--lightweight', '-r', 'tag:tag',
+             'lp:my-source', 'source_dir'])
+
+    def test_pull_existing_with_depth(self):
+        self.mock_path_exists.return_value = True
+
+        bzr = snapcraft.sources.Bazaar(
+            'lp:my-source', 'source_dir', source_tag='tag', source_depth=1)
+        bzr.pull()
+
+        self.mock_run.assert_called_once_with(
+            ['bzr', 'update', '-r', 'tag:tag', 'source_dir'])
 
     def test_pull_existing_with_tag(self):
         self.mock_path_exists.return_value = True
@@ -135,26 +479,147 @@ class TestGit(SourceTestCase):
 
         git.pull()
 
+        mirror = self.get_mirror('git', 'git://my-source')
+        self.assertEqual(self.mock_run.call_args_list, [
+            unittest.mock.call(
+                ['git', 'clone', '--mirror', 'git://my-source', mirror]),
+            unittest.mock.call(
+                ['git', 'clone', '--reference', mirror, '--dissociate',
+                 'git://my-source', 'source_dir'])])
+
+    def test_pull_updates_mirror(self):
+        mirror = self.get_mirror('git', 'git://my-source')
+        self.mock_path_exists.side_effect = lambda path: path == mirror
+
+        git = snapcraft.sources.Git('git://my-source', 'source_dir')
+        git.pull()
+
+        self.mock_run.assert_any_call(
+            ['git', '-C', mirror, 'fetch', '--prune'])
+
+    @unittest.mock.patch('shutil.rmtree')
+    def test_pull_replaces_broken_mirror(self, mock_rmtree):
+        mirror = self.get_mirror('git', 'git://my-source')
+        self.mock_path_exists.side_effect = lambda path: path == mirror
+        self.mock_run.side_effect = [
+            subprocess.CalledProcessError(1, 'git'), True, True]
+
+        git = snapcraft.sources.Git('git://my-source', 'source_dir')
+        git.pull()
+
+        mock_rmtree.assert_called_once_with(mirror)
+        self.mock_run.assert_any_call(
+            ['git', 'clone', '--mirror', 'git://my-source', mirror])
+
+    def test_pull_with_depth(self):
+        git = snapcraft.sources.Git('git://my-source', 'source_dir',
+                                    source_depth=1)
+        git.pull()
+
         self.mock_run.assert_called_once_with(
-            ['git', 'clone', 'git://my-source', 'source_dir'])
+            ['git', 'clone', '--depth', '1', '--single-branch',
+             'git://my-source', 'source_dir'])
+
+    @unittest.mock.patch('snapcraft.sources._get_git_version',
+                         return_value=(2, 25))
+    def test_pull_with_subdir(self, mock_version):
+        git = snapcraft.sources.Git('git://my-source', 'source_dir',
+                                    source_subdir='sub/dir')
+        git.pull()
+
+        self.assertEqual(self.mock_run.call_args_list, [
+            unittest.mock.call(
+                ['git', 'clone', '--filter=blob:none', '--no-checkout',
+                 'git://my-source', 'source_dir']),
+            unittest.mock.call(
+                ['git', '-C', 'source_dir', 'sparse-checkout', 'set',
+                 '/sub/dir/']),
+            unittest.mock.call(['git', '-C', 'source_dir', 'checkout'])])
+
+    @unittest.mock.patch('snapcraft.sources._get_git_version',
+                         return_value=(2, 35))
+    def test_pull_with_subdir_in_cone_mode(self, mock_version):
+        git = snapcraft.sources.Git('git://my-source', 'source_dir',
+                                    source_subdir='sub/dir')
+        git.pull()
+
+        self.mock_run.assert_any_call(
+            ['git', '-C', 'source_dir', 'sparse-checkout', 'set', '--cone',
+             'sub/dir'])
+
+    @unittest.mock.patch('snapcraft.sources._get_git_version',
+                         return_value=(2, 7))
+    def test_pull_with_subdir_and_old_git_clones_all(self, mock_version):
+        git = snapcraft.sources.Git('git://my-source', 'source_dir',
+                                    source_subdir='sub/dir')
+        git.pull()
+
+        mirror = self.get_mirror('git', 'git://my-source')
+        self.assertEqual(self.mock_run.call_args_list, [
+            unittest.mock.call(
+                ['git', 'clone', '--mirror', 'git://my-source', mirror]),
+            unittest.mock.call(
+                ['git', 'clone', '--reference', mirror, '--dissociate',
+                 'git://my-source', 'source_dir'])])
+
+    @unittest.mock.patch('subprocess.check_output',
+                         return_value=b'git version 2.7.4\n')
+    def test_get_git_version(self, mock_output):
+        self.addCleanup(setattr, snapcraft.sources, '_git_version', None)
+        snapcraft.sources._git_version = None
+
+        self.assertEqual(snapcraft.sources._get_git_version(), (2, 7))
+        self.assertEqual(snapcraft.sources._get_git_version(), (2, 7))
+
+        mock_output.assert_called_once_with(['git', '--version'])
+
+    def test_pull_existing_with_subdir(self):
+        self.mock_path_exists.return_value = True
+
+        git = snapcraft.sources.Git('git://my-source', 'source_dir',
+                                    source_subdir='sub/dir')
+        git.pull()
+
+        self.mock_run.assert_called_once_with(
+            ['git', '-C', 'source_dir', 'pull', 'git://my-source', 'HEAD'])
+
+    def test_pull_local_source_is_not_mirrored(self):
+        os.mkdir('my-source')
+
+        git = snapcraft.sources.Git('my-source', 'source_dir')
+        git.pull()
+
+        self.mock_run.assert_called_once_with(
+            ['git', 'clone', 'my-source', 'source_dir'])
 
     def test_pull_branch(self):
         git = snapcraft.sources.Git('git://my-source', 'source_dir',
                                     source_branch='my-branch')
         git.pull()
 
-        self.mock_run.assert_called_once_with(
-            ['git', 'clone', '--branch', 'my-branch', 'git://my-source',
-             'source_dir'])
+        mirror = self.get_mirror('git', 'git://my-source')
+        self.mock_run.assert_called_with(
+            ['git', 'clone', '--branch', 'my-branch', '--reference', mirror,
+             '--dissociate', 'git://my-source', 'source_dir'])
 
     def test_pull_tag(self):
         git = snapcraft.sources.Git('git://my-source', 'source_dir',
                                     source_tag='tag')
         git.pull()
 
+        mirror = self.get_mirror('git', 'git://my-source')
+        self.mock_run.assert_called_with(
+            ['git', 'clone', '--branch', 'tag', '--reference', mirror,
+             '--dissociate', 'git://my-source', 'source_dir'])
+
+    def test_pull_tag_with_depth(self):
+        git = snapcraft.sources.Git('git://my-source', 'source_dir',
+                                    source_tag='tag', source_depth=10)
+        git.pull()
+
         self.mock_run.assert_called_once_with(
-            ['git', 'clone', '--branch', 'tag', 'git://my-source',
-             'source_dir'])
+            ['git', 'clone', '--branch', 'tag', '--depth', '10',
+             '--single-branch', 'git://my-source', 'source_dir'])
 
     def test_pull_existing(self):
         self.mock_path_exists.return_value = True
@@ -177,6 +642,17 @@ class TestGit(SourceTestCase):
             ['git', '-C', 'source_dir', 'pull', 'git://my-source',
              'refs/tags/tag'])
 
+    def test_pull_existing_with_depth(self):
+        self.mock_path_exists.return_value = True
+
+        git = snapcraft.sources.Git('git://my-source', 'source_dir',
+                                    source_tag='tag', source_depth=1)
+        git.pull()
+
+        self.mock_run.assert_called_once_with(
+            ['git', '-C', 'source_dir', 'pull', '--depth', '1',
+             'git://my-source', 'refs/tags/tag'])
+
     def test_pull_existing_with_branch(self):
         self.mock_path_exists.return_value = True
 
@@ -199,31 +675,85 @@ class TestGit(SourceTestCase):
         self.assertEqual(raised.exception.message, expected_message)
 
 
+@unittest.skipUnless(shutil.which('git'), 'needs git')
+class TestGitSparseCheckout(tests.TestCase):
+
+    def test_pull_with_subdir_leaves_out_nested_namesakes(self):
+        for path in ('docs/index', 'foo/docs/index', 'other'):
+            os.makedirs(os.path.dirname(os.path.join('repo', path)) or
+                        'repo', exist_ok=True)
+            with open(os.path.join('repo', path), 'w') as f:
+                f.write(path)
+        git = ['git', '-C', 'repo', '-c', 'user.name=Test',
+               '-c', 'user.email=test@example.com']
+        subprocess.check_call(['git', 'init', '-q', 'repo'])
+        subprocess.check_call(git + ['add', '.'])
+        subprocess.check_call(git + ['commit', '-q', '-m', 'init'])
+        os.mkdir('src')
+
+        snapcraft.sources.Git('file://' + os.path.abspath('repo'), 'src',
+                              source_subdir='docs').pull()
+
+        self.assertTrue(os.path.exists(os.path.join('src', 'docs', 'index')))
+        self.assertFalse(os.path.exists(os.path.join('src', 'foo')))
+
+
 class TestMercurial(SourceTestCase):
 
     def test_pull(self):
         hg = snapcraft.sources.Mercurial('hg://my-source', 'source_dir')
         hg.pull()
 
+        mirror = self.get_mirror('hg', 'hg://my-source')
+        self.assertEqual(self.mock_run.call_args_list, [
+            unittest.mock.call(
+                ['hg', 'clone', '-U', 'hg://my-source', mirror]),
+            unittest.mock.call(['hg', 'clone', mirror, 'source_dir'])])
+
+    def test_pull_updates_mirror(self):
+        mirror = self.get_mirror('hg', 'hg://my-source')
+        self.mock_path_exists.side_effect = lambda path: path == mirror
+
+        hg = snapcraft.sources.Mercurial('hg://my-source', 'source_dir')
+        hg.pull()
+
+        self.mock_run.assert_any_call(
+            ['hg', 'pull', '-R', mirror, 'hg://my-source'])
+
+    def test_pull_with_depth(self):
+        hg = snapcraft.sources.Mercurial('hg://my-source', 'source_dir',
+                                         source_depth=1)
+        hg.pull()
+
         self.mock_run.assert_called_once_with(
-            ['hg', 'clone', 'hg://my-source', 'source_dir'])
+            ['hg', 'clone', '-r', 'default', '-u', 'default',
+             'hg://my-source', 'source_dir'])
 
     def test_pull_branch(self):
         hg = snapcraft.sources.Mercurial('hg://my-source', 'source_dir',
                                          source_branch='my-branch')
         hg.pull()
 
-        self.mock_run.assert_called_once_with(
-            ['hg', 'clone', '-u', 'my-branch', 'hg://my-source',
-             'source_dir'])
+        mirror = self.get_mirror('hg', 'hg://my-source')
+        self.mock_run.assert_called_with(
+            ['hg', 'clone', '-u', 'my-branch', mirror, 'source_dir'])
 
     def test_pull_tag(self):
         hg = snapcraft.sources.Mercurial('hg://my-source', 'source_dir',
                                          source_tag='tag')
         hg.pull()
 
+        mirror = self.get_mirror('hg', 'hg://my-source')
+        self.mock_run.assert_called_with(
+            ['hg', 'clone', '-u', 'tag', mirror, 'source_dir'])
+
+    def test_pull_tag_with_depth(self):
+        hg = snapcraft.sources.Mercurial('hg://my-source', 'source_dir',
+                                         source_tag='tag', source_depth=1)
+        hg.pull()
+
         self.mock_run.assert_called_once_with(
-            ['hg', 'clone', '-u', 'tag', 'hg://my-source',
+            ['hg', 'clone', '-r', 'tag', '-u', 'tag', 'hg://my-source',
              'source_dir'])
 
     def test_pull_existing(self):
@@ -319,9 +849,71 @@ class TestUri(tests.TestCase):
             'https://golang.tar.xz',
             'https://golang.tar.bz2',
             'https://golang.tar.tgz',
+            'https://golang.tar.zst',
+            'https://golang.zip',
         ]
 
         for source in sources:
             with self.subTest(key=source):
                 self.assertEqual(
                     snapcraft.sources._get_source_type_from_uri(source), 'tar')
+
+
+class TestTarStreamedDownload(tests.TestCase):
+
+    def setUp(self):
+        super().setUp()
+        os.environ['no_proxy'] = '127.0.0.1'
+        self.addCleanup(setattr, RangeHTTPRequestHandler, 'data',
+                        RangeHTTPRequestHandler.data)
+        RangeHTTPRequestHandler.requests = []
+        data = io.BytesIO()
+        with tarfile.open(fileobj=data, mode='w:xz') as tar:
+            for path in ('project/dir/file', 'project/other'):
+                info = tarfile.TarInfo(path)
+                info.size = len(path)
+                tar.addfile(info, io.BytesIO(path.encode()))
+        RangeHTTPRequestHandler.data = data.getvalue()
+
+        server = http.server.HTTPServer(
+            ('127.0.0.1', 0), RangeHTTPRequestHandler)
+        server_thread = threading.Thread(target=server.serve_forever)
+        self.addCleanup(server_thread.join)
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        server_thread.start()
+        self.source = 'http://{}:{}/test.tar.xz'.format(
+            *server.server_address)
+        os.mkdir('src')
+
+    @unittest.mock.patch('snapcraft.sources.Tar.provision')
+    def test_download_is_extracted_as_it_comes(self, mock_prov):
+        checksum = 'sha256/' + hashlib.sha256(
+            RangeHTTPRequestHandler.data).hexdigest()
+
+        snapcraft.sources.Tar(self.source, 'src',
+                              source_checksum=checksum).pull()
+
+        self.assertFalse(mock_prov.called)
+        self.assertEqual(sorted(os.listdir('src')),
+                         ['dir', 'other', 'test.tar.xz'])
+        with open(os.path.join('src', 'dir', 'file')) as f:
+            self.assertEqual(f.read(), 'project/dir/file')
+        with open(os.path.join('src', 'test.tar.xz'), 'rb') as f:
+            self.assertEqual(f.read(), RangeHTTPRequestHandler.data)
+
+    def test_download_with_subdir_is_extracted_once_downloaded(self):
+        snapcraft.sources.Tar(self.source, 'src', source_subdir='dir').pull()
+
+        self.assertEqual(RangeHTTPRequestHandler.requests, [None])
+        self.assertEqual(sorted(os.listdir('src')),
+                         ['dir', 'test.tar.xz'])
+
+    def test_download_with_wrong_checksum_removes_what_was_extracted(self):
+        tar_source = snapcraft.sources.Tar(self.source, 'src',
+                                           source_checksum='sha256/0123')
+
+        with self.assertRaises(EnvironmentError):
+            tar_source.pull()
+
+        self.assertEqual(os.listdir('src'), [])
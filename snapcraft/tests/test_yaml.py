@@ -398,6 +398,107 @@ parts:
                             'Expected LD_LIBRARY_PATH to include "{}"'.format(
                                 expected))
 
+    def test_snap_library_paths(self):
+        config = snapcraft.yaml.Config()
+        snapdir = snapcraft.common.get_snapdir()
+        arch = snapcraft.common.get_arch_triplet()
+
+        self.assertEqual(config.snap_library_paths(), [
+            snapdir + '/lib', snapdir + '/usr/lib',
+            '{}/lib/{}'.format(snapdir, arch),
+            '{}/usr/lib/{}'.format(snapdir, arch)])
+
+    def test_build_env_for_part_with_shared_deps(self):
+        self.make_snapcraft_yaml("""name: test
+version: "1"
+summary: test
+description: test
+
+parts:
+  main:
+    plugin: nil
+    after: [left, right]
+  left:
+    plugin: nil
+    after: [base]
+  right:
+    plugin: nil
+    after: [base]
+  base:
+    plugin: nil
+""")
+        config = snapcraft.yaml.Config()
+        parts = {p.name: p for p in config.all_parts}
+        for part in parts.values():
+            part.code.env = unittest.mock.Mock(
+                return_value=['PATH="{}/bin:$PATH"'.format(part.name)])
+
+        stagedir = snapcraft.common.get_stagedir()
+        installdir = parts['main'].installdir
+        env = config.build_env_for_part(parts['main'])
+
+        parts['base'].code.env.assert_called_once_with(stagedir)
+        parts['main'].code.env.assert_called_once_with(installdir)
+        paths = [e for e in env if e.startswith('PATH=')]
+        self.assertEqual(paths, ['PATH="' + ':'.join([
+            '{}/bin'.format(installdir),
+            '{}/usr/bin'.format(installdir),
+            'main/bin',
+            '{}/bin'.format(stagedir),
+            '{}/usr/bin'.format(stagedir),
+            'right/bin',
+            'left/bin',
+            'base/bin',
+            '$PATH']) + '"'])
+
+    def test_merge_env(self):
+        env = snapcraft.yaml._merge_env([
+            'PATH="a:$PATH"',
+            'CFLAGS="-Ia $CFLAGS"',
+            'PYTHONPATH=a',
+            'PATH=b:a:$PATH',
+            'PYTHONPATH=a',
+            'CFLAGS="-Ib -Ia $CFLAGS"',
+            '. setup.sh',
+            'PATH="c:$PATH"',
+        ])
+
+        self.assertEqual(env, [
+            'PATH="b:a:$PATH"',
+            'CFLAGS="-Ib -Ia -Ia $CFLAGS"',
+            'PYTHONPATH=a',
+            '. setup.sh',
+            'PATH="c:$PATH"',
+        ])
+
+    def test_merge_env_keeps_paired_flags(self):
+        env = snapcraft.yaml._merge_env([
+            'CFLAGS="-isystem A $CFLAGS"',
+            'CFLAGS="-isystem B $CFLAGS"',
+        ])
+
+        self.assertEqual(env, ['CFLAGS="-isystem B -isystem A $CFLAGS"'])
+
+    def test_part_env_is_not_cached(self):
+        self.make_snapcraft_yaml("""name: test
+version: "1"
+summary: test
+description: test
+
+parts:
+  main:
+    plugin: nil
+""")
+        config = snapcraft.yaml.Config()
+        part = config.all_parts[0]
+        part.code.env = unittest.mock.Mock(return_value=[])
+        config.build_env_for_part(part)
+        # Such as the jars the ant plugin finds once built.
+        part.code.env.return_value = ['CLASSPATH=a.jar:$CLASSPATH']
+
+        self.assertIn('CLASSPATH=a.jar:$CLASSPATH',
+                      config.build_env_for_part(part))
+
 
 class TestValidation(tests.TestCase):
 
@@ -260,25 +260,23 @@ class Config:
         env.append('PERL5LIB={0}/usr/share/perl5/'.format(root))
         return env
 
-    def build_env_for_part(self, part, root_part=True):
+    def build_env_for_part(self, part):
         """Return a build env of all the part's dependencies."""
 
         env = []
         stagedir = common.get_stagedir()
-        for dep_part in part.deps:
+        deps = _get_all_deps(part)
+        for dep_part in deps:
             env += dep_part.env(stagedir)
-            env += self.build_env_for_part(dep_part, root_part=False)
-
-        if root_part:
-            env += part.env(part.installdir)
-            env += self.runtime_env(part.installdir)
-            env += self.build_env(part.installdir)
-        else:
-            env += part.env(stagedir)
+        if deps:
             env += self.runtime_env(stagedir)
             env += self.build_env(stagedir)
 
-        return env
+        env += part.env(part.installdir)
+        env += self.runtime_env(part.installdir)
+        env += self.build_env(part.installdir)
+
+        return _merge_env(env)
 
     def stage_env(self):
         root = common.get_stagedir()
@@ -301,6 +299,103 @@ class Config:
 
         return env
 
+    def snap_library_paths(self):
+        """Return the directories the snap has its libraries looked up in."""
+        paths = []
+        for line in self.snap_env():
+            name, _, value = line.partition('=')
+            if name != 'LD_LIBRARY_PATH':
+                continue
+            for path in value.strip('"').split(':'):
+                if path and '$' not in path and path not in paths:
+                    paths.append(path)
+        return paths
+
+
+def _get_all_deps(part):
+    """Return the dependencies of part and theirs, each one only once.
+
+    Dependencies come before the parts depending on them.
+    """
+    deps = []
+    seen = set()
+
+    def visit(part):
+        for dep_part in part.deps:
+            if dep_part.name not in seen:
+                seen.add(dep_part.name)
+                visit(dep_part)
+                deps.append(dep_part)
+
+    visit(part)
+    return deps
+
+
+# The variables holding lists of paths or flags, by their separator.
+# Flags can come in pairs, such as -isystem <dir>, only paths are unique.
+_PATH_VARIABLES = ('PATH', 'LD_LIBRARY_PATH', 'PKG_CONFIG_PATH')
+_LIST_VARIABLES = {
+    'PATH': ':',
+    'LD_LIBRARY_PATH': ':',
+    'PKG_CONFIG_PATH': ':',
+    'CFLAGS': ' ',
+    'CPPFLAGS': ' ',
+    'LDFLAGS': ' ',
+}
+
+
+def _merge_env(env):
+    """Merge the exports extending the same list variable into one.
+
+    Each export of a variable in _LIST_VARIABLES referencing its
+    previous value is folded into the first export of it, dropping the
+    paths already present in _PATH_VARIABLES. Assignments repeating the
+    current value of a variable are dropped as well. Anything that is not
+    an assignment is kept as is and starts over the merging as it could
+    change any variable.
+    """
+    merged = []
+    lists = {}
+    values = {}
+    for line in env:
+        name, sep, value = line.partition('=')
+        if not sep or not name.isidentifier():
+            if line not in merged:
+                merged.append(line)
+            lists.clear()
+            values.clear()
+            continue
+
+        separator = _LIST_VARIABLES.get(name)
+        if not separator:
+            if values.get(name) != value:
+                values[name] = value
+                merged.append(line)
+            continue
+
+        if len(value) > 1 and value[0] == value[-1] == '"':
+            value = value[1:-1]
+        entries = [e for e in value.split(separator) if e]
+        reference = '$' + name
+        if name not in lists:
+            lists[name] = (len(merged), [reference])
+            merged.append(None)
+        index, current = lists[name]
+        if reference in entries:
+            i = entries.index(reference)
+            entries = entries[:i] + current + entries[i + 1:]
+
+        current = entries
+        if name in _PATH_VARIABLES:
+            current = []
+            for entry in entries:
+                if entry not in current:
+                    current.append(entry)
+        lists[name] = (index, current)
+        merged[index] = '{}="{}"'.format(name, separator.join(current))
+
+    return merged
+
 
 def _validate_snapcraft_yaml(snapcraft_yaml):
     schema_file = os.path.abspath(os.path.join(common.get_schemadir(),
@@ -359,6 +454,22 @@ def _expand_filesets_for(stage, properties):
     return new_stage_set
 
 
+def load_compression():
+    """Return the compression section of snapcraft.yaml.
+
+    Only snapcraft.yaml itself is read, not the parts, so it can be checked
+    before anything is built. Missing or invalid files are reported when
+    the config is loaded.
+    """
+    try:
+        data = _snapcraft_yaml_load()
+    except SnapcraftYamlFileError:
+        return {}
+    if not isinstance(data, dict):
+        return {}
+    return data.get('compression') or {}
+
+
 def load_config():
     try:
         return Config()